@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+
+"""chat_view.py
+
+The Lair: how the gui client copes with a busy lair.
+
+A thread feeds --rate messages a second for --seconds into a chat view
+shown on the offscreen platform, while a timer in the gui thread checks
+how late it fires, which is how long a click or a key press would wait.
+The list view gets them in batches at most --fps times a second, the
+text edit the gui used before gets every message as a signal of its
+own.  Every view runs in a process of its own, the script reports the
+timer lag, how long the view took to catch up once the feed stopped,
+the lines it holds and how much its process grew.
+
+    python3 benchmarks/chat_view.py --rate 10000 --seconds 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtCore, QtWidgets
+
+from lairchat.gui.MessageView import MessageBatcher, MessageView
+
+# Milliseconds between checks of the gui thread
+PROBE_MS = 10
+
+
+class Receiver(QtCore.QObject):
+    """A message per signal, the way the text edit was fed."""
+
+    message = QtCore.pyqtSignal(str)
+
+
+def rss_mb() -> float:
+    """The resident memory of this process in megabytes."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def feed(post: Callable[[str], None], rate: int, seconds: float) -> None:
+    """Post rate messages a second, a millisecond's worth at a time."""
+    start = time.perf_counter()
+    sent = 0
+    total = int(rate * seconds)
+    while sent < total:
+        due = min(total, int((time.perf_counter() - start) * rate))
+        while sent < due:
+            post(f"<user{sent % 50}> message {sent} of a busy lair, say something")
+            sent += 1
+        time.sleep(0.001)
+
+
+def run_view(view_name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Feed one view and measure the gui thread and memory."""
+    app = QtWidgets.QApplication(sys.argv)
+    shown = [0]
+    if view_name == "list":
+        view = MessageView()
+        batcher = MessageBatcher(args.fps)
+
+        def show_batch(lines: list) -> None:
+            view.add_batch(lines)
+            shown[0] += len(lines)
+
+        batcher.batch.connect(show_batch)
+        post = batcher.post
+        rows = lambda: view.model().rowCount()
+    else:
+        view = QtWidgets.QTextEdit()
+        view.setReadOnly(True)
+        receiver = Receiver()
+
+        def show_message(text: str) -> None:
+            view.append(f'<font color="blue">{text}</font>')
+            shown[0] += 1
+
+        receiver.message.connect(show_message)
+        post = receiver.message.emit
+        rows = lambda: view.document().blockCount()
+    view.resize(500, 400)
+    view.show()
+    app.processEvents()
+    before = rss_mb()
+
+    # The gui thread is late by however long the timer fires after it should
+    lags = []
+    last = [time.perf_counter()]
+
+    def probe() -> None:
+        now = time.perf_counter()
+        lags.append(max(0.0, now - last[0] - PROBE_MS / 1000))
+        last[0] = now
+
+    timer = QtCore.QTimer()
+    timer.timeout.connect(probe)
+    timer.start(PROBE_MS)
+
+    total = int(args.rate * args.seconds)
+    feeder = threading.Thread(target=feed, args=(post, args.rate, args.seconds))
+    feeder.start()
+    while feeder.is_alive():
+        app.processEvents(QtCore.QEventLoop.AllEvents, 50)
+    stopped = time.perf_counter()
+    while shown[0] < total and time.perf_counter() - stopped < args.timeout:
+        app.processEvents(QtCore.QEventLoop.AllEvents, 50)
+    caught_up = time.perf_counter() - stopped
+    timer.stop()
+
+    lags.sort()
+    return {
+        "view": view_name,
+        "shown": shown[0],
+        "lag_p50_ms": statistics.median(lags) * 1000,
+        "lag_p99_ms": lags[int(len(lags) * 0.99)] * 1000,
+        "lag_max_ms": lags[-1] * 1000,
+        "catch_up_s": caught_up,
+        "rows": rows(),
+        "grew_mb": rss_mb() - before,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair chat view benchmark")
+    parser.add_argument("--rate", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--views", nargs="+", default=["textedit", "list"])
+    parser.add_argument("--view", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.view:
+        print(json.dumps(run_view(args.view, args)))
+        return
+
+    print(
+        f'{"view":<10}{"shown":>8}{"lag p50":>9}{"p99":>8}{"max":>8}'
+        f'{"catch up":>10}{"rows":>8}{"grew MB":>9}'
+    )
+    for name in args.views:
+        result = json.loads(
+            subprocess.run(
+                [sys.executable, __file__, "--view", name]
+                + ["--rate", str(args.rate), "--seconds", str(args.seconds)]
+                + ["--fps", str(args.fps), "--timeout", str(args.timeout)],
+                stdout=subprocess.PIPE,
+                check=True,
+                text=True,
+            ).stdout
+        )
+        print(
+            f'{result["view"]:<10}{result["shown"]:>8}{result["lag_p50_ms"]:>9.1f}'
+            f'{result["lag_p99_ms"]:>8.1f}{result["lag_max_ms"]:>8.1f}'
+            f'{result["catch_up_s"]:>10.2f}{result["rows"]:>8}{result["grew_mb"]:>9.1f}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
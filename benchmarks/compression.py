@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+
+"""compression.py
+
+The Lair: how much compressing messages saves and what it costs.
+
+Packs --messages chat lines, the way the server formats them, with deflate
+alone, deflate against the preset dictionary, and as one stream against
+the dictionary the way clients and the server send them, then unpacks
+them again.  Reports the bytes on the wire against the
+text, the messages too short to compress and the CPU time per message
+both ways.  Chat lines are made up from common words unless --file names
+a file of real ones, one per line, and --dictionary tries another
+dictionary in place of the preset one.
+
+    python3 benchmarks/compression.py --messages 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.net import Compression
+from lairchat.net.Compression import (
+    LEVEL,
+    MEM_LEVEL,
+    STORED,
+    WBITS,
+    Deflater,
+    Inflater,
+)
+
+WORDS = (
+    "i you the a to is it that and what do so in my be for not just like me "
+    "lol yeah ok no this have are was with but think know get on all haha "
+    "how can good one at of we your there about if now oh did would why "
+    "really time out up going when well see go want he some people right "
+    "they got make thanks nice sure here been too will back hey today work "
+    "game tonight anyone server update fixed broken python build release "
+    "tomorrow weekend idk brb btw sounds great maybe later lunch coffee"
+).split()
+
+NAMES = [
+    f"{name}{i}" for name in ("nyx", "gort", "ash", "mira", "zed") for i in (1, 7, 42)
+]
+
+
+def corpus(args: argparse.Namespace) -> List[bytes]:
+    """Chat lines as clients send them and the server broadcasts them."""
+    if args.file is not None:
+        with open(args.file, encoding="utf-8", errors="ignore") as f:
+            lines = [line.rstrip("\n") for line in f if line.strip()]
+        return [lines[i % len(lines)].encode() for i in range(args.messages)]
+
+    messages = []
+    for i in range(args.messages):
+        name = random.choice(NAMES)
+        if i % 20 == 0:
+            messages.append(f"{name} has entered the lair!".encode())
+            continue
+        words = random.choices(WORDS, k=1 + int(random.expovariate(1 / args.words)))
+        text = " ".join(words)
+        if args.sent:
+            messages.append(text.encode())
+        else:
+            stamp = f"{i // 3600 % 24:02}:{i // 60 % 60:02}:{i % 60:02}"
+            messages.append(f"[{stamp}]\n{name}: {text}".encode())
+    return messages
+
+
+class PlainDeflater:
+    """Deflate every message on its own without a dictionary."""
+
+    stream = None
+
+    def pack(self, data: bytes) -> bytes:
+        """A marker byte and the data, compressed unless it wouldn't pay."""
+        deflater = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, MEM_LEVEL)
+        packed = deflater.compress(data) + deflater.flush()
+        if len(packed) >= len(data):
+            return bytes([STORED]) + data
+        return bytes([1]) + packed
+
+
+class PlainInflater:
+    """Inflate what PlainDeflater packed."""
+
+    def unpack(self, payload: bytes) -> bytes:
+        """The data of a packed message."""
+        if payload[0] == STORED:
+            return payload[1:]
+        return zlib.decompressobj(WBITS).decompress(payload[1:])
+
+
+def measure(
+    messages: List[bytes], deflater: Any, inflater: Any
+) -> Tuple[int, int, float, float]:
+    """Bytes packed, messages stored as they were and seconds both ways."""
+    start = time.perf_counter()
+    packed = [deflater.pack(message) for message in messages]
+    packing = time.perf_counter() - start
+
+    start = time.perf_counter()
+    unpacked = [inflater.unpack(payload) for payload in packed]
+    unpacking = time.perf_counter() - start
+
+    if unpacked != messages:
+        raise SystemExit("messages came back changed")
+    stored = sum(1 for payload in packed if payload[0] == STORED)
+    return sum(len(payload) for payload in packed), stored, packing, unpacking
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair compression benchmark")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--words", type=float, default=8.0)
+    parser.add_argument("--file", default=None, help="chat lines, one per line")
+    parser.add_argument("--dictionary", default=None, help="dictionary to try")
+    parser.add_argument(
+        "--sent", action="store_true", help="lines as sent, without name and time"
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    if args.dictionary is not None:
+        with open(args.dictionary, "rb") as f:
+            Compression.DICTIONARY = f.read()
+    messages = corpus(args)
+    text = sum(len(message) for message in messages)
+    count = len(messages)
+
+    print(f'{" Lair compression ":*^60}')
+    print(f"messages:  {count}, {text / count:.1f} B each on average", end="")
+    print(f", dictionary {len(Compression.DICTIONARY)} B")
+    print()
+    print(f'{"":>14}{"ratio":>8}{"stored":>9}{"pack us":>10}{"unpack us":>11}')
+    for name, deflater, inflater in (
+        ("deflate", PlainDeflater(), PlainInflater()),
+        ("deflate+dict", Deflater(), Inflater()),
+        ("stream+dict", Deflater(streaming=True), Inflater()),
+    ):
+        size, stored, packing, unpacking = measure(messages, deflater, inflater)
+        print(
+            f"{name:>14}{size / text:>8.3f}{stored / count:>8.1%}"
+            f"{packing / count * 1e6:>10.2f}{unpacking / count * 1e6:>11.2f}"
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
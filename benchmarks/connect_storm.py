@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+
+"""connect_storm.py
+
+The Lair: a storm of connections, some of which never log in.
+
+A server runs in a process of its own while --connections clients
+connect over --seconds, evenly spread.  An --idle share of them connect
+and say nothing, like half-open or idle connections, and hold on until
+the server drops them.  The others say hello, pick a name once greeted
+and quit once welcomed.  The script reports how long those waited to be
+greeted after connecting, which is how long the server took to accept
+them and start their handshake, and to log in, how many clients were
+turned away with too many handshakes going on, how many failed to
+connect or said hello too late to be taken for framed clients, how many
+the server timed out, and the most threads it ran at once.
+
+    python3 benchmarks/connect_storm.py --connections 10000 --seconds 3
+    python3 benchmarks/connect_storm.py --idle 0.9 --max-handshakes 256
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import re
+import selectors
+import statistics
+import sys
+import time
+import urllib.request
+from socket import *
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import FRAMED, FrameError, WireCodec, encode_hello
+
+ENGINES = {"threaded": ChatServer, "asyncio": AsyncChatServer}
+
+# Seconds between counting the threads of the server
+SAMPLE = 0.05
+
+
+class Client:
+    """One connection of the storm, moving along as it is answered."""
+
+    __slots__ = ("sock", "name", "idle", "codec", "started", "greeted", "welcomed")
+
+    def __init__(self, name: str, idle: bool) -> None:
+        """Start connecting without blocking."""
+        self.name = name
+        self.idle = idle
+        self.codec = WireCodec(FRAMED)
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.started = time.perf_counter()
+        self.greeted: Union[float, None] = None
+        self.welcomed: Union[float, None] = None
+
+
+def serve(engine: str, config: ServerConfig, pipe: Any) -> None:
+    """Run a server, telling the parent its port."""
+    logging.disable(logging.WARNING)
+    server = ENGINES[engine]("127.0.0.1", 0, admin_console=False, config=config)
+    pipe.send(server.server.getsockname()[1])
+    server.run()
+
+
+def free_port() -> int:
+    """A local port nobody listens on right now."""
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def threads(pid: int) -> int:
+    """The threads a process runs."""
+    with open(f"/proc/{pid}/status") as status:
+        return int(re.search(r"Threads:\s+(\d+)", status.read()).group(1))
+
+
+def counter(metrics: str, name: str) -> int:
+    """The value of a counter in Prometheus text."""
+    return int(float(re.search(rf"^{name} (\S+)$", metrics, re.M).group(1)))
+
+
+def percentile(values: List[float], q: float) -> float:
+    """The q quantile of sorted values in milliseconds."""
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+def storm(engine: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Connect the storm to a server and follow every client through it."""
+    config = ServerConfig(
+        listen_backlog=args.listen_backlog,
+        accept_batch=args.accept_batch,
+        max_handshakes=args.max_handshakes,
+        handshake_timeout=args.handshake_timeout,
+        metrics_port=free_port(),
+    )
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.get_context("fork").Process(
+        target=serve, args=(engine, config, child), daemon=True
+    )
+    process.start()
+    address = ("127.0.0.1", parent.recv())
+    time.sleep(0.2)
+
+    sel = selectors.DefaultSelector()
+    clients: List[Client] = []
+    rejected = failed = finished = 0
+    peak_threads = threads(process.pid)
+    sampled = start = time.perf_counter()
+
+    def finish(client: Client) -> None:
+        """Stop following a client, an idle one holds on to its connection."""
+        nonlocal finished
+        sel.unregister(client.sock)
+        finished += 1
+        if not client.idle or client.greeted is None:
+            client.sock.close()
+
+    while finished < args.connections:
+        now = time.perf_counter()
+        if now - start > args.seconds + args.timeout:
+            break
+        if now - sampled > SAMPLE:
+            peak_threads = max(peak_threads, threads(process.pid))
+            sampled = now
+
+        # Connect every client due by now, every so many of them idle
+        due = int((now - start) / args.seconds * args.connections)
+        due = min(args.connections, due)
+        while len(clients) < due:
+            i = len(clients)
+            client = Client(f"s{i}", int(i * args.idle) != int((i + 1) * args.idle))
+            client.sock.connect_ex(address)
+            sel.register(client.sock, selectors.EVENT_WRITE, client)
+            clients.append(client)
+
+        for key, mask in sel.select(0.001):
+            client = key.data
+            if mask & selectors.EVENT_WRITE:
+                if client.sock.getsockopt(SOL_SOCKET, SO_ERROR) != 0:
+                    failed += 1
+                    finish(client)
+                    continue
+                sel.modify(client.sock, selectors.EVENT_READ, client)
+                if not client.idle:
+                    client.sock.send(encode_hello())
+                continue
+
+            # Closed before the greeting, the server turned the client away
+            try:
+                data = client.sock.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                rejected += client.greeted is None
+                finish(client)
+                continue
+
+            # Idle clients are greeted as legacy clients, and say nothing more
+            if client.idle:
+                client.greeted = time.perf_counter()
+                finish(client)
+                continue
+            try:
+                messages = client.codec.feed(data)
+            except FrameError:
+                failed += 1
+                finish(client)
+                continue
+            for message in messages:
+                if client.greeted is None:
+                    client.greeted = time.perf_counter()
+                    client.sock.send(client.codec.encode(client.name))
+                elif message.startswith(f"Hello {client.name}!".encode()):
+                    client.welcomed = time.perf_counter()
+                    client.sock.send(client.codec.encode("{quit}"))
+                    finish(client)
+                    break
+    elapsed = time.perf_counter() - start
+
+    # Give the server the time to drop the idle clients it took in
+    time.sleep(args.handshake_timeout + 0.5)
+    metrics = urllib.request.urlopen(f"http://127.0.0.1:{config.metrics_port}/metrics")
+    text = metrics.read().decode()
+    process.kill()
+    process.join()
+    for client in clients:
+        client.sock.close()
+
+    talkers = [client for client in clients if not client.idle]
+    greet = sorted(c.greeted - c.started for c in talkers if c.greeted is not None)
+    login = sorted(c.welcomed - c.started for c in talkers if c.welcomed is not None)
+    return {
+        "engine": engine,
+        "connections": len(clients),
+        "talkers": len(talkers),
+        "logged_in": len(login),
+        "rejected": rejected,
+        "failed": failed,
+        "server_rejected": counter(text, "lair_handshakes_rejected_total"),
+        "timed_out": counter(text, "lair_handshakes_timed_out_total"),
+        "accept_p50_ms": statistics.median(greet) * 1000 if greet else 0.0,
+        "accept_p99_ms": percentile(greet, 0.99),
+        "accept_max_ms": percentile(greet, 1.0),
+        "login_p99_ms": percentile(login, 0.99),
+        "threads": peak_threads,
+        "seconds": elapsed,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair connect storm benchmark")
+    parser.add_argument(
+        "--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES)
+    )
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--idle", type=float, default=0.5)
+    parser.add_argument(
+        "--listen-backlog", type=int, default=ServerConfig.listen_backlog
+    )
+    parser.add_argument("--accept-batch", type=int, default=ServerConfig.accept_batch)
+    parser.add_argument(
+        "--max-handshakes", type=int, default=ServerConfig.max_handshakes
+    )
+    parser.add_argument("--handshake-timeout", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    print(
+        f'{"engine":<10}{"conns":>7}{"logged in":>11}{"rejected":>10}{"failed":>8}'
+        f'{"timed out":>11}{"accept p50":>12}{"p99":>8}{"max":>8}{"login p99":>11}'
+        f'{"threads":>9}{"secs":>7}'
+    )
+    for engine in args.engines:
+        result = storm(engine, args)
+        print(
+            f'{result["engine"]:<10}{result["connections"]:>7}'
+            f'{result["logged_in"]:>6}/{result["talkers"]:<4}'
+            f'{result["rejected"]:>10}{result["failed"]:>8}{result["timed_out"]:>11}'
+            f'{result["accept_p50_ms"]:>12.1f}{result["accept_p99_ms"]:>8.1f}'
+            f'{result["accept_max_ms"]:>8.1f}{result["login_p99_ms"]:>11.1f}'
+            f'{result["threads"]:>9}{result["seconds"]:>7.1f}'
+        )
+        if result["rejected"] != result["server_rejected"]:
+            print(f'  the server turned {result["server_rejected"]} away')
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+
+"""crypto.py
+
+The Lair: cipher micro-benchmark.
+
+Compares the legacy AES-CBC + base64 path with the framed session
+ciphers, sealing and opening messages of each size in turn, and reports
+messages/sec and payload bytes/sec for both directions.
+
+    python3 benchmarks/crypto.py --sizes 64 1024 65536
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.crypto.AESCipher import aes_cipher
+from lairchat.crypto.Ciphers import SUITES, new_cipher
+
+
+def timed(func: Callable, items: List[Any], seconds: float) -> Tuple[int, float]:
+    """Call func on items round robin for about seconds, return calls made."""
+    calls = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        for item in items:
+            func(item)
+        calls += len(items)
+    return calls, elapsed
+
+
+def bench_legacy(size: int, seconds: float) -> Tuple[float, float]:
+    """Seal and open with AES-CBC + base64, return calls/sec both ways."""
+    message = "x" * size
+    encrypted = [aes_cipher.encrypt(message) for _ in range(16)]
+    seal_calls, seal_time = timed(aes_cipher.encrypt, [message] * 16, seconds)
+    open_calls, open_time = timed(aes_cipher.decrypt, encrypted, seconds)
+    return seal_calls / seal_time, open_calls / open_time
+
+
+def bench_suite(suite: int, size: int, seconds: float) -> Tuple[float, float]:
+    """Seal and open with a session cipher, return calls/sec both ways."""
+    cipher = new_cipher(suite)
+    data = b"x" * size
+    sealed = [bytes(cipher.seal(data)) for _ in range(16)]
+    seal_calls, seal_time = timed(cipher.seal, [data] * 16, seconds)
+    open_calls, open_time = timed(cipher.open, sealed, seconds)
+    return seal_calls / seal_time, open_calls / open_time
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair cipher benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 65536])
+    parser.add_argument("--seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(f'{"cipher":<12}{"size":>7}', end="")
+    print(f'{"seal msg/s":>13}{"seal MB/s":>11}{"open msg/s":>13}{"open MB/s":>11}')
+    for size in args.sizes:
+        rows = [("cbc+base64", bench_legacy(size, args.seconds))]
+        for suite, cipher in SUITES.items():
+            rows.append((cipher.name, bench_suite(suite, size, args.seconds)))
+
+        for name, (seal_rate, open_rate) in rows:
+            print(
+                f"{name:<12}{size:>7}"
+                f"{seal_rate:>13.0f}{seal_rate * size / 1e6:>11.1f}"
+                f"{open_rate:>13.0f}{open_rate * size / 1e6:>11.1f}"
+            )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
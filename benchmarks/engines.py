@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+
+"""engines.py
+
+The Lair: compare the threaded and asyncio server engines.
+
+Each engine is started in-process on an ephemeral port.  The benchmark
+connects as many clients as it can (up to --clients), completes the
+username handshake for each of them and then runs rounds in which
+--senders clients each send one message that is broadcast to everybody
+else.  Reported are the number of connections held and the number of
+delivered messages per second, and how many frames were written per send
+call with the given --flush-interval.
+
+    python3 benchmarks/engines.py --clients 500 --rounds 50
+    python3 benchmarks/engines.py --flush-interval 0.005
+"""
+
+import argparse
+import os
+import selectors
+import sys
+import threading
+import time
+from socket import *
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import FRAMED, FrameDecoder, encode_hello, encode_message
+
+ENGINES = {"threaded": ChatServer, "asyncio": AsyncChatServer}
+
+
+def start_server(engine: str, config: ServerConfig) -> ChatServer:
+    """Start a server engine in a daemon thread."""
+    server = ENGINES[engine]("127.0.0.1", 0, admin_console=False, config=config)
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+
+def read_frame(sock: socket, decoder: FrameDecoder) -> bytes:
+    """Block until a whole frame has been read."""
+    while not (frames := decoder.feed(sock.recv(4096))):
+        pass
+    return frames[0]
+
+
+def connect_clients(address: Tuple[str, int], count: int) -> List[socket]:
+    """Connect and log in up to count clients, stop at the first failure."""
+    clients = []
+    for i in range(count):
+        try:
+            sock = create_connection(address, timeout=5)
+            sock.sendall(encode_hello())
+            decoder = FrameDecoder()
+            read_frame(sock, decoder)
+            sock.sendall(encode_message(f"b{i:05d}", FRAMED))
+            read_frame(sock, decoder)
+        except OSError as e:
+            print(f"connection {i} failed: {e}")
+            break
+        clients.append(sock)
+    return clients
+
+
+def drain(clients: List[socket], sel: selectors.BaseSelector, idle: float) -> None:
+    """Read and discard everything until the clients have been idle a while."""
+    while events := sel.select(timeout=idle):
+        for key, mask in events:
+            try:
+                key.fileobj.recv(65536)
+            except OSError:
+                pass
+
+
+def run_rounds(
+    clients: List[socket],
+    sel: selectors.BaseSelector,
+    senders: int,
+    rounds: int,
+    size: int,
+) -> Tuple[int, float]:
+    """Broadcast rounds of messages, return messages delivered and seconds."""
+    payload = "x" * size
+    frame_size = len(encode_message(f"[00:00:00]\nb00000: {payload}", FRAMED))
+    encrypted = encode_message(payload, FRAMED)
+    per_round = senders * (len(clients) - 1) * frame_size
+
+    delivered = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for sock in clients[:senders]:
+            sock.sendall(encrypted)
+
+        received = 0
+        deadline = time.perf_counter() + 10
+        while received < per_round and time.perf_counter() < deadline:
+            for key, mask in sel.select(timeout=1):
+                try:
+                    received += len(key.fileobj.recv(65536))
+                except OSError:
+                    pass
+        delivered += received // frame_size
+        if received < per_round:
+            print("round timed out")
+            break
+
+    return delivered, time.perf_counter() - start
+
+
+def bench_engine(engine: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmark a single server engine."""
+    config = ServerConfig(flush_interval=args.flush_interval)
+    server = start_server(engine, config)
+    clients = connect_clients(server.server.getsockname(), args.clients)
+
+    sel = selectors.DefaultSelector()
+    for sock in clients:
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+    drain(clients, sel, 0.5)
+
+    senders = min(args.senders, len(clients))
+    delivered, elapsed = run_rounds(clients, sel, senders, args.rounds, args.size)
+
+    queues = [session.queue for session in server.connections.sessions()]
+    frames = sum(queue.sent_frames for queue in queues)
+    writes = sum(queue.writes for queue in queues)
+
+    for sock in clients:
+        sel.unregister(sock)
+        sock.close()
+    sel.close()
+
+    return {
+        "engine": engine,
+        "connections": len(clients),
+        "delivered": delivered,
+        "msgs_per_sec": delivered / elapsed if elapsed else 0.0,
+        "frames_per_write": frames / writes if writes else 0.0,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair server engine benchmark")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=ENGINES)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--flush-interval", type=float, default=0.0)
+    args = parser.parse_args()
+
+    print(f'{"engine":<10}{"connections":>14}{"delivered":>12}{"msgs/sec":>12}', end="")
+    print(f'{"frames/write":>14}')
+    for engine in args.engines:
+        result = bench_engine(engine, args)
+        print(
+            f'{result["engine"]:<10}{result["connections"]:>14}'
+            f'{result["delivered"]:>12}{result["msgs_per_sec"]:>12.0f}'
+            f'{result["frames_per_write"]:>14.2f}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+
+"""federation.py
+
+The Lair: end-to-end delivery latency across linked servers.
+
+Starts --nodes servers in-process, each linked to the one before it, so
+a message crosses every link of the chain.  A sender on the first node
+broadcasts timestamped messages and a client on every node reads them.
+The script reports delivery latency to the clients on the last node and
+checks everybody got every message exactly once.
+
+    python3 benchmarks/federation.py --nodes 1 2 4 --engine asyncio
+"""
+
+import argparse
+import os
+import selectors
+import statistics
+import sys
+import threading
+import time
+from socket import *
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import FRAMED, WireCodec, encode_hello, encode_message
+
+ENGINES = {"threaded": ChatServer, "asyncio": AsyncChatServer}
+
+
+def login(address: Tuple[str, int], username: str) -> socket:
+    """Connect a framed client and pick a username."""
+    sock = create_connection(address)
+    sock.sendall(encode_hello() + encode_message(username, FRAMED))
+    return sock
+
+
+def start_chain(engine: str, nodes: int) -> List[ChatServer]:
+    """Start servers, each linked with the one started before it."""
+    servers: List[ChatServer] = []
+    for _ in range(nodes):
+        peers = [servers[-1].federation.address] if servers else []
+        config = ServerConfig(link_port=0, peers=peers, link_secret="bench")
+        server = ENGINES[engine]("127.0.0.1", 0, admin_console=False, config=config)
+        threading.Thread(target=server.run, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def bench(engine: str, nodes: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Measure delivery latency across a chain of linked servers."""
+    servers = start_chain(engine, nodes)
+    readers = [
+        login(server.server.getsockname(), f"r{i}") for i, server in enumerate(servers)
+    ]
+    sender = login(servers[0].server.getsockname(), "sender")
+
+    # Wait for presence to reach the end of the chain
+    deadline = time.perf_counter() + 10
+    while time.perf_counter() < deadline:
+        if all(len(server.roster()) == nodes + 1 for server in servers):
+            break
+        time.sleep(0.05)
+    time.sleep(0.5)
+
+    sel = selectors.DefaultSelector()
+    for i, sock in enumerate(readers):
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ, (i, WireCodec(FRAMED)))
+
+    def send() -> None:
+        """Send timestamped messages at the requested rate."""
+        for _ in range(args.messages):
+            stamp = f"{time.perf_counter():.6f}"
+            sender.sendall(encode_message(stamp.ljust(args.size, "."), FRAMED))
+            time.sleep(1 / args.rate)
+
+    threading.Thread(target=send, daemon=True).start()
+
+    latencies = []
+    received = [0] * nodes
+    deadline = time.perf_counter() + args.messages / args.rate + 10
+    while sum(received) < args.messages * nodes and time.perf_counter() < deadline:
+        for key, mask in sel.select(timeout=1):
+            node, codec = key.data
+            for message in codec.feed(key.fileobj.recv(1 << 20)):
+                text = message.decode("utf-8", "ignore")
+                if "sender: " not in text:
+                    continue
+                received[node] += 1
+                if node == nodes - 1:
+                    stamp = float(text.split("sender: ", 1)[1].rstrip("."))
+                    latencies.append(time.perf_counter() - stamp)
+
+    for sock in readers + [sender]:
+        sock.close()
+    for server in servers:
+        if server.federation is not None:
+            server.federation.close()
+
+    latencies.sort()
+    return {
+        "nodes": nodes,
+        "exactly_once": all(count == args.messages for count in received),
+        "delivered": len(latencies),
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair federation benchmark")
+    parser.add_argument("--engine", default="threaded", choices=ENGINES)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=256)
+    args = parser.parse_args()
+
+    print(f'{"nodes":>6}{"once":>6}{"delivered":>11}', end="")
+    print(f'{"p50 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+    for nodes in args.nodes:
+        result = bench(args.engine, nodes, args)
+        print(
+            f'{result["nodes"]:>6}{str(result["exactly_once"]):>6}'
+            f'{result["delivered"]:>11}{result["p50_ms"]:>9.2f}'
+            f'{result["p99_ms"]:>9.2f}{result["max_ms"]:>9.2f}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
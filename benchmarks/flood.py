@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+
+"""flood.py
+
+The Lair: latency for well-behaved clients while another one floods.
+
+A server runs in a process of its own with --talkers clients in the
+lobby, each saying a timestamped line --rate times a second.  After
+--quiet seconds a flooder, in a process of its own, logs in and sends
+lines to the lobby as fast as it can for --flood seconds, like a client
+pasting a large file.  The script reports the delivery latency of the
+talkers' lines before and during the flood, the flood lines a talker
+was sent a second, and how often the server paused the flooder, first
+with no limits and then with --client-rate and --room-rate.
+
+    python3 benchmarks/flood.py --talkers 10 --flood 5
+    python3 benchmarks/flood.py --engines asyncio --client-rate 50
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import re
+import selectors
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+from socket import *
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import FRAMED, WireCodec, encode_hello, encode_message
+
+ENGINES = {"threaded": ChatServer, "asyncio": AsyncChatServer}
+
+# Lines the flooder sends at once
+CHUNK = 100
+
+
+def serve(engine: str, config: ServerConfig, pipe: Any) -> None:
+    """Run a server, telling the parent its port."""
+    logging.disable(logging.WARNING)
+    server = ENGINES[engine]("127.0.0.1", 0, admin_console=False, config=config)
+    pipe.send(server.server.getsockname()[1])
+    server.run()
+
+
+def free_port() -> int:
+    """A local port nobody listens on right now."""
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def counter(metrics: str, name: str) -> int:
+    """The value of a counter in Prometheus text."""
+    return int(float(re.search(rf"^{name} (\S+)$", metrics, re.M).group(1)))
+
+
+def login(address: Tuple[str, int], username: str) -> socket:
+    """Connect a framed client and pick a username."""
+    sock = create_connection(address)
+    sock.sendall(encode_hello() + encode_message(username, FRAMED))
+    return sock
+
+
+def flood(address: Tuple[str, int], size: int) -> None:
+    """Send lines as fast as the server takes them, reading what comes back."""
+    sock = login(address, "flooder")
+
+    def drain() -> None:
+        """Throw away what the flooder is sent."""
+        while sock.recv(1 << 20):
+            pass
+
+    threading.Thread(target=drain, daemon=True).start()
+    line = encode_message("x" * size, FRAMED)
+    while True:
+        sock.sendall(line * CHUNK)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """The q quantile of sorted values in milliseconds."""
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+def bench(engine: str, limited: bool, args: argparse.Namespace) -> Dict[str, Any]:
+    """Measure talker latency before and during a flood."""
+    config = ServerConfig(
+        client_rate=args.client_rate if limited else 0.0,
+        client_burst=args.client_burst,
+        room_rate=args.room_rate if limited else 0.0,
+        room_burst=args.room_burst,
+        resume_grace=0,
+        metrics_port=free_port(),
+    )
+    context = multiprocessing.get_context("fork")
+    parent, child = context.Pipe()
+    server = context.Process(target=serve, args=(engine, config, child), daemon=True)
+    server.start()
+    address = ("127.0.0.1", parent.recv())
+
+    talkers = [login(address, f"t{i}") for i in range(args.talkers)]
+    time.sleep(1)
+    sel = selectors.DefaultSelector()
+    for sock in talkers:
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ, WireCodec(FRAMED))
+
+    # Talkers take turns, so the room hears them evenly spread
+    running = threading.Event()
+    running.set()
+
+    def talk() -> None:
+        """Say timestamped lines until the end."""
+        turn = 0
+        while running.is_set():
+            stamp = f"{time.perf_counter():.6f}"
+            talkers[turn % len(talkers)].sendall(encode_message(stamp, FRAMED))
+            turn += 1
+            time.sleep(1 / (args.rate * len(talkers)))
+
+    start = time.perf_counter()
+    flood_start = start + args.quiet
+    end = flood_start + args.flood
+    threading.Thread(target=talk, daemon=True).start()
+    flooder: Union[multiprocessing.Process, None] = None
+
+    quiet: List[float] = []
+    flooded: List[float] = []
+    flood_lines = 0
+    while (now := time.perf_counter()) < end:
+        if flooder is None and now >= flood_start:
+            flooder = context.Process(target=flood, args=(address, args.size))
+            flooder.start()
+        for key, _ in sel.select(0.05):
+            for message in key.data.feed(key.fileobj.recv(1 << 20)):
+                text = message.decode("utf-8", "ignore")
+                if "flooder: " in text:
+                    flood_lines += 1
+                elif (stamp := text.rpartition(": ")[2]).replace(".", "").isdigit():
+                    sent = float(stamp)
+                    latency = time.perf_counter() - sent
+                    (flooded if sent >= flood_start else quiet).append(latency)
+    running.clear()
+
+    metrics = urllib.request.urlopen(f"http://127.0.0.1:{config.metrics_port}/metrics")
+    throttled = counter(metrics.read().decode(), "lair_throttled_total")
+    for process in (flooder, server):
+        process.kill()
+        process.join()
+    for sock in talkers:
+        sock.close()
+
+    quiet.sort()
+    flooded.sort()
+    return {
+        "engine": engine,
+        "limits": "on" if limited else "off",
+        "quiet_p50_ms": statistics.median(quiet) * 1000 if quiet else 0.0,
+        "quiet_p99_ms": percentile(quiet, 0.99),
+        "flood_p50_ms": statistics.median(flooded) * 1000 if flooded else 0.0,
+        "flood_p99_ms": percentile(flooded, 0.99),
+        "flood_max_ms": percentile(flooded, 1.0),
+        "delivered": len(flooded),
+        "flood_rate": flood_lines / len(talkers) / args.flood,
+        "throttled": throttled,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair flood benchmark")
+    parser.add_argument(
+        "--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES)
+    )
+    parser.add_argument("--talkers", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=2.0)
+    parser.add_argument("--quiet", type=float, default=3.0)
+    parser.add_argument("--flood", type=float, default=5.0)
+    parser.add_argument("--size", type=int, default=80)
+    parser.add_argument("--client-rate", type=float, default=20.0)
+    parser.add_argument("--client-burst", type=int, default=ServerConfig.client_burst)
+    parser.add_argument("--room-rate", type=float, default=200.0)
+    parser.add_argument("--room-burst", type=int, default=ServerConfig.room_burst)
+    args = parser.parse_args()
+
+    print(
+        f'{"engine":<10}{"limits":>7}{"quiet p50":>11}{"p99":>8}{"flood p50":>11}'
+        f'{"p99":>8}{"max":>8}{"lines":>7}{"flood/s":>9}{"pauses":>8}'
+    )
+    for engine in args.engines:
+        for limited in (False, True):
+            result = bench(engine, limited, args)
+            print(
+                f'{result["engine"]:<10}{result["limits"]:>7}'
+                f'{result["quiet_p50_ms"]:>11.1f}{result["quiet_p99_ms"]:>8.1f}'
+                f'{result["flood_p50_ms"]:>11.1f}{result["flood_p99_ms"]:>8.1f}'
+                f'{result["flood_max_ms"]:>8.1f}{result["delivered"]:>7}'
+                f'{result["flood_rate"]:>9.0f}{result["throttled"]:>8}'
+            )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
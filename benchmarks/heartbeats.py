@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+
+"""heartbeats.py
+
+The Lair: watching many clients with heartbeats.
+
+First the timers alone: --timers sessions each get a heartbeat timer,
+and for a few minutes of simulated time every timer that comes due is
+set again, as the server does for clients it heard from.  The timer
+wheel is compared with a heap, reporting the time to set a timer, to
+take out those due each tick, and the memory the timers hold.
+
+Then a server with --live clients that answer pings and --dead clients
+that log in and never read or write again, like peers that vanished.
+The script reports the pings sent, how many clients were evicted and
+how long after going quiet, and whether every live client was kept.
+
+    python3 benchmarks/heartbeats.py --timers 100000
+    python3 benchmarks/heartbeats.py --engine asyncio --live 200 --dead 200
+"""
+
+import argparse
+import heapq
+import logging
+import os
+import random
+import selectors
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from socket import *
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.cli.TimerWheel import TimerWheel
+from lairchat.net.Framing import FRAMED, WireCodec, encode_hello
+from lairchat.net.Heartbeat import PING, PONG
+
+ENGINES = {"threaded": ChatServer, "asyncio": AsyncChatServer}
+
+
+class HeapTimers:
+    """Timers in a heap, the usual alternative to the wheel."""
+
+    def __init__(self, now: float) -> None:
+        """Initialize with no timers."""
+        self.now = now
+        self.heap: List[Tuple[float, int, Any]] = []
+        self.counter = 0
+
+    def schedule(self, delay: float, item: Any) -> None:
+        """Set a timer for item."""
+        self.counter += 1
+        heapq.heappush(self.heap, (self.now + delay, self.counter, item))
+
+    def advance(self, now: float) -> List[Any]:
+        """The items of every timer due by now."""
+        self.now = now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        return due
+
+
+def run_timers(name: str, count: int, interval: float, ticks: int) -> Dict[str, Any]:
+    """Set a heartbeat per session and keep them going for ticks seconds."""
+
+    def set_timers() -> Union[TimerWheel, HeapTimers]:
+        """Every session's first heartbeat, spread over the interval."""
+        rng = random.Random(1)
+        timers = TimerWheel(0.0) if name == "wheel" else HeapTimers(0.0)
+        for session in range(count):
+            timers.schedule(rng.uniform(0, interval), session)
+        return timers
+
+    tracemalloc.start()
+    timers = set_timers()
+    memory = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+    del timers
+    start = time.perf_counter()
+    timers = set_timers()
+    set_ns = (time.perf_counter() - start) / count * 1e9
+
+    # Every tick takes out what is due and sets it again
+    durations = []
+    fired = 0
+    for tick in range(1, ticks + 1):
+        start = time.perf_counter()
+        due = timers.advance(float(tick))
+        for session in due:
+            timers.schedule(interval, session)
+        durations.append(time.perf_counter() - start)
+        fired += len(due)
+    durations.sort()
+    return {
+        "timers": name,
+        "set_ns": set_ns,
+        "tick_p50_ms": statistics.median(durations) * 1000,
+        "tick_max_ms": durations[-1] * 1000,
+        "per_timer_ns": sum(durations) / max(1, fired) * 1e9,
+        "memory_mb": memory,
+    }
+
+
+def log_in(port: int, name: str) -> Tuple[socket, WireCodec]:
+    """A framed client logged in under name."""
+    sock = create_connection(("127.0.0.1", port))
+    sock.sendall(encode_hello())
+    codec = WireCodec(FRAMED)
+    messages = []
+    while not messages:
+        messages = codec.feed(sock.recv(4096))
+    sock.sendall(codec.encode(name))
+    while not any(m.startswith(b"Hello ") for m in messages):
+        messages = codec.feed(sock.recv(4096))
+    return sock, codec
+
+
+def answer_pings(clients: Dict[socket, WireCodec], running: threading.Event) -> None:
+    """Read what the live clients are sent, answering every ping."""
+    sel = selectors.DefaultSelector()
+    for sock in clients:
+        sel.register(sock, selectors.EVENT_READ)
+    while running.is_set():
+        for key, _ in sel.select(0.1):
+            sock = key.fileobj
+            codec = clients[sock]
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                sel.unregister(sock)
+                continue
+            for message in codec.feed(data):
+                if message == PING.encode():
+                    sock.sendall(codec.encode(PONG))
+
+
+def run_server(args: argparse.Namespace) -> Dict[str, Any]:
+    """Log in live and dead clients and wait for the dead to be evicted."""
+    config = ServerConfig(
+        heartbeat_interval=args.interval,
+        idle_timeout=args.idle_timeout,
+        resume_grace=0,
+    )
+    server = ENGINES[args.engine]("127.0.0.1", 0, admin_console=False, config=config)
+    port = server.server.getsockname()[1]
+    threading.Thread(target=server.run, daemon=True).start()
+
+    live = dict(log_in(port, f"l{i}") for i in range(args.live))
+    running = threading.Event()
+    running.set()
+    threading.Thread(target=answer_pings, args=(live, running), daemon=True).start()
+    dead = [log_in(port, f"d{i}")[0] for i in range(args.dead)]
+    quiet = time.perf_counter()
+
+    # Wait for the dead clients to be gone, noting when each of them went
+    gone: Dict[str, float] = {}
+    deadline = quiet + args.idle_timeout + args.timeout
+    while len(gone) < args.dead and time.perf_counter() < deadline:
+        for i in range(args.dead):
+            if f"d{i}" not in gone and f"d{i}" not in server.connections:
+                gone[f"d{i}"] = time.perf_counter() - quiet
+        time.sleep(0.05)
+    kept = sum(f"l{i}" in server.connections for i in range(args.live))
+    running.clear()
+    for sock in list(live) + dead:
+        sock.close()
+
+    after = sorted(gone.values())
+    return {
+        "engine": args.engine,
+        "pings": server.metrics.pings.value,
+        "evicted": server.metrics.evicted.value,
+        "gone": len(gone),
+        "after_min_s": after[0] if after else 0.0,
+        "after_max_s": after[-1] if after else 0.0,
+        "kept": kept,
+    }
+
+
+def main() -> int:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair heartbeat benchmark")
+    parser.add_argument("--timers", type=int, default=100000)
+    parser.add_argument("--ticks", type=int, default=300)
+    parser.add_argument("--engine", choices=list(ENGINES), default="threaded")
+    parser.add_argument("--live", type=int, default=100)
+    parser.add_argument("--dead", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=2.0)
+    parser.add_argument("--idle-timeout", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print(
+        f'{"timers":<8}{"count":>8}{"set ns":>8}{"tick p50 ms":>13}{"max ms":>8}'
+        f'{"ns/timer":>10}{"MB":>7}'
+    )
+    for name in ("heap", "wheel"):
+        result = run_timers(name, args.timers, 30.0, args.ticks)
+        print(
+            f'{result["timers"]:<8}{args.timers:>8}{result["set_ns"]:>8.0f}'
+            f'{result["tick_p50_ms"]:>13.2f}{result["tick_max_ms"]:>8.2f}'
+            f'{result["per_timer_ns"]:>10.0f}{result["memory_mb"]:>7.1f}'
+        )
+
+    result = run_server(args)
+    print(
+        f'\n{result["engine"]}: {result["pings"]} pings, {result["evicted"]} of'
+        f' {args.dead} dead clients evicted {result["after_min_s"]:.1f}'
+        f' to {result["after_max_s"]:.1f} s after going quiet,'
+        f' {result["kept"]} of {args.live} live clients kept'
+    )
+    return 0 if result["gone"] == args.dead and result["kept"] == args.live else 1
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+
+"""history.py
+
+The Lair: memory and speed of the in-memory room history.
+
+Fills the history of --rooms rooms to their message limit with chat
+lines of each size, measures the memory held per stored message with
+tracemalloc, then times appending to full buffers and fetching the last
+--replay messages of a room.
+
+    python3 benchmarks/history.py --sizes 32 128 512 --rooms 100
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.History import History
+
+
+def bench(size: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Measure the history with messages of one size."""
+    rooms = [f"#r{i}" for i in range(args.rooms)]
+    lines = [f"[00:00:00]\nuser{i % 10}: {'x' * size}" for i in range(args.lines)]
+    stored = args.rooms * args.lines
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    history = History(args.lines, 1 << 40, args.rooms)
+    for room in rooms:
+        for line in lines:
+            history.append(room, line)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # Appending to full buffers drops the oldest record every time
+    start = time.perf_counter()
+    for i in range(args.appends):
+        history.append(rooms[i % len(rooms)], lines[i % len(lines)])
+    append_time = (time.perf_counter() - start) / args.appends
+
+    start = time.perf_counter()
+    for i in range(args.appends):
+        history.recent(rooms[i % len(rooms)], args.replay)
+    replay_time = (time.perf_counter() - start) / args.appends
+
+    return {
+        "size": len(lines[0]),
+        "stored": stored,
+        "bytes_per_message": used / stored,
+        "overhead": used / stored - len(lines[0]),
+        "append_us": append_time * 1e6,
+        "replay_us": replay_time * 1e6,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair history benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 128, 512])
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=1000)
+    parser.add_argument("--replay", type=int, default=20)
+    parser.add_argument("--appends", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f'{"text B":>7}{"stored":>9}{"B/message":>11}{"overhead B":>12}', end="")
+    print(f'{"append us":>11}{"replay us":>11}')
+    for size in args.sizes:
+        result = bench(size, args)
+        print(
+            f'{result["size"]:>7}{result["stored"]:>9}'
+            f'{result["bytes_per_message"]:>11.1f}{result["overhead"]:>12.1f}'
+            f'{result["append_us"]:>11.2f}{result["replay_us"]:>11.2f}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
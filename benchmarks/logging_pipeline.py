@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+
+"""logging_pipeline.py
+
+The Lair: cost of logging on the threads serving clients.
+
+Has --threads threads log --records records each, most of them the same
+send error over and over and the rest distinct messages, the way a lair
+logs while a network goes bad.  They log once through handlers writing
+the file and the terminal synchronously, as the server used to, then
+through the queue of the log pipeline with every record kept, and then
+with the pipeline sampling repeated records.  The terminal is /dev/null.
+The script reports records logged per second by the threads and the
+time until everything was written.
+
+    python3 benchmarks/logging_pipeline.py --threads 8 --records 20000
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.LogPipeline import LOG_FORMAT, LogPipeline
+
+
+def log_records(records: int, repeated: float) -> None:
+    """Log records, a share of them repeated from one place."""
+    for i in range(records):
+        if i % 100 < repeated * 100:
+            logging.warning("Send error: [Errno 32] Broken pipe")
+        else:
+            logging.info(f"('127.0.0.1', {i}) has connected")
+
+
+def synchronous(path: str) -> Callable[[], None]:
+    """Log straight to the file and the terminal, return how to stop."""
+    root = logging.getLogger()
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(path), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+    def stop() -> None:
+        """Close the handlers."""
+        for handler in handlers:
+            root.removeHandler(handler)
+            handler.close()
+
+    return stop
+
+
+def pipeline(path: str, burst: int) -> Callable[[], None]:
+    """Log through the pipeline, return how to stop."""
+    log = LogPipeline("debug", path, burst=burst)
+
+    def stop() -> None:
+        """Drain the queue and close the handlers."""
+        log.stop()
+        for handler in log.handlers:
+            handler.close()
+        logging.getLogger().removeHandler(log.handler)
+
+    return stop
+
+
+def bench(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time the threads logging and everything being written."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "lair.log")
+        if name == "sync":
+            stop = synchronous(path)
+        elif name == "queue":
+            stop = pipeline(path, 0)
+        else:
+            stop = pipeline(path, args.burst)
+
+        threads = [
+            threading.Thread(target=log_records, args=(args.records, args.repeated))
+            for _ in range(args.threads)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logged = time.perf_counter() - start
+        stop()
+        written = time.perf_counter() - start
+
+        with open(path, "rb") as f:
+            lines = sum(1 for _ in f)
+
+    return {
+        "name": name,
+        "records_per_sec": args.threads * args.records / logged,
+        "written_s": written,
+        "lines": lines,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair logging benchmark")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--repeated", type=float, default=0.9)
+    parser.add_argument("--burst", type=int, default=20)
+    args = parser.parse_args()
+
+    # The terminal the handlers write to
+    sys.stderr = open(os.devnull, "w")
+
+    print(f'{"logging":<10}{"records/sec":>13}{"written s":>11}{"lines":>9}')
+    for name in ("sync", "queue", "sampled"):
+        result = bench(name, args)
+        print(
+            f'{result["name"]:<10}{result["records_per_sec"]:>13.0f}'
+            f'{result["written_s"]:>11.2f}{result["lines"]:>9}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
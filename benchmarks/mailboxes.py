@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+
+"""mailboxes.py
+
+The Lair: memory and disk used by the mailboxes of a large lair.
+
+Registers --accounts names, then has --away of them receive whispers
+while they are away: most get a handful, --heavy of them get hundreds
+and spill to disk.  Reports the memory held by the mailboxes with
+tracemalloc, the bytes on disk, how fast messages were kept and how long
+emptying a mailbox for a login took.
+
+    python3 benchmarks/mailboxes.py --accounts 50000 --away 0.3
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.store.Mailboxes import Mailboxes
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair mailbox benchmark")
+    parser.add_argument("--accounts", type=int, default=50000)
+    parser.add_argument("--away", type=float, default=0.3)
+    parser.add_argument("--mean", type=float, default=5.0)
+    parser.add_argument("--heavy", type=float, default=0.01)
+    parser.add_argument("--heavy-messages", type=int, default=500)
+    parser.add_argument("--size", type=int, default=80)
+    parser.add_argument("--memory", type=int, default=4096)
+    parser.add_argument("--cap", type=int, default=1024 * 1024)
+    parser.add_argument("--dir", default=None, help="directory to spill to")
+    args = parser.parse_args()
+
+    random.seed(0)
+    directory = tempfile.mkdtemp(dir=args.dir)
+    names = [f"dweller{i}" for i in range(args.accounts)]
+    away = random.sample(names, int(args.accounts * args.away))
+    plan = [
+        (
+            name,
+            (
+                args.heavy_messages
+                if random.random() < args.heavy
+                else 1 + int(random.expovariate(1 / args.mean))
+            ),
+        )
+        for name in away
+    ]
+    text = f"[00:00:00]\nsomebody whispers: {'x' * args.size}"
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    mailboxes = Mailboxes(directory, args.memory, args.cap)
+    for name in names:
+        mailboxes.know(name)
+    known = tracemalloc.get_traced_memory()[0] - before
+
+    # Round robin, the way whispers to many dwellers would arrive
+    kept = 0
+    start = time.perf_counter()
+    remaining = dict(plan)
+    while remaining:
+        for name in list(remaining):
+            kept += mailboxes.put(name, text)
+            remaining[name] -= 1
+            if remaining[name] == 0:
+                del remaining[name]
+    elapsed = time.perf_counter() - start
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    disk = sum(
+        os.path.getsize(os.path.join(directory, filename))
+        for filename in os.listdir(directory)
+    )
+    messages = sum(count for _, count in plan)
+    print(f'{" Lair mailboxes ":*^60}')
+    print(f"accounts:  {args.accounts}, {len(plan)} away, {messages} messages")
+    print(f"kept:      {kept} in {elapsed:.2f} s ({kept / elapsed:.0f}/sec)")
+    print(f"mail:      {mailboxes.summary()}")
+    print(f"memory:    {known / 1e6:.1f} MB for the names,", end="")
+    print(f" {(used - known) / 1e6:.1f} MB for the mailboxes")
+    print(f"disk:      {disk / 1e6:.1f} MB")
+    print(f"text:      {len(text) + 1} B per message, {kept * len(text) / 1e6:.1f} MB")
+
+    # Everybody comes back
+    latencies = []
+    for name, count in plan:
+        start = time.perf_counter()
+        mailboxes.take(name)
+        latencies.append((time.perf_counter() - start, count))
+    for label, selected in (
+        ("light", [t for t, count in latencies if count < args.heavy_messages]),
+        ("heavy", [t for t, count in latencies if count >= args.heavy_messages]),
+    ):
+        if selected:
+            selected.sort()
+            print(
+                f"take {label}: p50 {percentile(selected, 0.5) * 1e6:.0f} us,"
+                f" p99 {percentile(selected, 0.99) * 1e6:.0f} us"
+            )
+    shutil.rmtree(directory)
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
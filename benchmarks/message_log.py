@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+
+"""message_log.py
+
+The Lair: write throughput and read latency of the durable room history.
+
+Has --threads threads append --messages chat lines spread over --rooms
+rooms at --rate messages per second, or as fast as they can with a rate
+of 0, for each commit interval, counting the records written per second
+and per sync of a segment.  Then times random {history N} and
+{history since <ts>} lookups against the log that was written.
+
+    python3 benchmarks/message_log.py --intervals 0 0.005 0.02 --rate 20000
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.store.MessageLog import MessageLog
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def write(directory: str, interval: float, args: argparse.Namespace) -> Dict:
+    """Fill a log from several threads, return the write figures."""
+    log = MessageLog(
+        directory, segment_bytes=args.segment_bytes, commit_interval=interval
+    )
+    rooms = [f"#r{i}" for i in range(args.rooms)]
+    line = f"[00:00:00]\nuser: {'x' * args.size}"
+    per_thread = args.messages // args.threads
+    rate = args.rate / args.threads
+
+    def append() -> None:
+        """Append this thread's share of the messages."""
+        start = time.perf_counter()
+        for i in range(per_thread):
+            # Keep to the schedule rather than sleeping a fixed time
+            if rate and (delay := start + i / rate - time.perf_counter()) > 0:
+                time.sleep(delay)
+            log.append(rooms[i % len(rooms)], line)
+
+    threads = [threading.Thread(target=append) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "interval": interval,
+        "records": log.records,
+        "per_sec": log.records / elapsed,
+        "commits": log.commits,
+        "syncs": log.syncs,
+        "per_sync": log.records / max(1, log.syncs),
+    }
+
+
+def read(directory: str, args: argparse.Namespace) -> Dict[str, List[float]]:
+    """Time random lookups in a log, return sorted latencies by kind."""
+    log = MessageLog(directory, segment_bytes=args.segment_bytes)
+    rooms = [f"#r{i}" for i in range(args.rooms)]
+    times = [t for t, _ in log.last(rooms[0], args.messages)]
+    latencies: Dict[str, List[float]] = {"last": [], "since": []}
+    for _ in range(args.reads):
+        room = random.choice(rooms)
+        start = time.perf_counter()
+        log.last(room, args.count)
+        latencies["last"].append(time.perf_counter() - start)
+
+        since = random.choice(times)
+        start = time.perf_counter()
+        log.since(room, since, args.count)
+        latencies["since"].append(time.perf_counter() - start)
+    log.close()
+    return {kind: sorted(values) for kind, values in latencies.items()}
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair message log benchmark")
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0, 0.005])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--rate", type=float, default=20000.0)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--segment-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--reads", type=int, default=10000)
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--dir", default=None, help="directory to write in")
+    args = parser.parse_args()
+
+    print(f'{"interval s":>11}{"records":>9}{"records/s":>11}', end="")
+    print(f'{"commits":>9}{"syncs":>8}{"records/sync":>14}')
+    directory = ""
+    for interval in args.intervals:
+        if directory:
+            shutil.rmtree(directory)
+        directory = tempfile.mkdtemp(dir=args.dir)
+        result = write(directory, interval, args)
+        print(
+            f'{result["interval"]:>11}{result["records"]:>9}'
+            f'{result["per_sec"]:>11.0f}{result["commits"]:>9}'
+            f'{result["syncs"]:>8}{result["per_sync"]:>14.1f}'
+        )
+
+    # Read back the last log written
+    print()
+    print(f'{"lookup":>8}{"p50 us":>9}{"p99 us":>9}{"max us":>9}')
+    for kind, values in read(directory, args).items():
+        print(
+            f"{kind:>8}{percentile(values, 0.5) * 1e6:>9.1f}"
+            f"{percentile(values, 0.99) * 1e6:>9.1f}"
+            f"{percentile(values, 1.0) * 1e6:>9.1f}"
+        )
+    shutil.rmtree(directory)
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
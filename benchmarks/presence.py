@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+
+"""presence.py
+
+The Lair: how long {who} takes with more and more dwellers.
+
+Logs --users clients into a server without sockets, their frames are
+queued but never written, then times {who} from one of them, both right
+after somebody logged in, when the sorted roster has to be built again,
+and with the roster unchanged.  Then --changes clients come and go,
+every other one leaving again within the window, with everybody
+subscribed to presence updates, and the script counts the updates and
+bytes a subscriber was sent for them.
+
+    python3 benchmarks/presence.py --users 10 1000 100000
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.ChatServer import LOBBY, ChatServer
+from lairchat.cli.Presence import GONE, HERE
+from lairchat.cli.Registry import Session
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import FRAMED, WireCodec
+from lairchat.net.OutboundQueue import OutboundQueue
+
+
+def populate(server: ChatServer, users: int) -> None:
+    """Add users straight to the server, all of them in the lobby."""
+    codec = WireCodec(FRAMED)
+    for i in range(users):
+        username = f"u{i}"
+        queue = OutboundQueue(1 << 40, 1 << 39)
+        server.connections.add(Session(username, i, ("127.0.0.1", i), codec, queue))
+        server.join_room(username, LOBBY)
+
+
+def time_who(server: ChatServer, repeat: int, churn: bool) -> List[float]:
+    """Seconds {who} took each time, with somebody logging in before if churn."""
+    codec = WireCodec(FRAMED)
+    timings = []
+    for i in range(repeat):
+        if churn:
+            queue = OutboundQueue(1 << 40, 1 << 39)
+            session = Session(f"c{i}", -i, ("127.0.0.1", 0), codec, queue)
+            server.connections.add(session)
+        start = time.perf_counter()
+        server.handle_message("u0", "{who}")
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def count_updates(server: ChatServer, changes: int) -> Tuple[int, int]:
+    """Updates and bytes sent to a subscriber while clients come and go."""
+    for session in server.connections.sessions():
+        server.presence.subscribe(session.username)
+    frames = server.connections.get("u0").queue.frames
+    before = len(frames)
+    for i in range(changes):
+        server.announce(f"p{i}", "127.0.0.1", GONE, HERE)
+        if i % 2:
+            server.announce(f"p{i}", "127.0.0.1", HERE, GONE)
+    server.flush_presence()
+    sent = list(frames)[before:]
+    return len(sent), sum(len(frame) for frame in sent)
+
+
+def bench(users: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time {who} and count presence updates for a number of users."""
+    server = ChatServer(
+        "127.0.0.1", 0, admin_console=False, config=ServerConfig(presence_window=60)
+    )
+    populate(server, users)
+    cold = time_who(server, args.repeat, True)
+    warm = time_who(server, args.repeat, False)
+    updates, update_bytes = count_updates(server, args.changes)
+    server.server.close()
+    return {
+        "users": users,
+        "cold_ms": statistics.median(cold) * 1000,
+        "warm_ms": statistics.median(warm) * 1000,
+        "updates": updates,
+        "update_bytes": update_bytes,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair presence benchmark")
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--changes", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f'{"users":>8}{"cold ms":>10}{"warm ms":>10}{"updates":>9}{"bytes":>8}')
+    for users in args.users:
+        result = bench(users, args)
+        print(
+            f'{result["users"]:>8}{result["cold_ms"]:>10.3f}{result["warm_ms"]:>10.3f}'
+            f'{result["updates"]:>9}{result["update_bytes"]:>8}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
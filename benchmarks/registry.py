@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+
+"""registry.py
+
+The Lair: broadcasts while clients log in and out as fast as they can.
+
+Logs --users clients into a server without sockets, then has --storm
+threads broadcast to everybody for --seconds while another thread logs
+churning clients in and out at --churn logins and as many logouts per
+second.  Churning clients go straight into the registry and the lobby,
+without the announcements that would be broadcasts of their own.
+Frames are counted instead of queued.  Every client that stays
+logged in must get every broadcast, so the script reports the rates
+reached, the errors raised and the broadcasts lost, and exits with an
+error if there were any.
+
+    python3 benchmarks/registry.py --users 1000 --churn 1000 --seconds 10
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.ChatServer import LOBBY, ChatServer
+from lairchat.cli.Registry import Session
+from lairchat.net.Framing import FRAMED, WireCodec
+
+STORM = "storm"
+
+
+class PlainCodec(WireCodec):
+    """A framed codec that leaves messages in plain text."""
+
+    def encode(self, message: str) -> Union[bytes, None]:
+        """Encode a message without encrypting it."""
+        return message.encode("utf-8")
+
+
+class CountingQueue:
+    """Stands in for an outbound queue, counting the storm frames put in it."""
+
+    def __init__(self) -> None:
+        """Initialize the count."""
+        self.storm_frames = 0
+        self.queued_bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, frame: bytes) -> bool:
+        """Count a frame."""
+        if frame.startswith(b"storm"):
+            with self.lock:
+                self.storm_frames += 1
+        return True
+
+    def close(self, discard: bool = False) -> None:
+        """Nothing to close."""
+
+
+class StressServer(ChatServer):
+    """A server whose clients have counting queues and no writer threads."""
+
+    def create_queue(self, sock: Any, codec: WireCodec) -> CountingQueue:
+        """Count frames instead of writing them."""
+        return CountingQueue()
+
+
+def churn(server: ChatServer, rate: int, done: threading.Event) -> int:
+    """Log clients in and out at rate per second until done."""
+    codec = PlainCodec(FRAMED)
+    online: Deque[str] = deque()
+    logins = 0
+    start = time.perf_counter()
+    while not done.is_set():
+        # Keep pace with the clock rather than sleeping a fixed time
+        if logins >= rate * (time.perf_counter() - start):
+            time.sleep(0.0005)
+            continue
+        username = f"c{logins}"
+        address = ("127.0.0.1", logins)
+        server.connections.add(
+            Session(username, object(), address, codec, CountingQueue())
+        )
+        server.join_room(username, LOBBY)
+        online.append(username)
+        logins += 1
+        if len(online) > 100:
+            username = online.popleft()
+            server.forget_member(username, LOBBY)
+            server.connections.remove(username)
+    return logins
+
+
+def storm(server: ChatServer, done: threading.Event, sent: List[int]) -> None:
+    """Broadcast to everybody until done."""
+    while not done.is_set():
+        server.broadcast_to_all(STORM, relay=False)
+        sent.append(1)
+
+
+def bench(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the broadcast storm with clients churning underneath it."""
+    server = StressServer("127.0.0.1", 0, admin_console=False)
+    codec = PlainCodec(FRAMED)
+    stable = [f"u{i}" for i in range(args.users)]
+    for i, username in enumerate(stable):
+        server.login(username, object(), ("127.0.0.1", i), codec)
+
+    done = threading.Event()
+    errors = []
+    sent: List[int] = []
+    logins = []
+
+    def guard(work: Callable[[], Any]) -> Callable[[], None]:
+        """Record what a thread raises instead of losing it."""
+
+        def run() -> None:
+            try:
+                result = work()
+                if result is not None:
+                    logins.append(result)
+            except Exception as e:
+                errors.append(e)
+                done.set()
+
+        return run
+
+    threads = [threading.Thread(target=guard(lambda: churn(server, args.churn, done)))]
+    threads += [
+        threading.Thread(target=guard(lambda: storm(server, done, sent)))
+        for _ in range(args.storm)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    done.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    broadcasts = len(sent)
+    lost = sum(
+        broadcasts - server.connections.get(username).queue.storm_frames
+        for username in stable
+    )
+    server.server.close()
+    return {
+        "logins_per_sec": sum(logins) / elapsed,
+        "broadcasts_per_sec": broadcasts / elapsed,
+        "errors": len(errors),
+        "lost": lost,
+        "first_error": repr(errors[0]) if errors else "",
+    }
+
+
+def main() -> int:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair connection registry stress")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--churn", type=int, default=1000)
+    parser.add_argument("--storm", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    # Thousands of logins a second would mostly measure the log handlers
+    logging.disable(logging.WARNING)
+
+    result = bench(args)
+    print(f'{"logins/sec":>11}{"broadcasts/sec":>16}{"errors":>8}{"lost":>8}')
+    print(
+        f'{result["logins_per_sec"]:>11.0f}{result["broadcasts_per_sec"]:>16.0f}'
+        f'{result["errors"]:>8}{result["lost"]:>8}'
+    )
+    if result["errors"] or result["lost"]:
+        print(f'failed: {result["first_error"] or "broadcasts were lost"}')
+        return 1
+    return 0
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+
+"""resume.py
+
+The Lair: clients that lose their connection in the middle of a burst.
+
+Starts a server and a proxy in front of it that cuts every connection
+through it each --drop-interval seconds.  --listeners clients log in
+through the proxy with sessions, then a talker connected straight to
+the server says --messages numbered lines at --rate a second.  The
+listeners reconnect and resume every time they are cut off, and each
+of them must read every line exactly once and in order.  The script
+reports the cuts and reconnects, the lines missed, repeated and out of
+order, how many lines were sent again on resuming compared to the
+whole burst, and exits with an error if any were missed or repeated.
+
+    python3 benchmarks/resume.py --listeners 5 --messages 5000 --rate 1000
+"""
+
+import argparse
+import contextlib
+import io
+import logging
+import os
+import re
+import selectors
+import sys
+import threading
+import time
+from socket import *
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatClient import ChatClient
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import DEFAULT_SUITE, FRAMED, WireCodec, encode_hello
+from lairchat.net.Resume import GREETING
+
+LINE = re.compile(r"talker: m(\d+)$")
+RESENT = re.compile(r"Welcome back!  (\d+) missed messages\.")
+
+
+class FaultProxy:
+    """Relays connections to the server, cutting them all when told to."""
+
+    def __init__(self, server_port: int) -> None:
+        """Listen on a port of its own."""
+        self.server_port = server_port
+        self.listener = socket(AF_INET, SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.listener, selectors.EVENT_READ)
+        self.peers: Dict[socket, socket] = {}
+        self.cut_requested = False
+        self.cuts = 0
+        self.running = True
+
+    def run(self) -> None:
+        """Relay until stopped, cutting connections in between reads."""
+        while self.running:
+            if self.cut_requested:
+                self.cut_requested = False
+                self.cut()
+            for key, _ in self.sel.select(0.01):
+                if key.fileobj is self.listener:
+                    self.accept()
+                else:
+                    self.relay(key.fileobj)
+
+    def accept(self) -> None:
+        """Connect a new client to the server."""
+        client, _ = self.listener.accept()
+        upstream = create_connection(("127.0.0.1", self.server_port))
+        self.peers[client] = upstream
+        self.peers[upstream] = client
+        self.sel.register(client, selectors.EVENT_READ)
+        self.sel.register(upstream, selectors.EVENT_READ)
+
+    def relay(self, sock: socket) -> None:
+        """Pass on what one side sent to the other."""
+        if (peer := self.peers.get(sock)) is None:
+            return
+        try:
+            data = sock.recv(65536)
+            if data:
+                peer.sendall(data)
+                return
+        except OSError:
+            pass
+        self.close(sock)
+
+    def close(self, sock: socket) -> None:
+        """Close a connection on both sides."""
+        peer = self.peers.pop(sock)
+        del self.peers[peer]
+        for side in (sock, peer):
+            self.sel.unregister(side)
+            side.close()
+
+    def cut(self) -> None:
+        """Close every connection, whatever is on its way is lost."""
+        for sock in list(self.peers):
+            if sock in self.peers:
+                self.close(sock)
+        self.cuts += 1
+
+
+class Listener(ChatClient):
+    """A client logging in by itself and keeping the lines it reads."""
+
+    def __init__(self, name: str, port: int) -> None:
+        """Connect through the proxy without a console."""
+        self.name = name
+        self.lines: List[int] = []
+        self.resent = 0
+        self.logged_in = threading.Event()
+        super().__init__("127.0.0.1", port, FRAMED, DEFAULT_SUITE, console=False)
+
+    def show(self, message: str) -> None:
+        """Keep the numbered lines, answer the greeting with the name."""
+        if message == GREETING:
+            self.send(self.name)
+        elif message.startswith(f"Hello {self.name}!"):
+            self.logged_in.set()
+        elif (line := LINE.search(message)) is not None:
+            self.lines.append(int(line.group(1)))
+        elif (resent := RESENT.match(message)) is not None:
+            self.resent += int(resent.group(1))
+
+
+def talk(port: int, messages: int, rate: int) -> None:
+    """Log in straight to the server and say numbered lines."""
+    sock = create_connection(("127.0.0.1", port))
+    sock.sendall(encode_hello(DEFAULT_SUITE))
+    codec = WireCodec(FRAMED, DEFAULT_SUITE)
+    time.sleep(0.2)
+    sock.sendall(codec.encode("talker"))
+    time.sleep(0.2)
+    start = time.perf_counter()
+    for i in range(messages):
+        if (ahead := i / rate - (time.perf_counter() - start)) > 0:
+            time.sleep(ahead)
+        sock.sendall(codec.encode(f"m{i}"))
+
+    # Keep the connection until the listeners are done
+    threading.Event().wait()
+
+
+def check(lines: List[int], messages: int) -> Tuple[int, int, int]:
+    """Lines missed, repeated and out of order."""
+    missed = messages - len(set(lines))
+    repeated = len(lines) - len(set(lines))
+    disordered = sum(1 for a, b in zip(lines, lines[1:]) if b <= a)
+    return missed, repeated, disordered
+
+
+def burst(args: argparse.Namespace) -> Tuple[List[Listener], FaultProxy, float]:
+    """Run the burst with connections cut, the listeners and the seconds it took."""
+    engine = AsyncChatServer if args.engine == "asyncio" else ChatServer
+    config = ServerConfig(resume_messages=args.keep, compress=args.compress)
+    server = engine("127.0.0.1", 0, admin_console=False, config=config)
+    server_port = server.server.getsockname()[1]
+    threading.Thread(target=server.run, daemon=True).start()
+    proxy = FaultProxy(server_port)
+    threading.Thread(target=proxy.run, daemon=True).start()
+
+    listeners = [Listener(f"l{i}", proxy.port) for i in range(args.listeners)]
+    for listener in listeners:
+        threading.Thread(target=listener.run, daemon=True).start()
+    for listener in listeners:
+        listener.logged_in.wait(10)
+
+    # Cut every connection now and then while the burst goes on
+    start = time.perf_counter()
+    talker = threading.Thread(
+        target=talk, args=(server_port, args.messages, args.rate), daemon=True
+    )
+    talker.start()
+    last = args.messages - 1
+    while time.perf_counter() - start < args.timeout:
+        time.sleep(args.drop_interval)
+        if all(listener.lines[-1:] == [last] for listener in listeners):
+            break
+        proxy.cut_requested = True
+    return listeners, proxy, time.perf_counter() - start
+
+
+def main() -> int:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair resume benchmark")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--listeners", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rate", type=int, default=1000)
+    parser.add_argument("--drop-interval", type=float, default=1.0)
+    parser.add_argument("--keep", type=int, default=ServerConfig.resume_messages)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--compress", default=False, action="store_true")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    # The clients say when they reconnect, keep it off the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        listeners, proxy, elapsed = burst(args)
+
+    print(
+        f'{"listener":<10}{"read":>7}{"missed":>8}{"repeated":>10}{"disorder":>10}'
+        f'{"reconnects":>12}{"resent":>8}'
+    )
+    failed = False
+    for listener in listeners:
+        missed, repeated, disordered = check(listener.lines, args.messages)
+        failed = failed or missed > 0 or repeated > 0 or disordered > 0
+        print(
+            f"{listener.name:<10}{len(listener.lines):>7}{missed:>8}{repeated:>10}"
+            f"{disordered:>10}{listener.reconnects:>12}{listener.resent:>8}"
+        )
+    resent = sum(listener.resent for listener in listeners)
+    print(
+        f"{proxy.cuts} cuts in {elapsed:.1f} s, {resent} lines sent again of "
+        f"{args.messages * args.listeners} read"
+    )
+    proxy.running = False
+    return 1 if failed else 0
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
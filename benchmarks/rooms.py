@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+
+"""rooms.py
+
+The Lair: cost of a chat line with everybody in the lobby or split in rooms.
+
+Logs --users clients into a server without sockets, their frames are
+queued but never written, then has senders talk once with everybody in
+the lobby and once with the users split evenly across --rooms rooms.
+The script reports chat lines handled per second, frames queued and
+messages encrypted per line, which measures the fan-out the server does
+and nothing else.
+
+    python3 benchmarks/rooms.py --users 10000 --rooms 100
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.ChatServer import LOBBY, ChatServer
+from lairchat.cli.Registry import Session
+from lairchat.net.Framing import FRAMED, WireCodec
+from lairchat.net.OutboundQueue import OutboundQueue
+
+
+class CountingCodec(WireCodec):
+    """A framed codec that counts the messages it encrypts."""
+
+    encoded = 0
+
+    def encode(self, message: str) -> Union[bytes, None]:
+        """Encrypt a message and encode it for the wire."""
+        CountingCodec.encoded += 1
+        return super().encode(message)
+
+
+def populate(server: ChatServer, users: int, rooms: int) -> List[str]:
+    """Add users straight to the server, spread across rooms if any."""
+    usernames = [f"u{i}" for i in range(users)]
+    codec = CountingCodec(FRAMED)
+    for i, username in enumerate(usernames):
+        queue = OutboundQueue(1 << 40, 1 << 39)
+        server.connections.add(
+            Session(username, i, ("127.0.0.1", i), codec, queue)
+        )
+        server.join_room(username, f"#r{i % rooms}" if rooms else LOBBY)
+    return usernames
+
+
+def bench(users: int, rooms: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time chat lines from senders in every room."""
+    server = ChatServer("127.0.0.1", 0, admin_console=False)
+    usernames = populate(server, users, rooms)
+    senders = usernames[: args.senders]
+
+    CountingCodec.encoded = 0
+    start = time.perf_counter()
+    for _ in range(args.lines):
+        for username in senders:
+            server.handle_message(username, "x" * args.size)
+    elapsed = time.perf_counter() - start
+
+    lines = args.lines * len(senders)
+    frames = sum(len(session.queue.frames) for session in server.connections.sessions())
+    server.server.close()
+    return {
+        "layout": f"{rooms} rooms" if rooms else "lobby",
+        "lines_per_sec": lines / elapsed,
+        "frames_per_line": frames / lines,
+        "encrypts_per_line": CountingCodec.encoded / lines,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair rooms benchmark")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=5)
+    parser.add_argument("--size", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f'{"layout":<12}{"lines/sec":>11}{"frames/line":>13}{"encrypts/line":>15}')
+    for rooms in (0, args.rooms):
+        result = bench(args.users, rooms, args)
+        print(
+            f'{result["layout"]:<12}{result["lines_per_sec"]:>11.0f}'
+            f'{result["frames_per_line"]:>13.0f}{result["encrypts_per_line"]:>15.1f}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
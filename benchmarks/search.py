@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+
+"""search.py
+
+The Lair: indexing speed, size and query latency of the search index.
+
+Indexes --messages chat lines of --words words drawn from a Zipf
+distributed vocabulary, while another thread keeps querying the index,
+and reports the indexing rate, how long adding a message took while
+flushes, merges and queries went on, and the bytes per message on disk.
+Then reopens the index and times queries for common, middling and rare
+words, two words together and a later page of a common word.
+
+    python3 benchmarks/search.py --messages 10000000
+"""
+
+import argparse
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.store.SearchIndex import SearchIndex
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def corpus(args: argparse.Namespace) -> Iterator[Tuple[str, str]]:
+    """Rooms and chat lines of Zipf distributed words."""
+    vocabulary = [f"w{rank}" for rank in range(args.vocabulary)]
+    ranks = range(1, args.vocabulary + 1)
+    weights = list(itertools.accumulate(1 / rank for rank in ranks))
+    rooms = [f"#r{i}" for i in range(args.rooms)]
+    for i in range(args.messages):
+        words = random.choices(vocabulary, cum_weights=weights, k=args.words)
+        yield rooms[i % len(rooms)], f"user{i % 1000}: {' '.join(words)}"
+
+
+def index(directory: str, args: argparse.Namespace) -> None:
+    """Fill an index, querying it all along."""
+    search = SearchIndex(directory, flush_messages=args.flush)
+    done = threading.Event()
+    queries = 0
+
+    def query() -> None:
+        """Keep searching for a common word."""
+        nonlocal queries
+        while not done.is_set():
+            search.search(["w1"], None, 0, 10)
+            queries += 1
+            time.sleep(0.001)
+
+    querier = threading.Thread(target=query)
+    querier.start()
+
+    # Time every hundredth message, timing them all would cost as much
+    latencies = []
+    start = time.perf_counter()
+    for i, (room, text) in enumerate(corpus(args)):
+        if i % 100:
+            search.add(room, text)
+        else:
+            added = time.perf_counter()
+            search.add(room, text)
+            latencies.append(time.perf_counter() - added)
+    elapsed = time.perf_counter() - start
+    done.set()
+    querier.join()
+
+    closing = time.perf_counter()
+    search.close()
+    closed = time.perf_counter() - closing
+
+    sizes: Dict[str, int] = {}
+    for filename in os.listdir(directory):
+        extension = os.path.splitext(filename)[1]
+        sizes[extension] = sizes.get(extension, 0) + os.path.getsize(
+            os.path.join(directory, filename)
+        )
+
+    latencies.sort()
+    print(f"indexed:   {args.messages} messages in {elapsed:.1f} s", end="")
+    print(f" ({args.messages / elapsed:.0f}/sec), {queries} queries meanwhile")
+    print(
+        f"closed in: {closed:.1f} s, {search.flushes} flushes, {search.merges} merges"
+    )
+    print(
+        f"add:       p50 {percentile(latencies, 0.5) * 1e6:.1f} us,"
+        f" p99 {percentile(latencies, 0.99) * 1e6:.1f} us,"
+        f" max {percentile(latencies, 1.0) * 1e3:.1f} ms"
+    )
+    print("disk:      ", end="")
+    print(
+        ", ".join(
+            f"{extension} {size / args.messages:.1f} B/message"
+            for extension, size in sorted(sizes.items())
+            if extension != ".json"
+        )
+    )
+
+
+def query(directory: str, args: argparse.Namespace) -> None:
+    """Time queries against a filled index."""
+    search = SearchIndex(directory, flush_messages=args.flush)
+    print(f"segments:  {len(search.segments)}")
+    rare = f"w{args.vocabulary - 1}"
+    queries = {
+        "common": (["w0"], 0),
+        "middling": (["w100"], 0),
+        "rare": ([rare], 0),
+        "two common": (["w0", "w1"], 0),
+        "common+rare": (["w0", rare], 0),
+        "page 10": (["w0"], 90),
+    }
+
+    print()
+    print(f'{"query":>12}{"p50 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+    for name, (words, offset) in queries.items():
+        latencies = []
+        for _ in range(args.queries):
+            start = time.perf_counter()
+            search.search(words, None, offset, 10)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(
+            f"{name:>12}{percentile(latencies, 0.5) * 1e3:>9.2f}"
+            f"{percentile(latencies, 0.99) * 1e3:>9.2f}"
+            f"{percentile(latencies, 1.0) * 1e3:>9.2f}"
+        )
+    search.close()
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair search index benchmark")
+    parser.add_argument("--messages", type=int, default=10000000)
+    parser.add_argument("--words", type=int, default=8)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--flush", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dir", default=None, help="directory to write in")
+    args = parser.parse_args()
+
+    random.seed(0)
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        index(directory, args)
+        query(directory, args)
+    finally:
+        shutil.rmtree(directory)
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+
+"""slow_consumers.py
+
+The Lair: broadcast latency to healthy clients while others stop reading.
+
+A sender broadcasts timestamped messages to --healthy clients that read
+everything and to --stalled clients that never read.  The script reports
+median, 99th percentile and worst delivery latency to the healthy
+clients, the stalled clients still connected and the frames dropped for
+them.
+
+The server runs in a process of its own so the clients don't share its
+interpreter lock.  The kernel buffers megabytes for a client that stops
+reading, until then it looks no different from a healthy one, so the
+sender first fills every queue with --fill MiB that the healthy clients
+read and throw away.  Only then are the stalled clients congested, and
+latency is measured.
+
+    python3 benchmarks/slow_consumers.py --stalled 0 4 16 --policy drop
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import selectors
+import statistics
+import sys
+import threading
+import time
+from socket import *
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import FRAMED, WireCodec, encode_hello, encode_message
+from lairchat.net.OutboundQueue import DISCONNECT, DROP
+
+ENGINES = {"threaded": ChatServer, "asyncio": AsyncChatServer}
+
+# Lines the queues are filled with at a time
+FILL_CHUNK = 64
+
+
+def serve(engine: str, config: ServerConfig, pipe: Any) -> None:
+    """Run a server, telling the parent its port and what it did to the stalled."""
+    logging.disable(logging.WARNING)
+    server = ENGINES[engine]("127.0.0.1", 0, admin_console=False, config=config)
+    threading.Thread(target=server.run, daemon=True).start()
+    pipe.send(server.server.getsockname()[1])
+
+    pipe.recv()
+    sessions = [s for s in server.connections.sessions() if s.username[0] == "z"]
+    pipe.send((len(sessions), sum(s.queue.dropped_frames for s in sessions)))
+
+
+def login(address: Tuple[str, int], username: str) -> socket:
+    """Connect a framed client and pick a username."""
+    sock = create_connection(address)
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    sock.sendall(encode_hello() + encode_message(username, FRAMED))
+    return sock
+
+
+def bench(engine: str, stalled: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Measure delivery latency with a number of stalled clients."""
+    config = ServerConfig(slow_policy=args.policy)
+    context = multiprocessing.get_context("fork")
+    parent, child = context.Pipe()
+    server = context.Process(target=serve, args=(engine, config, child), daemon=True)
+    server.start()
+    address = ("127.0.0.1", parent.recv())
+
+    stalled_clients = [login(address, f"z{i}") for i in range(stalled)]
+    healthy = [login(address, f"h{i}") for i in range(args.healthy)]
+    sender = login(address, "sender")
+    time.sleep(1)
+
+    sel = selectors.DefaultSelector()
+    for sock in healthy:
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ, WireCodec(FRAMED))
+
+    def read(timeout: float) -> Iterator[str]:
+        """The lines of the sender the healthy clients read."""
+        for key, mask in sel.select(timeout):
+            for message in key.data.feed(key.fileobj.recv(1 << 20)):
+                text = message.decode("utf-8", "ignore")
+                if "sender: " in text:
+                    yield text.split("sender: ", 1)[1]
+
+    # Fill the kernel buffers and queues of the stalled clients, a chunk at
+    # a time the healthy ones have read before the next
+    filler = encode_message("f" * args.size, FRAMED) * FILL_CHUNK
+    filled = 0
+    for chunk in range(args.fill * 1024 * 1024 // args.size // FILL_CHUNK):
+        sender.sendall(filler)
+        while filled < (chunk + 1) * FILL_CHUNK * len(healthy):
+            filled += sum(1 for _ in read(1))
+
+    # The sender paces itself by the clock, not by how long sending takes
+    running = threading.Event()
+    running.set()
+
+    def send() -> None:
+        """Send timestamped messages padded to the requested size."""
+        start = time.perf_counter()
+        for i in range(args.messages):
+            if not running.is_set():
+                return
+            if (delay := start + i / args.rate - time.perf_counter()) > 0:
+                time.sleep(delay)
+            stamp = f"{time.perf_counter():.6f}"
+            sender.sendall(encode_message(stamp.ljust(args.size, "."), FRAMED))
+
+    sending = threading.Thread(target=send, daemon=True)
+    sending.start()
+
+    latencies = []
+    expected = args.messages * len(healthy)
+    deadline = time.perf_counter() + args.messages / args.rate + 10
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        for line in read(1):
+            latencies.append(time.perf_counter() - float(line.rstrip(".")))
+
+    # Only close the sockets once nothing sends on them any more
+    running.clear()
+    sending.join()
+    parent.send("stats")
+    connected, dropped = parent.recv()
+    server.kill()
+    server.join()
+    for sock in stalled_clients + healthy + [sender]:
+        sock.close()
+
+    latencies.sort()
+    return {
+        "stalled": stalled,
+        "delivered": len(latencies),
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        "stalled_connected": connected,
+        "dropped": dropped,
+    }
+
+
+def main() -> None:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair slow consumer benchmark")
+    parser.add_argument("--engine", default="threaded", choices=ENGINES)
+    parser.add_argument("--policy", default=DISCONNECT, choices=[DROP, DISCONNECT])
+    parser.add_argument("--stalled", type=int, nargs="+", default=[0, 4, 16])
+    parser.add_argument("--healthy", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rate", type=int, default=500)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--fill", type=int, default=8)
+    args = parser.parse_args()
+
+    print(f'{"stalled":>8}{"delivered":>11}{"p50 ms":>9}{"p99 ms":>9}', end="")
+    print(f'{"max ms":>9}', end="")
+    print(f'{"still up":>10}{"dropped":>9}')
+    for stalled in args.stalled:
+        result = bench(args.engine, stalled, args)
+        print(
+            f'{result["stalled"]:>8}{result["delivered"]:>11}'
+            f'{result["p50_ms"]:>9.2f}{result["p99_ms"]:>9.2f}'
+            f'{result["max_ms"]:>9.2f}'
+            f'{result["stalled_connected"]:>10}{result["dropped"]:>9}'
+        )
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+
+"""startup.py
+
+The Lair: how long every session takes to start, and a budget for it.
+
+Runs lair.py under python -X importtime for every session: printing the
+help, a client, and a server of each engine.  The client connects to a
+port nobody listens on and the servers bind a port that is taken, so
+each one exits as soon as it has loaded everything it runs on.  The
+script reports the median over --repeat runs of the milliseconds spent
+importing and of the wall time, the modules costing the most, and exits
+with an error if a session imports for longer than its budget.
+
+    python3 benchmarks/startup.py --repeat 5 --scale 1.5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from socket import *
+from typing import *
+
+LAIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lair.py"
+)
+
+# Milliseconds every session may spend importing, about half again as
+# much as they took when set, --scale adjusts them to slower machines
+BUDGETS = {
+    "help": 110.0,
+    "client": 160.0,
+    "threaded": 230.0,
+    "asyncio": 250.0,
+}
+
+
+def sessions(port: int) -> Dict[str, List[str]]:
+    """The command line of every session, given a port that is taken."""
+    quiet = ["--log-file", ""]
+    return {
+        "help": ["--help"],
+        "client": ["client", "--sp", str(port + 1)] + quiet,
+        "threaded": ["server", "--port", str(port)] + quiet,
+        "asyncio": ["server", "--engine", "asyncio", "--port", str(port)] + quiet,
+    }
+
+
+def run(args: List[str]) -> Tuple[float, float, Dict[str, float]]:
+    """Import and wall milliseconds of a session, and its slowest imports."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", LAIR] + args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    wall = (time.perf_counter() - start) * 1000
+
+    # Lines are "import time: self | cumulative | name", nested names indented
+    total = 0.0
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not name.startswith("  "):
+            total += int(cumulative) / 1000
+            modules[name.strip()] = int(cumulative) / 1000
+    return total, wall, modules
+
+
+def main() -> int:
+    """Main Function."""
+    parser = argparse.ArgumentParser(description="Lair startup benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="scales the budgets")
+    parser.add_argument("--top", type=int, default=3)
+    args = parser.parse_args()
+
+    # Servers fail to bind this port once they have loaded their engine
+    taken = socket(AF_INET, SOCK_STREAM)
+    taken.bind(("127.0.0.1", 0))
+    taken.listen(1)
+    port = taken.getsockname()[1]
+
+    over = []
+    print(f'{"session":<10}{"import ms":>11}{"wall ms":>9}{"budget":>8}  slowest')
+    for name, command in sessions(port).items():
+        runs = [run(command) for _ in range(args.repeat)]
+        imported = statistics.median(total for total, _, _ in runs)
+        wall = statistics.median(wall for _, wall, _ in runs)
+        budget = BUDGETS[name] * args.scale
+        slowest = sorted(runs[-1][2].items(), key=lambda item: -item[1])[: args.top]
+        print(
+            f"{name:<10}{imported:>11.1f}{wall:>9.1f}{budget:>8.0f}  "
+            + ", ".join(f"{module} {ms:.1f}" for module, ms in slowest)
+        )
+        if imported > budget:
+            over.append(name)
+
+    taken.close()
+    if over:
+        print(f"over budget: {', '.join(over)}")
+        return 1
+    return 0
+
+
+# __main__? Program entry point
+if __name__ == "__main__":
+    sys.exit(main())
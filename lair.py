@@ -24,11 +24,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import os
 import sys
-import subprocess
 from typing import *
 
-from lairchat.cli.ChatClient import ChatClient
-from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.LogPipeline import LEVELS, LOG_FILE, configure
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.crypto.Suites import DEFAULT_SUITE, SUITE_NAMES, suite_name
+from lairchat.net.OutboundQueue import DISCONNECT, DROP
 
 # Program name
 prog = sys.argv[0]
@@ -49,6 +50,15 @@ def catch_keyboard_interrupt(func: Callable) -> Any:
     return wrapper
 
 
+def peer_address(peer: str) -> Tuple[str, int]:
+    """Parse the host:port of a peer server."""
+    host, _, port = peer.rpartition(":")
+    try:
+        return host or "127.0.0.1", int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid peer address {peer}")
+
+
 @catch_keyboard_interrupt
 def main() -> None:
     """Main Function."""
@@ -64,7 +74,35 @@ def main() -> None:
     lair_options.add_argument(
         "session_type",
         type=str,
-        help='specifies whether to run a "server" or "client" session',
+        help='specifies whether to run a "server", "client" or "bench" session',
+    )
+
+    lair_options.add_argument(
+        "--log-level",
+        choices=LEVELS,
+        default="info",
+        help="specifies the least severe messages logged",
+    )
+
+    lair_options.add_argument(
+        "--log-file",
+        type=str,
+        default=LOG_FILE,
+        help="specifies the file messages are logged to, empty for none",
+    )
+
+    lair_options.add_argument(
+        "--log-burst",
+        type=int,
+        default=20,
+        help="messages a single place in the code may log per interval, 0 for all",
+    )
+
+    lair_options.add_argument(
+        "--log-interval",
+        type=float,
+        default=1.0,
+        help="seconds after which a place in the code may log a burst again",
     )
 
     # Server options
@@ -84,6 +122,300 @@ def main() -> None:
         help="specifies which port the server will bind to",
     )
 
+    server_options.add_argument(
+        "--engine",
+        type=str,
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="specifies the server engine, a thread per client or one event loop",
+    )
+
+    server_options.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="specifies how many server processes share the port",
+    )
+
+    server_options.add_argument(
+        "--link-port",
+        type=int,
+        default=None,
+        help="specifies which port the server accepts links from peer servers on",
+    )
+
+    server_options.add_argument(
+        "--peer",
+        type=peer_address,
+        action="append",
+        default=[],
+        help="host:port of a peer server to link with, may be repeated",
+    )
+
+    server_options.add_argument(
+        "--link-secret",
+        default=os.environ.get("LAIR_LINK_SECRET"),
+        help="secret shared by linked servers, $LAIR_LINK_SECRET by default",
+    )
+
+    server_options.add_argument(
+        "--history-lines",
+        type=int,
+        default=ServerConfig.history_lines,
+        help="recent messages kept per room, 0 keeps none",
+    )
+
+    server_options.add_argument(
+        "--history-bytes",
+        type=int,
+        default=ServerConfig.history_bytes,
+        help="bytes of recent messages kept per room",
+    )
+
+    server_options.add_argument(
+        "--history-replay",
+        type=int,
+        default=ServerConfig.history_replay,
+        help="recent messages sent to a client joining a room",
+    )
+
+    server_options.add_argument(
+        "--history-rooms",
+        type=int,
+        default=ServerConfig.history_rooms,
+        help="rooms whose recent messages are kept, the least recently used go",
+    )
+
+    server_options.add_argument(
+        "--history-dir",
+        default=None,
+        help="specifies a directory to keep the history of every room in",
+    )
+
+    server_options.add_argument(
+        "--history-segment-bytes",
+        type=int,
+        default=ServerConfig.history_segment_bytes,
+        help="bytes after which a room starts a new log segment",
+    )
+
+    server_options.add_argument(
+        "--history-segment-age",
+        type=float,
+        default=ServerConfig.history_segment_age,
+        help="seconds after which a room starts a new log segment",
+    )
+
+    server_options.add_argument(
+        "--history-retain-bytes",
+        type=int,
+        default=ServerConfig.history_retain_bytes,
+        help="bytes of log kept per room, older segments are deleted",
+    )
+
+    server_options.add_argument(
+        "--history-retain-age",
+        type=float,
+        default=ServerConfig.history_retain_age,
+        help="seconds of log kept per room, older segments are deleted",
+    )
+
+    server_options.add_argument(
+        "--history-commit-interval",
+        type=float,
+        default=ServerConfig.history_commit_interval,
+        help="seconds of messages gathered into each sync of the log",
+    )
+
+    server_options.add_argument(
+        "--history-open-rooms",
+        type=int,
+        default=ServerConfig.history_open_rooms,
+        help="rooms whose logs are kept open, the least recently used are closed",
+    )
+
+    server_options.add_argument(
+        "--search-dir",
+        default=None,
+        help="specifies a directory to keep the search index of the rooms in",
+    )
+
+    server_options.add_argument(
+        "--search-flush",
+        type=int,
+        default=ServerConfig.search_flush,
+        help="messages indexed in memory before they are written to disk",
+    )
+
+    server_options.add_argument(
+        "--mailbox-dir",
+        default=None,
+        help="specifies a directory to spill large mailboxes of absent users to",
+    )
+
+    server_options.add_argument(
+        "--mailbox-memory",
+        type=int,
+        default=ServerConfig.mailbox_memory,
+        help="bytes of a mailbox kept in memory before it spills to disk",
+    )
+
+    server_options.add_argument(
+        "--mailbox-cap",
+        type=int,
+        default=ServerConfig.mailbox_cap,
+        help="bytes a mailbox may hold when spilled to disk",
+    )
+
+    server_options.add_argument(
+        "--mailbox-ttl",
+        type=float,
+        default=ServerConfig.mailbox_ttl,
+        help="seconds messages are kept in a mailbox",
+    )
+
+    server_options.add_argument(
+        "--listen-backlog",
+        type=int,
+        default=ServerConfig.listen_backlog,
+        help="connections the kernel queues until the server accepts them",
+    )
+
+    server_options.add_argument(
+        "--accept-batch",
+        type=int,
+        default=ServerConfig.accept_batch,
+        help="connections accepted at most each time the listener is ready",
+    )
+
+    server_options.add_argument(
+        "--max-handshakes",
+        type=int,
+        default=ServerConfig.max_handshakes,
+        help="connections logging in at once, more are turned away",
+    )
+
+    server_options.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=ServerConfig.handshake_timeout,
+        help="seconds a new connection is given to log in",
+    )
+
+    server_options.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        default=ServerConfig.heartbeat_interval,
+        help="seconds a client is quiet before it is pinged, 0 for no heartbeats",
+    )
+
+    server_options.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=ServerConfig.idle_timeout,
+        help="seconds a client is quiet before it is disconnected",
+    )
+
+    server_options.add_argument(
+        "--client-rate",
+        type=float,
+        default=ServerConfig.client_rate,
+        help="messages a second a client may send, 0 for no limit",
+    )
+
+    server_options.add_argument(
+        "--client-burst",
+        type=int,
+        default=ServerConfig.client_burst,
+        help="messages a client may send at once within its rate",
+    )
+
+    server_options.add_argument(
+        "--room-rate",
+        type=float,
+        default=ServerConfig.room_rate,
+        help="chat lines a second a room may be sent, 0 for no limit",
+    )
+
+    server_options.add_argument(
+        "--room-burst",
+        type=int,
+        default=ServerConfig.room_burst,
+        help="chat lines a room may be sent at once within its rate",
+    )
+
+    server_options.add_argument(
+        "--presence-window",
+        type=float,
+        default=ServerConfig.presence_window,
+        help="seconds presence changes are gathered into each update",
+    )
+
+    server_options.add_argument(
+        "--resume-messages",
+        type=int,
+        default=ServerConfig.resume_messages,
+        help="unacknowledged messages kept for a client to resume with",
+    )
+
+    server_options.add_argument(
+        "--resume-grace",
+        type=float,
+        default=ServerConfig.resume_grace,
+        help="seconds a dropped client's session is kept, 0 for no resume",
+    )
+
+    server_options.add_argument(
+        "--compress",
+        default=False,
+        action="store_true",
+        help="offer framed clients to compress messages with deflate",
+    )
+
+    server_options.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="specifies a local port to serve Prometheus metrics on",
+    )
+
+    server_options.add_argument(
+        "--queue-high",
+        type=int,
+        default=ServerConfig.queue_high_water,
+        help="bytes queued for a client before it is treated as slow",
+    )
+
+    server_options.add_argument(
+        "--queue-low",
+        type=int,
+        default=ServerConfig.queue_low_water,
+        help="bytes a slow client's queue must drain to before it recovers",
+    )
+
+    server_options.add_argument(
+        "--slow-policy",
+        type=str,
+        choices=[DROP, DISCONNECT],
+        default=ServerConfig.slow_policy,
+        help="drop new messages for slow clients or disconnect them,"
+        " compressing clients and those with a session are always disconnected",
+    )
+
+    server_options.add_argument(
+        "--flush-interval",
+        type=float,
+        default=ServerConfig.flush_interval,
+        help="seconds to coalesce messages for a client before writing, 0 for none",
+    )
+
+    server_options.add_argument(
+        "--flush-bytes",
+        type=int,
+        default=ServerConfig.flush_bytes,
+        help="write coalesced messages as soon as this many bytes are queued",
+    )
+
     # Client options
     client_options = parser.add_argument_group("Client Arguments")
 
@@ -91,6 +423,28 @@ def main() -> None:
         "--gui", default=False, action="store_true", help="run the Qt gui client"
     )
 
+    client_options.add_argument(
+        "--legacy",
+        default=False,
+        action="store_true",
+        help="speak the legacy unframed protocol to older servers",
+    )
+
+    client_options.add_argument(
+        "--no-compress",
+        default=False,
+        action="store_true",
+        help="decline the compression a server offers",
+    )
+
+    client_options.add_argument(
+        "--cipher",
+        type=str,
+        choices=list(SUITE_NAMES),
+        default=suite_name(DEFAULT_SUITE),
+        help="specifies the cipher suite of the framed protocol",
+    )
+
     client_options.add_argument(
         "--sa",
         default="127.0.0.1",
@@ -105,20 +459,204 @@ def main() -> None:
         help="specifies which port on the server to connect to",
     )
 
+    # Bench options
+    bench_options = parser.add_argument_group("Bench Arguments")
+
+    bench_options.add_argument(
+        "--clients",
+        type=int,
+        default=100,
+        help="specifies how many simulated clients log in",
+    )
+
+    bench_options.add_argument(
+        "--senders",
+        type=int,
+        default=10,
+        help="specifies how many of the clients send messages",
+    )
+
+    bench_options.add_argument(
+        "--rate",
+        type=float,
+        default=100.0,
+        help="messages sent per second by all senders together",
+    )
+
+    bench_options.add_argument(
+        "--size",
+        type=int,
+        default=64,
+        help="specifies the size of a message in characters",
+    )
+
+    bench_options.add_argument(
+        "--messages",
+        type=int,
+        default=1000,
+        help="specifies how many messages are sent in total",
+    )
+
+    bench_options.add_argument(
+        "--in-process",
+        default=False,
+        action="store_true",
+        help="benchmark a server started in-process instead of --sa/--sp",
+    )
+
+    bench_options.add_argument(
+        "--json",
+        type=str,
+        default=None,
+        help="write the results as JSON to a file, - for standard output",
+    )
+
     # Parse the command line
     args = parser.parse_args()
 
+    # Logging is set up here rather than by whatever module is imported first
+    configure(
+        args.log_level, args.log_file, burst=args.log_burst, interval=args.log_interval
+    )
+
+    if args.session_type in ("server", "bench"):
+        config = ServerConfig(
+            queue_high_water=args.queue_high,
+            queue_low_water=args.queue_low,
+            slow_policy=args.slow_policy,
+            flush_interval=args.flush_interval,
+            flush_bytes=args.flush_bytes,
+            link_port=args.link_port,
+            peers=args.peer,
+            link_secret=args.link_secret,
+            history_lines=args.history_lines,
+            history_bytes=args.history_bytes,
+            history_replay=args.history_replay,
+            history_rooms=args.history_rooms,
+            history_dir=args.history_dir,
+            history_segment_bytes=args.history_segment_bytes,
+            history_segment_age=args.history_segment_age,
+            history_retain_bytes=args.history_retain_bytes,
+            history_retain_age=args.history_retain_age,
+            history_commit_interval=args.history_commit_interval,
+            history_open_rooms=args.history_open_rooms,
+            search_dir=args.search_dir,
+            search_flush=args.search_flush,
+            mailbox_dir=args.mailbox_dir,
+            mailbox_memory=args.mailbox_memory,
+            mailbox_cap=args.mailbox_cap,
+            mailbox_ttl=args.mailbox_ttl,
+            listen_backlog=args.listen_backlog,
+            accept_batch=args.accept_batch,
+            max_handshakes=args.max_handshakes,
+            handshake_timeout=args.handshake_timeout,
+            heartbeat_interval=args.heartbeat_interval,
+            idle_timeout=args.idle_timeout,
+            client_rate=args.client_rate,
+            client_burst=args.client_burst,
+            room_rate=args.room_rate,
+            room_burst=args.room_burst,
+            presence_window=args.presence_window,
+            resume_messages=args.resume_messages,
+            resume_grace=args.resume_grace,
+            compress=args.compress,
+            metrics_port=args.metrics_port,
+        )
+
     if args.session_type == "server":
-        ChatServer(args.address, args.port).run()
+        if args.workers > 1 and (args.link_port is not None or args.peer):
+            parser.error("a server linked with peers runs a single worker")
+        if (args.link_port is not None or args.peer) and not args.link_secret:
+            parser.error("a server linked with peers needs --link-secret")
+        run_server(args, config)
     elif args.session_type == "client":
-        if not args.gui:
-            ChatClient(args.sa, args.sp).run()
-        else:
-            # exec gui client
-            subprocess.Popen(os.path.join(sys.path[0], "lair_client-qt.py"))
-            return
+        run_client(args)
+    elif args.session_type == "bench":
+        run_bench(args, config)
     else:
-        print(f"{prog}: error: session_type must be either server or client")
+        print(f"{prog}: error: session_type must be server, client or bench")
+
+
+# Every session imports the modules it runs on only once it is chosen, a
+# client never loads the server engines and a server never loads Qt
+
+
+def load_engine(name: str) -> Type:
+    """Import the server engine of a name."""
+    if name == "asyncio":
+        from lairchat.cli.AsyncChatServer import AsyncChatServer
+
+        return AsyncChatServer
+    from lairchat.cli.ChatServer import ChatServer
+
+    return ChatServer
+
+
+def run_server(args: argparse.Namespace, config: ServerConfig) -> None:
+    """Run a server session."""
+    engine = load_engine(args.engine)
+    if args.workers > 1:
+        from lairchat.cli.ShardedServer import ShardedServer
+
+        server = ShardedServer(
+            engine, args.address, args.port, args.workers, config=config
+        )
+        server.run()
+    else:
+        engine(args.address, args.port, config=config).run()
+
+
+def run_client(args: argparse.Namespace) -> None:
+    """Run a client session, in a terminal or a window."""
+    if args.gui:
+        from lairchat.gui.ChatWindow import launch
+
+        launch()
+        return
+
+    from lairchat.cli.ChatClient import ChatClient
+    from lairchat.net.Framing import FRAMED, LEGACY
+
+    ChatClient(
+        args.sa,
+        args.sp,
+        LEGACY if args.legacy else FRAMED,
+        SUITE_NAMES[args.cipher],
+        compress=not args.no_compress,
+    ).run()
+
+
+def run_bench(args: argparse.Namespace, config: ServerConfig) -> None:
+    """Run a bench session."""
+    import json
+
+    from lairchat.cli.ChatBench import ChatBench, report, start_server
+    from lairchat.net.Framing import FRAMED, LEGACY
+
+    host, port = args.sa, args.sp
+    if args.in_process:
+        host, port = start_server(load_engine(args.engine), config)
+
+    bench = ChatBench(
+        host,
+        port,
+        clients=args.clients,
+        senders=args.senders,
+        rate=args.rate,
+        size=args.size,
+        messages=args.messages,
+        mode=LEGACY if args.legacy else FRAMED,
+        suite=SUITE_NAMES[args.cipher],
+    )
+    results = bench.run()
+    report(results)
+
+    # Machine readable results to compare versions with
+    if args.json == "-":
+        print(json.dumps(results, indent=2))
+    elif args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
 
 
 # __main__? Program entry point
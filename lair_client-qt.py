@@ -23,17 +23,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
 
-from PyQt5 import QtWidgets
-
-from lairchat.gui.ChatWindow import ChatWindow
+from lairchat.cli.LogPipeline import configure
+from lairchat.gui.ChatWindow import launch
 
 
 def main():
     """Main function."""
-    app = QtWidgets.QApplication(sys.argv)
-    main_win = ChatWindow()
-    main_win.show()
-    app.exec_()
+    configure()
+    launch()
 
 
 # __main__? Program entry point
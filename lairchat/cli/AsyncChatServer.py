@@ -0,0 +1,383 @@
+"""AsyncChatServer.py
+
+The Lair: asyncio server engine for a chat application.
+
+All clients are served by a single event loop instead of a thread per
+connection.  The wire protocol, username handshake, client commands and
+admin console are shared with the threaded ChatServer.
+"""
+
+import asyncio
+import logging
+import sys
+import time
+from socket import *
+from typing import *
+
+from lairchat.cli.ChatServer import ChatServer, broadcast_to_client
+from lairchat.cli.Handshake import HELLO, Handshake
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Compression import START
+from lairchat.net.Framing import FRAMED, LEGACY, FrameError, WireCodec
+from lairchat.net.OutboundQueue import OutboundQueue
+from lairchat.net.Resume import RESUME, SESSION
+
+
+class ChatProtocol(asyncio.Protocol):
+    """A single client connection driven by the event loop."""
+
+    def __init__(self, server: "AsyncChatServer") -> None:
+        """Initialize the connection."""
+        self.server = server
+        self.transport: Union[asyncio.Transport, None] = None
+        self.address: Union[Tuple[str, int], None] = None
+        self.username = ""
+        self.resumable = False
+        self.codec = WireCodec()
+        self.writing_paused = False
+        self.flusher: Union[asyncio.TimerHandle, None] = None
+        self.queue = OutboundQueue(
+            server.config.queue_high_water,
+            server.config.queue_low_water,
+            server.config.slow_policy,
+            notify=self.schedule_flush,
+            flush_interval=server.config.flush_interval,
+            flush_bytes=server.config.flush_bytes,
+        )
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        """A client has connected."""
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        self.server.spawn_connection(self)
+
+    def data_received(self, data: bytes) -> None:
+        """A client has sent data."""
+        self.server.receive(self, data)
+
+    def connection_lost(self, exc: Union[Exception, None]) -> None:
+        """A client has disconnected."""
+        self.server.connection_lost(self)
+
+    def pause_writing(self) -> None:
+        """The transport buffer is full, keep frames in the queue."""
+        self.writing_paused = True
+
+    def resume_writing(self) -> None:
+        """The transport buffer has drained."""
+        self.writing_paused = False
+        self.flush()
+
+    def sendall(self, data: bytes) -> None:
+        """Queue data for the client, mirrors socket.sendall."""
+        if not self.queue.put(data):
+            self.abort()
+
+    def schedule_flush(self) -> None:
+        """Drain the queue after the flush interval or once it is full."""
+        loop = asyncio.get_running_loop()
+        queue = self.queue
+        delay = queue.flush_interval if queue.coalesce else 0
+        if queue.queued_bytes >= queue.flush_bytes:
+            delay = 0
+
+        # A flush is already due no later than this one would be
+        if self.flusher is not None:
+            if delay > 0 or self.flusher.when() <= loop.time():
+                return
+            self.flusher.cancel()
+        self.flusher = loop.call_later(delay, self.flush)
+
+    def flush(self) -> None:
+        """Move queued frames into the transport until it pushes back."""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        if self.transport.is_closing():
+            return
+
+        # Each batch goes out as a single scatter-gather write
+        while not self.writing_paused:
+            if not (frames := self.queue.get_batch_nowait()):
+                break
+            self.transport.writelines(frames)
+            self.queue.writes += 1
+
+    def close(self) -> None:
+        """Close the client connection once queued frames are written."""
+        self.flush()
+        self.transport.close()
+
+    def abort(self) -> None:
+        """Close the client connection, throwing away anything queued."""
+        self.queue.close(discard=True)
+        self.transport.abort()
+
+
+class AsyncChatServer(ChatServer):
+    """A chat room server running on a single asyncio event loop."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        admin_console: bool = True,
+        config: Union[ServerConfig, None] = None,
+    ) -> None:
+        """Initialize the chat server."""
+        super().__init__(host, port, admin_console, config)
+        self.handshake_timer: Union[asyncio.TimerHandle, None] = None
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+        self.closed: Union[asyncio.Event, None] = None
+
+    def create_selector(self) -> None:
+        """The asyncio event loop watches the sockets, there is no selector."""
+        return None
+
+    def run(self) -> None:
+        """Run the chat server."""
+        logging.info("Starting event loop, waiting for connections")
+
+        asyncio.run(self.serve())
+
+        logging.info("Event loop exited")
+
+    async def serve(self) -> None:
+        """Serve clients until the server is closed."""
+        loop = self.loop = asyncio.get_running_loop()
+        self.closed = asyncio.Event()
+
+        # The loop accepts as many connections per wakeup as it is told the
+        # backlog is, so listen again with the real one
+        server = await loop.create_server(
+            lambda: ChatProtocol(self),
+            sock=self.server,
+            backlog=self.config.accept_batch,
+        )
+        self.server.listen(self.config.listen_backlog)
+        self.start_metrics()
+        self.turn_wheel()
+        if self.admin_console:
+            loop.add_reader(sys.stdin, self.admin_input, None, None)
+        if self.bus is not None:
+            loop.add_reader(self.bus.events, self.read_bus)
+        if self.federation is not None:
+            self.federation.start(
+                lambda event: loop.call_soon_threadsafe(self.relay_from_peer, event)
+            )
+
+        async with server:
+            await self.closed.wait()
+
+        if self.admin_console:
+            loop.remove_reader(sys.stdin)
+        if self.bus is not None:
+            loop.remove_reader(self.bus.events)
+
+    def close_server(self) -> None:
+        """Shutdown the chat server."""
+        # Say goodbye
+        self.broadcast_to_all("The lair is closed.", relay=False)
+
+        # Closing a transport flushes what is already buffered
+        for session in self.connections.sessions():
+            session.socket.close()
+        if self.federation is not None:
+            self.federation.close()
+        self.stop_metrics()
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.search_index is not None:
+            self.search_index.close()
+
+        # Drop the connections still logging in
+        for handshake in list(self.handshakes.pending.values()):
+            self.end_handshake(handshake)
+        if self.handshake_timer is not None:
+            self.handshake_timer.cancel()
+            self.handshake_timer = None
+
+        self.exit_flag = True
+        self.closed.set()
+
+    def run_blocking(
+        self, work: Callable[[], Any], done: Callable[[Any], None]
+    ) -> None:
+        """Do slow work in a worker thread, then pass its result to done."""
+
+        def finish(future: asyncio.Future) -> None:
+            """Back on the event loop with the result."""
+            if (error := future.exception()) is not None:
+                logging.error(f"Error: {error}")
+            else:
+                done(future.result())
+
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, work).add_done_callback(finish)
+
+    def create_queue(self, conn: ChatProtocol, codec: WireCodec) -> OutboundQueue:
+        """The outbound queue of a client is drained by its protocol."""
+        return conn.queue
+
+    def disconnect(self, conn: ChatProtocol) -> None:
+        """Drop a client connection."""
+        conn.abort()
+
+    def turn_wheel(self) -> None:
+        """Run the timers due every tick of the wheel."""
+        self.run_timers()
+        self.loop.call_later(self.wheel.tick, self.turn_wheel)
+
+    def spawn_connection(self, conn: ChatProtocol) -> None:
+        """Wait for a new client connection to say hello."""
+        self.metrics.accepts.inc()
+        if self.handshakes.full():
+            self.metrics.rejected.inc()
+            logging.warning(f"{conn.address} turned away, too many logging in")
+            conn.abort()
+            return
+
+        # Listeners made without a protocol number don't get TCP_NODELAY from
+        # asyncio, and Nagle would hold back the flushes of the queue
+        sock = conn.transport.get_extra_info("socket")
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+        # Legacy clients never say hello, greet them once the wait is over
+        logging.info(f"{conn.address} has connected")
+        self.handshakes.add(conn, conn.address, conn.codec)
+        self.watch_handshakes()
+
+    def watch_handshakes(self) -> None:
+        """Wake up when the next handshake is due, sooner if one is added."""
+        deadline = self.handshakes.next_deadline()
+        if self.handshake_timer is not None:
+            if deadline is not None and self.handshake_timer.when() <= deadline:
+                return
+            self.handshake_timer.cancel()
+            self.handshake_timer = None
+        if deadline is not None:
+            self.handshake_timer = self.loop.call_at(deadline, self.handshakes_due)
+
+    def handshakes_due(self) -> None:
+        """Expire the handshakes due, and wait for the next one."""
+        self.handshake_timer = None
+        self.expire_handshakes()
+        self.watch_handshakes()
+
+    def greet(self, handshake: Handshake) -> None:
+        """Say hello to a new client connection."""
+        # Legacy clients read a message per recv, never merge their frames
+        conn = handshake.connection
+        conn.queue.coalesce = conn.codec.mode not in (None, LEGACY)
+        super().greet(handshake)
+
+    def end_handshake(self, handshake: Handshake) -> None:
+        """Drop the connection of a client that didn't log in."""
+        self.handshakes.remove(handshake.connection)
+        handshake.connection.abort()
+
+    def receive(self, conn: ChatProtocol, data: bytes) -> None:
+        """Handle data read from a client connection."""
+        # Split off the complete messages, the first data tells the wire mode
+        undecided = conn.codec.mode is None
+        try:
+            conn.codec.feed(data, 0)
+        except FrameError as e:
+            logging.warning(f"Receive error: {e}")
+            conn.close()
+            return
+        self.metrics.bytes_in.inc(len(data))
+        if conn.username and (session := self.connections.get(conn.username)):
+            session.seen = time.monotonic()
+
+        handshake = self.handshakes.get(conn)
+        if handshake is not None and (
+            handshake.step == HELLO or (undecided and conn.codec.mode == FRAMED)
+        ):
+            self.greet(handshake)
+        self.decode(conn)
+
+    def decode(self, conn: ChatProtocol) -> None:
+        """Decrypt and handle the messages of a client a batch at a time.
+
+        A client without tokens isn't read from, what it sent waits
+        undecoded until its bucket refills.  No more messages are decoded
+        at once than it may send, or than add up to a read.
+        """
+        while conn.codec.pending and conn.transport.is_reading():
+            limit, wait = self.allowance(conn.username)
+            if limit == 0:
+                self.pause(conn, [], wait)
+                return
+            start = time.perf_counter()
+            try:
+                messages = conn.codec.feed(b"", limit, self.buf_size)
+            except FrameError as e:
+                logging.warning(f"Receive error: {e}")
+                conn.close()
+                return
+            self.metrics.decrypt.observe(time.perf_counter() - start)
+            self.metrics.messages_in.inc(len(messages))
+            self.handle_decrypted(conn, messages)
+
+    def handle_decrypted(self, conn: ChatProtocol, messages: List[bytes]) -> None:
+        """Handle the messages of a client connection, in order."""
+        for i, decrypted_data in enumerate(messages):
+            message = decrypted_data.decode("utf-8", "ignore")
+
+            # Still waiting for a unique username
+            if not conn.username:
+                if message == START and conn.codec.inflater is not None:
+                    self.accept_compression(conn, conn.codec)
+                    continue
+
+                # Sessions are asked for and resumed in place of a name
+                if message == SESSION:
+                    conn.resumable = True
+                    continue
+                if message.startswith(RESUME):
+                    username = self.resume(message, conn, conn.address, conn.codec)
+                    conn.username = username or ""
+                    conn.resumable = True
+                    if conn.username:
+                        self.handshakes.remove(conn)
+                    continue
+                if (error := self.claim_username(message, conn.address)) is not None:
+                    broadcast_to_client(error, conn, conn.codec)
+                    continue
+                if not self.login(
+                    message, conn, conn.address, conn.codec, conn.resumable
+                ):
+                    continue
+                conn.username = message
+                self.handshakes.remove(conn)
+            elif (wait := self.throttle(conn.username, message)) > 0:
+                self.pause(conn, messages[i:], wait)
+                return
+            elif not self.handle_message(conn.username, message):
+                conn.close()
+                return
+
+    def pause(self, conn: ChatProtocol, held: List[bytes], wait: float) -> None:
+        """Stop reading from a client sending too fast until its buckets refill.
+
+        The messages it sent that were decoded already are held.
+        """
+        self.metrics.throttled.inc()
+        conn.transport.pause_reading()
+        self.loop.call_later(wait, self.unpause, conn, held)
+
+    def unpause(self, conn: ChatProtocol, held: List[bytes]) -> None:
+        """Read from a paused client again, its held messages first."""
+        if conn.transport.is_closing():
+            return
+        conn.transport.resume_reading()
+        self.handle_decrypted(conn, held)
+        self.decode(conn)
+
+    def connection_lost(self, conn: ChatProtocol) -> None:
+        """Forget a client connection once its transport is gone."""
+        self.handshakes.remove(conn)
+
+        if self.connections.find(conn) is not None:
+            self.drop_client(conn.username, conn)
@@ -0,0 +1,291 @@
+"""ChatBench.py
+
+The Lair: load generator for capacity planning a chat server.
+
+Logs in simulated clients with the same handshake and ciphers as the real
+client, has some of them broadcast timestamped messages at a fixed rate
+and measures how fast and how late they reach everybody else.
+"""
+
+import concurrent.futures
+import json
+import logging
+import selectors
+import threading
+import time
+from socket import *
+from typing import *
+
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import (
+    DEFAULT_SUITE,
+    FRAMED,
+    FrameError,
+    WireCodec,
+    encode_hello,
+)
+
+# Simulated clients logging in at the same time
+CONCURRENT_LOGINS = 64
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values, 0 if there are none."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_server(
+    engine: Type[ChatServer], config: Union[ServerConfig, None] = None
+) -> Tuple[str, int]:
+    """Start a server in-process on an ephemeral port, return its address."""
+    server = engine("127.0.0.1", 0, admin_console=False, config=config)
+    threading.Thread(target=server.run, daemon=True).start()
+    return server.server.getsockname()
+
+
+class BenchClient:
+    """A simulated client."""
+
+    def __init__(self, username: str, mode: str, suite: int) -> None:
+        """Initialize the client."""
+        self.username = username
+        self.mode = mode
+        self.suite = suite
+        self.codec = WireCodec(mode, suite)
+        self.sock: Union[socket, None] = None
+
+    def login(self, address: Tuple[str, int], timeout: float) -> float:
+        """Connect and pick a username, return the seconds it took."""
+        start = time.perf_counter()
+        self.sock = create_connection(address, timeout=timeout)
+        if self.mode == FRAMED:
+            self.sock.sendall(encode_hello(self.suite))
+
+        # Wait for the greeting, then for the welcome
+        self.expect("Enter your name!")
+        self.sock.sendall(self.codec.encode(self.username))
+        self.expect(f"Hello {self.username}!")
+        return time.perf_counter() - start
+
+    def expect(self, text: str) -> None:
+        """Read messages until one holds text."""
+        while True:
+            if not (data := self.sock.recv(4096)):
+                raise ConnectionError("the server closed the connection")
+            for message in self.codec.feed(data):
+                if text in message.decode("utf-8", "ignore"):
+                    return
+
+
+class ChatBench:
+    """Drive a chat server with simulated clients and measure it."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        clients: int = 100,
+        senders: int = 10,
+        rate: float = 100.0,
+        size: int = 64,
+        messages: int = 1000,
+        mode: str = FRAMED,
+        suite: int = DEFAULT_SUITE,
+        timeout: float = 10.0,
+    ) -> None:
+        """Initialize the benchmark."""
+        self.address = (host, port)
+        self.clients = [BenchClient(f"b{i}", mode, suite) for i in range(clients)]
+        self.senders = max(1, min(senders, clients))
+        self.rate = rate
+        self.size = size
+        self.messages = messages
+        self.mode = mode
+        self.timeout = timeout
+        self.errors: Dict[str, int] = {}
+        self.sent = 0
+
+    def error(self, kind: str) -> None:
+        """Count an error."""
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def run(self) -> Dict[str, Any]:
+        """Log the clients in, send the messages and return the results."""
+        logging.info(f"Logging in {len(self.clients)} clients")
+        connect_times = self.login_all()
+        connected = [client for client in self.clients if client.sock is not None]
+
+        logging.info(f"Sending {self.messages} messages at {self.rate}/sec")
+        if connected:
+            latencies, received_bytes, elapsed = self.exchange(connected)
+        else:
+            latencies, received_bytes, elapsed = [], 0, 0.0
+
+        for client in connected:
+            client.sock.close()
+
+        connect_times.sort()
+        latencies.sort()
+        expected = self.sent * (len(connected) - 1)
+        if (lost := expected - len(latencies)) > 0:
+            self.errors["lost"] = lost
+
+        return {
+            "address": f"{self.address[0]}:{self.address[1]}",
+            "mode": self.mode,
+            "clients": len(self.clients),
+            "connected": len(connected),
+            "senders": self.senders,
+            "rate": self.rate,
+            "size": self.size,
+            "sent": self.sent,
+            "delivered": len(latencies),
+            "seconds": elapsed,
+            "msgs_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "bytes_per_sec": received_bytes / elapsed if elapsed else 0.0,
+            "connect_ms": {
+                "p50": percentile(connect_times, 0.5) * 1000,
+                "p99": percentile(connect_times, 0.99) * 1000,
+                "max": percentile(connect_times, 1.0) * 1000,
+            },
+            "latency_ms": {
+                "p50": percentile(latencies, 0.5) * 1000,
+                "p95": percentile(latencies, 0.95) * 1000,
+                "p99": percentile(latencies, 0.99) * 1000,
+                "max": percentile(latencies, 1.0) * 1000,
+            },
+            "errors": self.errors,
+        }
+
+    def login_all(self) -> List[float]:
+        """Log in every client, a few at a time, return the connect times."""
+
+        def login(client: BenchClient) -> Union[float, None]:
+            """Log in one client, None if it failed."""
+            try:
+                return client.login(self.address, self.timeout)
+            except (OSError, FrameError) as e:
+                logging.warning(f"{client.username} failed to log in: {e}")
+                if client.sock is not None:
+                    client.sock.close()
+                    client.sock = None
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(CONCURRENT_LOGINS) as pool:
+            times = list(pool.map(login, self.clients))
+        if failed := sum(1 for t in times if t is None):
+            self.errors["connect"] = failed
+        return [t for t in times if t is not None]
+
+    def exchange(self, clients: List[BenchClient]) -> Tuple[List[float], int, float]:
+        """Send from the senders, read everywhere, return latencies and bytes."""
+        # Sockets keep the timeout they logged in with, so the sender thread
+        # can write while this one only reads what select says is there
+        sel = selectors.DefaultSelector()
+        for client in clients:
+            sel.register(client.sock, selectors.EVENT_READ, client)
+
+        # Let the join announcements settle
+        self.drain(sel, 0.5)
+
+        sender = threading.Thread(target=self.send, args=(clients[: self.senders],))
+        start = time.perf_counter()
+        sender.start()
+
+        latencies: List[float] = []
+        received_bytes = 0
+        expected = self.messages * (len(clients) - 1)
+        last = start
+        while len(latencies) < expected:
+            if not (events := sel.select(timeout=self.timeout)):
+                if not sender.is_alive():
+                    break
+                continue
+            for key, mask in events:
+                client = key.data
+                try:
+                    data = client.sock.recv(1 << 20)
+                    messages = client.codec.feed(data)
+                except (OSError, FrameError):
+                    data = b""
+                    self.error("receive")
+                if not data:
+                    sel.unregister(client.sock)
+                    self.error("disconnected")
+                    continue
+
+                now = last = time.perf_counter()
+                received_bytes += len(data)
+                for message in messages:
+                    if (stamp := self.stamp_of(message)) is not None:
+                        latencies.append(now - stamp)
+
+        sender.join()
+        sel.close()
+        return latencies, received_bytes, last - start
+
+    def send(self, senders: List[BenchClient]) -> None:
+        """Send timestamped messages round robin at the configured rate."""
+        start = time.perf_counter()
+        for i in range(self.messages):
+            # Keep to the schedule rather than sleeping a fixed time
+            if (delay := start + i / self.rate - time.perf_counter()) > 0:
+                time.sleep(delay)
+
+            client = senders[i % len(senders)]
+            stamp = f"{time.perf_counter():.6f}".ljust(self.size, ".")
+            try:
+                client.sock.sendall(client.codec.encode(stamp))
+                self.sent += 1
+            except OSError:
+                self.error("send")
+
+    def drain(self, sel: selectors.BaseSelector, idle: float) -> None:
+        """Read and discard everything until the clients have been idle a while."""
+        while events := sel.select(timeout=idle):
+            for key, mask in events:
+                try:
+                    key.data.codec.feed(key.fileobj.recv(1 << 20))
+                except (OSError, FrameError):
+                    pass
+
+    @staticmethod
+    def stamp_of(message: bytes) -> Union[float, None]:
+        """The send time in a benchmark chat line, None for other messages."""
+        line = message.decode("utf-8", "ignore").rpartition("\n")[2]
+        username, found, stamp = line.partition(": ")
+        if not found or not username.startswith("b"):
+            return None
+        try:
+            return float(stamp.rstrip("."))
+        except ValueError:
+            return None
+
+
+def report(results: Dict[str, Any]) -> None:
+    """Print benchmark results for people."""
+    connect = results["connect_ms"]
+    latency = results["latency_ms"]
+    print(f'{" Lair benchmark ":*^60}')
+    print(f'server:     {results["address"]} ({results["mode"]})')
+    print(f'clients:    {results["connected"]} of {results["clients"]} connected')
+    print(
+        f'connect:    p50 {connect["p50"]:.2f} ms, p99 {connect["p99"]:.2f} ms,'
+        f' max {connect["max"]:.2f} ms'
+    )
+    print(
+        f'delivered:  {results["delivered"]} of {results["sent"]} messages sent'
+        f' in {results["seconds"]:.2f} s'
+    )
+    print(
+        f'throughput: {results["msgs_per_sec"]:.0f} msgs/sec,'
+        f' {results["bytes_per_sec"] / 1e6:.2f} MB/sec'
+    )
+    print(
+        f'latency:    p50 {latency["p50"]:.2f} ms, p95 {latency["p95"]:.2f} ms,'
+        f' p99 {latency["p99"]:.2f} ms, max {latency["max"]:.2f} ms'
+    )
+    print(f'errors:     {json.dumps(results["errors"])}')
@@ -1,47 +1,110 @@
 """ChatClient.py
 
 The Lair: Client class for The Lair chat application.
+
+Framed clients ask for a session and reconnect when the connection
+drops, resuming the session without missing or repeating a message.
 """
 
 import selectors
 import sys
+import time
 from socket import *
+from typing import *
+
+from lairchat.cli.Presence import AWAY, GONE, PRESENCE
+from lairchat.net.Compression import OFFER, START
+from lairchat.net.Framing import (
+    DEFAULT_SUITE,
+    FRAMED,
+    FrameError,
+    WireCodec,
+    encode_hello,
+)
+from lairchat.net.Heartbeat import PING, PONG
+from lairchat.net.Resume import GREETING, SessionState, backoff
 
-from lairchat.crypto.AESCipher import aes_cipher
+# Seconds to wait for the server to accept a connection
+CONNECT_TIMEOUT = 10.0
 
 
 class ChatClient:
     """Create a chat client."""
 
-    def __init__(self, host: str, port: int) -> None:
-        """Create a chat client connection."""
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        mode: str = FRAMED,
+        suite: int = DEFAULT_SUITE,
+        compress: bool = True,
+        console: bool = True,
+    ) -> None:
+        """Create a chat client connection, reading the console if asked to."""
         self.exit_flag = False
         self.buf_size = 4096
+        self.host = host
+        self.port = port
+        self.mode = mode
+        self.suite = suite
+        self.compress = compress
+        self.console = console
+        self.away: Dict[str, bool] = {}
+        self.session = SessionState()
+        self.reconnects = 0
         self.sel = selectors.DefaultSelector()
 
-        # Connect to the server
         try:
-            self.server = socket(AF_INET, SOCK_STREAM)
-            self.server.connect((host, port))
+            self.connect()
         except OSError as e:
             print(f"Error: {e}")
             sys.exit(1)
-
-        # Register some select events
+        if self.console:
+            self.sel.register(sys.stdin, selectors.EVENT_READ, self.user_input)
+
+    def connect(self) -> None:
+        """Connect to the server, framed clients say hello straight away."""
+        self.server = create_connection((self.host, self.port), CONNECT_TIMEOUT)
+        self.server.settimeout(None)
+        self.codec = WireCodec(self.mode, self.suite)
+        if self.mode == FRAMED:
+            self.server.sendall(encode_hello(self.suite))
         self.sel.register(self.server, selectors.EVENT_READ, self.read_server)
-        self.sel.register(sys.stdin, selectors.EVENT_READ, self.user_input)
+
+    def reconnect(self) -> None:
+        """Connect again once the connection dropped, to resume the session."""
+        self.sel.unregister(self.server)
+        self.server.close()
+        if self.mode != FRAMED:
+            print("The lair is closed.")
+            self.exit_flag = True
+            return
+
+        print("Connection lost, reconnecting...")
+        for delay in backoff():
+            time.sleep(delay)
+            try:
+                self.connect()
+            except OSError:
+                continue
+            self.reconnects += 1
+            return
+        print("Unable to reconnect to the lair.")
+        self.exit_flag = True
 
     def run(self) -> None:
         """Run a client session."""
         while not self.exit_flag:
             self.event_loop()
 
-        # Clean up
-        self.sel.unregister(self.server)
-        self.sel.unregister(sys.stdin)
+        # Clean up, the socket is closed already if reconnecting failed
+        if self.console:
+            self.sel.unregister(sys.stdin)
+        if self.server.fileno() != -1:
+            self.sel.unregister(self.server)
+            self.server.shutdown(SHUT_RDWR)
+            self.server.close()
         self.sel.close()
-        self.server.shutdown(SHUT_RDWR)
-        self.server.close()
 
     def event_loop(self) -> None:
         """Select between reading from server socket and standard input."""
@@ -56,17 +119,100 @@ class ChatClient:
             data = self.server.recv(self.buf_size)
         except OSError as e:
             print(f"Error: {e}")
+            data = b""
+
+        # The connection dropped without the server saying goodbye
+        if not data:
+            self.reconnect()
             return
 
-        # Print the message
-        if (decrypted_data := aes_cipher.decrypt(data)) is None:
+        # Decrypt every complete message
+        try:
+            messages = self.codec.feed(data)
+        except FrameError as e:
+            print(f"Error: {e}")
+            self.reconnect()
             return
-        message = decrypted_data.decode("utf-8", "ignore")
+
+        for decrypted_data in messages:
+            message = decrypted_data.decode("utf-8", "ignore")
+
+            # Compression is negotiated out of sight
+            if message == OFFER:
+                if self.compress:
+                    self.accept_compression()
+                continue
+            elif message == START and self.codec.inflater is not None:
+                continue
+
+            # Sessions are asked for or resumed once greeted, and numbered
+            if self.mode == FRAMED:
+                if message == GREETING:
+                    self.send(self.session.greeted())
+                    if self.session.resuming:
+                        continue
+                message, reply = self.session.receive(message)
+                if reply is not None:
+                    self.send(reply)
+                if message is None:
+                    continue
+
+            # Heartbeats are answered out of sight
+            if message == PING:
+                self.send(PONG)
+                continue
+
+            if message.startswith(PRESENCE):
+                self.show_presence(message)
+                continue
+
+            # Print the message
+            self.show(message)
+
+            # Check if the server closed
+            if message == "The lair is closed.":
+                self.exit_flag = True
+
+    def show(self, message: str) -> None:
+        """Show a message from the server."""
         print(message)
 
-        # Check if the server closed
-        if message == "The lair is closed.":
-            self.exit_flag = True
+    def send(self, message: str) -> bool:
+        """Send a message to the server, False if it couldn't be."""
+        if (encrypted_message := self.codec.encode(message)) is None:
+            return False
+        try:
+            self.server.sendall(encrypted_message)
+        except OSError as e:
+            print(f"Error: {e}")
+            return False
+        return True
+
+    def show_presence(self, message: str) -> None:
+        """Keep track of who is here, saying who went away or came back.
+
+        Comings and goings are announced by the server as it is.
+        """
+        for line in message.splitlines()[1:]:
+            state, name = line[:1], line[1:].partition(" ")[0]
+            if state == GONE:
+                self.away.pop(name, None)
+                continue
+            was_away = self.away.get(name)
+            self.away[name] = state == AWAY
+            if state == AWAY and was_away is not None:
+                print(f"{name} is away.")
+            elif state != AWAY and was_away:
+                print(f"{name} is back.")
+
+    def accept_compression(self) -> None:
+        """Compress what is sent as one stream from now on."""
+        try:
+            self.server.sendall(self.codec.encode(START))
+        except OSError as e:
+            print(f"Error: {e}")
+            return
+        self.codec.compress(streaming=True)
 
     def user_input(self, key: selectors.SelectorKey, mask) -> None:
         """Read input from the user."""
@@ -75,24 +221,26 @@ class ChatClient:
             print(f'{" Available Commands ":*^40}')
             print("{help}:\tThis help message")
             print("{who}:\tA list of connected users")
+            print("{who #room}:\tA list of the users in a room")
+            print("{who page:N}:\tMore of the list of users")
+            print("{away}:\tTell the others you are away")
+            print("{back}:\tTell the others you are back")
+            print("{presence on}:\tBe told who is away or back")
+            print("{join #room}:\tJoin a room and talk in it")
+            print("{part #room}:\tLeave a room")
+            print("{msg name text}:\tSend a message to a single user")
+            print("{mail}:\tRead the rest of the messages kept for you")
+            print("{history N}:\tShow the last N messages of the room")
+            print("{history since 12:30}:\tShow the messages of the room since then")
+            print("{search words}:\tFind messages, add #room or page:N to them")
             print("{quit}:\tExit this client session")
             return
 
-        # Encrypt the message
-        if (encrypted_message := aes_cipher.encrypt(message)) is None:
+        # Send the message, a dropped connection is noticed by the reader
+        if not self.send(message):
             return
 
-        # Send the message
-        try:
-            self.server.sendall(encrypted_message)
-        except OSError as e:
-            print(f"Error: {e}")
-            sys.exit(1)
-
-        # Decrypt the message
-        decrypted_message = aes_cipher.decrypt(encrypted_message)
-
-        # Decode the message and check if the user wants to quit
-        if decrypted_message.decode("utf-8", "ignore") == "{quit}":
+        # Check if the user wants to quit
+        if message == "{quit}":
             self.exit_flag = True
             return
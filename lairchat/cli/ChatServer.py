@@ -3,9 +3,14 @@
 The Lair: Threaded server class for a chat application.
 """
 
+import collections
 import datetime
+import functools
+import hmac
+import http.server
+import itertools
 import logging
-import os
+import secrets
 import selectors
 import sys
 import threading
@@ -13,17 +18,53 @@ import time
 from socket import *
 from typing import *
 
+from lairchat.cli.Handshake import HELLO, NAME, Handshake, Handshakes
+from lairchat.cli.History import History
+from lairchat.cli.LogPipeline import LEVELS, log_level, set_log_level
+from lairchat.cli.Metrics import Metrics
+from lairchat.cli.Presence import AWAY, GONE, HERE, Presence
+from lairchat.cli.RateLimit import TokenBucket
+from lairchat.cli.Registry import Registry, Session
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.cli.TimerWheel import TICK, TimerWheel
 from lairchat.crypto.AESCipher import aes_cipher
+from lairchat.net.Compression import OFFER, START
+from lairchat.net.Federation import Federation
+from lairchat.net.Heartbeat import PING, PONG
+from lairchat.net.Framing import FRAMED, LEGACY, FrameError, WireCodec
+from lairchat.net.OutboundQueue import DISCONNECT, OutboundQueue, send_batch
+from lairchat.net.Resume import GREETING, RESUME, SESSION, SESSION_GONE, sequenced
+from lairchat.net.ShardBus import HubMailboxes, ShardBus
+from lairchat.store.Mailboxes import Mailboxes
+from lairchat.store.MessageLog import MessageLog
+from lairchat.store.SearchIndex import SearchIndex, split_words
 
-logfilename = os.path.join(os.path.expanduser("~"), ".lair.log")
+# Everybody starts out in the lobby
+LOBBY = "#lair"
 
-# Enable logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)-15s [%(threadName)-12s]" + "[%(levelname)-8s]  %(message)s",
-    handlers=[logging.FileHandler(logfilename), logging.StreamHandler()],
+HELP = (
+    "{join #room} join a room and talk in it\n"
+    "{part #room} leave a room\n"
+    "{msg name text} send a message to one dweller, kept for them if away\n"
+    "{mail} read the rest of the messages kept for you\n"
+    "{who} or {who #room} list the dwellers, add page:N to see more of them\n"
+    "{away} and {back} tell the others whether you are around\n"
+    "{presence on} or {presence off} be told who comes, goes or is away\n"
+    "{history N} or {history since 12:30} show earlier messages of the room\n"
+    "{search words} find messages, newest first, add #room or page:N to them\n"
+    "{quit} leave the lair"
 )
 
+# Most messages a {history} command sends back
+HISTORY_LIMIT = 100
+
+# Results on a page of a {search} command
+SEARCH_PAGE = 10
+
+# Dwellers on a page of a {who} command, legacy clients read it with one recv
+WHO_PAGE = 100
+WHO_LEGACY_PAGE = 16
+
 
 def timestamp() -> str:
     """Create a timestamp."""
@@ -34,10 +75,40 @@ def timestamp() -> str:
     return f"[{hour}:{minute}:{second}]"
 
 
-def broadcast_to_client(message: str, sock: socket) -> None:
+def parse_time(text: str) -> Union[float, None]:
+    """Read a time as epoch seconds, an ISO date and time or a time today."""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        if ":" in text and "-" not in text:
+            clock = datetime.time.fromisoformat(text)
+            when = datetime.datetime.combine(datetime.date.today(), clock)
+        else:
+            when = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    return when.timestamp()
+
+
+def check_room(room: str) -> Union[str, None]:
+    """Return why a room name can't be used, or None if it is valid."""
+    if room[:1] != "#" or not room[1:].isalnum() or len(room) > 16:
+        return "A room name is a # and up to 15 letters or digits, e.g. #den"
+    return None
+
+
+def broadcast_to_client(
+    message: str, sock: socket, codec: Union[WireCodec, None] = None
+) -> None:
     """Broadcast a message to a single client."""
     # Create the encrypted message
-    if (encrypted_message := aes_cipher.encrypt(message)) is None:
+    if codec is None:
+        encrypted_message = aes_cipher.encrypt(message)
+    else:
+        encrypted_message = codec.encode(message)
+    if encrypted_message is None:
         return
 
     # Send message
@@ -50,31 +121,235 @@ def broadcast_to_client(message: str, sock: socket) -> None:
 class ChatServer:
     """A simple chat room server."""
 
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        admin_console: bool = True,
+        config: Union[ServerConfig, None] = None,
+    ) -> None:
         """Initialize the chat server."""
         self.exit_flag = False
-        self.connections: Dict[str, Dict] = {}
+        self.connections = Registry()
+        self.rooms: Dict[str, Set[str]] = {}
+        self.rooms_lock = threading.Lock()
+        self.room_buckets: Dict[str, TokenBucket] = {}
         self.buf_size = 4096
-        self.sel = selectors.DefaultSelector()
+        self.hello_timeout = 0.5
+        self.admin_console = admin_console
+        self.config = config or ServerConfig()
+        self.bus: Union[ShardBus, None] = None
+        self.server = self.create_listener(host, port)
+        self.handshakes = Handshakes(
+            self.config.max_handshakes,
+            self.hello_timeout,
+            self.config.handshake_timeout,
+        )
+        self.federation = self.create_federation(host)
+        self.metrics = self.create_metrics()
+        self.metrics_server: Union[http.server.HTTPServer, None] = None
+        self.history = self.create_history()
+        self.message_log = self.create_message_log()
+        self.search_index = self.create_search_index()
+        self.mailboxes = self.create_mailboxes()
+        self.presence = Presence(self.config.presence_window)
+        self.roster_cache: Tuple[int, List[Tuple[str, str]]] = (-1, [])
+        self.sequence = itertools.count(1)
+        self.sequence_lock = threading.RLock()
+        self.wheel = self.create_wheel()
+        self.wheel_lock = threading.Lock()
+        self.sel = self.create_selector()
+
+    def create_selector(self) -> Union[selectors.BaseSelector, None]:
+        """Create the selector of the event loop, watching the listener."""
+        sel = selectors.DefaultSelector()
+
+        # Register some select events
+        sel.register(self.server, selectors.EVENT_READ, self.spawn_connection)
+        if self.admin_console:
+            sel.register(sys.stdin, selectors.EVENT_READ, self.admin_input)
+        return sel
 
-        # Create the server socket
+    def create_listener(self, host: str, port: int) -> socket:
+        """Create the listening server socket, accepting without blocking."""
         try:
-            self.server = socket(AF_INET, SOCK_STREAM)
-            self.server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            self.server.bind((host, port))
-            self.server.listen(5)
+            server = socket(AF_INET, SOCK_STREAM)
+            server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            if self.config.reuse_port:
+                server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            server.bind((host, port))
+            server.listen(self.config.listen_backlog)
+            server.setblocking(False)
         except OSError as e:
             logging.critical(f"Error: {e}")
             sys.exit(1)
 
-        # Register some select events
-        self.sel.register(self.server, selectors.EVENT_READ, self.spawn_connection)
-        self.sel.register(sys.stdin, selectors.EVENT_READ, self.admin_input)
+        return server
+
+    def create_federation(self, host: str) -> Union[Federation, None]:
+        """Create the node linking this server with its peers, if it has any."""
+        if self.config.link_port is None and not self.config.peers:
+            return None
+        if not self.config.link_secret:
+            logging.critical("Error: linking with peers needs a link secret")
+            sys.exit(1)
+        try:
+            return Federation(
+                host, self.config.link_port, self.config.peers, self.config.link_secret
+            )
+        except OSError as e:
+            logging.critical(f"Error: {e}")
+            sys.exit(1)
+
+    def create_history(self) -> History:
+        """Create the recent messages of the rooms."""
+        return History(
+            self.config.history_lines,
+            self.config.history_bytes,
+            self.config.history_rooms,
+        )
+
+    def create_wheel(self) -> TimerWheel:
+        """Create the timer wheel, turning at least once per presence window."""
+        tick = TICK
+        if self.presence.window > 0:
+            tick = min(TICK, self.presence.window)
+        return TimerWheel(time.monotonic(), tick)
+
+    def create_message_log(self) -> Union[MessageLog, None]:
+        """Open the durable history if a directory is configured."""
+        if self.config.history_dir is None:
+            return None
+        try:
+            return MessageLog(
+                self.config.history_dir,
+                self.config.history_segment_bytes,
+                self.config.history_segment_age,
+                self.config.history_retain_bytes,
+                self.config.history_retain_age,
+                self.config.history_commit_interval,
+                self.config.history_open_rooms,
+            )
+        except OSError as e:
+            logging.critical(f"Error: {e}")
+            sys.exit(1)
+
+    def create_search_index(self) -> Union[SearchIndex, None]:
+        """Open the search index if a directory is configured."""
+        if self.config.search_dir is None:
+            return None
+        try:
+            return SearchIndex(self.config.search_dir, self.config.search_flush)
+        except OSError as e:
+            logging.critical(f"Error: {e}")
+            sys.exit(1)
+
+    def create_mailboxes(self) -> Mailboxes:
+        """Create the mailboxes of dwellers who are away."""
+        try:
+            return Mailboxes(
+                self.config.mailbox_dir,
+                self.config.mailbox_memory,
+                self.config.mailbox_cap,
+                self.config.mailbox_ttl,
+            )
+        except OSError as e:
+            logging.critical(f"Error: {e}")
+            sys.exit(1)
+
+    def create_metrics(self) -> Metrics:
+        """Create the metrics of the server."""
+        metrics = Metrics()
+        metrics.gauge(
+            "lair_connections",
+            "Clients logged in.",
+            lambda: {"": len(self.connections)},
+        )
+        metrics.gauge(
+            "lair_handshakes",
+            "Connections logging in.",
+            lambda: {"": len(self.handshakes)},
+        )
+        metrics.gauge(
+            "lair_rooms", "Rooms with members.", lambda: {"": len(self.rooms)}
+        )
+        metrics.gauge(
+            "lair_queue_bytes",
+            "Bytes queued for a client.",
+            lambda: {
+                session.username: session.queue.queued_bytes
+                for session in self.connections.sessions()
+            },
+            label="user",
+        )
+        return metrics
+
+    def start_metrics(self) -> None:
+        """Serve metrics over HTTP if a port is configured."""
+        if self.config.metrics_port is None:
+            return
+        try:
+            self.metrics_server = self.metrics.serve(
+                "127.0.0.1", self.config.metrics_port
+            )
+        except OSError as e:
+            logging.warning(f"Unable to serve metrics: {e}")
+
+    def stop_metrics(self) -> None:
+        """Stop serving metrics over HTTP."""
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+
+    def attach_bus(self, bus: ShardBus) -> None:
+        """Run as one shard of a multi-process server."""
+        self.bus = bus
+        self.mailboxes = HubMailboxes(bus)
+        if self.sel is not None:
+            self.sel.register(bus.events, selectors.EVENT_READ, self.read_bus)
+
+    def read_bus(self, key: Any = None, mask: Any = None) -> None:
+        """Act on events relayed from the other shards."""
+        for event in self.bus.receive():
+            if event["op"] == "broadcast":
+                self.relay_from_peer(event)
+            elif event["op"] == "close" and not self.exit_flag:
+                self.close_server()
+            elif event["op"] == "log":
+                set_log_level(event["level"])
+            elif event["op"] == "stats":
+                self.bus.report(self.summary())
+            elif event["op"] == "abandon":
+                self.abandon(event["name"])
+
+    def relay_from_peer(self, event: Dict[str, Any]) -> None:
+        """Deliver a message from a client on another shard or server.
+
+        Room names come from peers too, they are checked like those of clients.
+        """
+        message = event["text"]
+        omit_username = event.get("omit")
+        if (room := event.get("room")) is not None and check_room(room) is not None:
+            logging.warning(f"Dropping a message relayed to {room!r}")
+            return
+        if (to := event.get("to")) is not None:
+            self.send_to(to, message)
+        elif room is not None:
+            self.broadcast_to_room(room, message, omit_username, relay=False)
+        else:
+            presence = event.get("presence")
+            self.broadcast_to_all(
+                message, omit_username, relay=False, presence=presence
+            )
 
     def run(self) -> None:
         """Run the chat server."""
         # Start the main thread
         logging.info("Starting main thread, waiting for connections")
+        if self.federation is not None:
+            self.federation.start(self.relay_from_peer)
+        self.start_metrics()
 
         try:
             accept_thread = threading.Thread(target=self.event_loop)
@@ -87,14 +362,23 @@ class ChatServer:
         logging.info("Main thread exited")
 
     def event_loop(self) -> None:
-        """Select between reading from server socket and standard input."""
-        while not self.exit_flag:
-            logging.info("Executing event loop")
+        """Select between the sockets and standard input, running timers.
 
-            events = self.sel.select()
+        Client threads set timers too, so the loop wakes up every tick of
+        the wheel at least.
+        """
+        logging.info("Executing event loop")
+        while not self.exit_flag:
+            deadlines = [self.handshakes.next_deadline(), self.wheel.next_tick()]
+            timeout = self.wheel.tick
+            if due := [deadline for deadline in deadlines if deadline is not None]:
+                timeout = min(timeout, max(0.0, min(due) - time.monotonic()))
+            events = self.sel.select(timeout)
             for key, mask in events:
                 callback = key.data
                 callback(key.fileobj, mask)
+            self.expire_handshakes()
+            self.run_timers()
 
     def admin_input(self, key: selectors.SelectorKey, mask) -> None:
         """Read from standard input for administrative commands."""
@@ -103,13 +387,37 @@ class ChatServer:
             self.close_server()
         elif command == "who":
             self.who()
+        elif command == "stats":
+            self.stats()
+        elif command.startswith("log"):
+            self.log_command(command[3:].strip())
         else:
             print(f"error: unknown command {command}")
 
+    def log_command(self, level: str) -> None:
+        """Show the log level, or change it."""
+        if not level:
+            print(f"log level: {log_level()}")
+        elif not set_log_level(level):
+            print(f"error: log level must be one of {', '.join(LEVELS)}")
+
     def close_server(self) -> None:
         """Shutdown the chat server."""
-        # Say goodbye
-        self.broadcast_to_all("The lair is closed.")
+        # Say goodbye, writer threads drain their queues before exiting
+        self.broadcast_to_all("The lair is closed.", relay=False)
+        for session in self.connections.sessions():
+            session.queue.close()
+        if self.federation is not None:
+            self.federation.close()
+        self.stop_metrics()
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.search_index is not None:
+            self.search_index.close()
+
+        # Drop the connections still logging in
+        for handshake in list(self.handshakes.pending.values()):
+            self.end_handshake(handshake)
 
         # Close the server
         try:
@@ -118,148 +426,1188 @@ class ChatServer:
             logging.warning(f"Error: {e}")
         finally:
             # Clean up selector
-            self.sel.unregister(self.server)
-            self.sel.unregister(sys.stdin)
+            for key in list(self.sel.get_map().values()):
+                self.sel.unregister(key.fileobj)
             self.sel.close()
 
+            # Wake up client threads once their goodbyes are written
+            for session in self.connections.sessions():
+                session.queue.wait_written(1.0)
+                self.disconnect(session.socket)
+
             # Set the exit flag
             self.exit_flag = True
 
     def who(self) -> None:
         """Print a list of all connected clients."""
         print(f'{" The lair dwellers! ":*^60}')
-        for username, info in self.connections.items():
-            print(f'{username} @ {info["address"]}')
+        for session in self.connections.sessions():
+            print(f"{session.username} @ {session.address}")
+
+    def stats(self) -> None:
+        """Print outbound queue statistics."""
+        print(f'{" Outbound queues ":*^60}')
+        for session in self.connections.sessions():
+            queue = session.queue
+            print(
+                f"{session.username}: queued {queue.queued_bytes} B"
+                f" (peak {queue.peak_bytes} B),"
+                f" sent {queue.sent_frames} in {queue.writes} writes,"
+                f" dropped {queue.dropped_frames}"
+            )
+        for line in self.summary():
+            print(line)
+
+    def summary(self) -> List[str]:
+        """The totals of the outbound queues and the metrics, as lines."""
+        queued = dropped = sent = writes = 0
+        for session in self.connections.sessions():
+            queue = session.queue
+            queued += queue.queued_bytes
+            dropped += queue.dropped_frames
+            sent += queue.sent_frames
+            writes += queue.writes
+        lines = [
+            f"total: queued {queued} B, dropped {dropped}",
+            f"total: sent {sent} in {writes} writes, saved {sent - writes} syscalls",
+            f'{" Metrics ":*^60}',
+            f"connections: {len(self.connections)}, rooms: {len(self.rooms)}",
+            f"mail: {self.mailboxes.summary()}",
+        ]
+        if self.bus is not None:
+            lines.append(f"bus: {self.bus.summary()}")
+        return lines + self.metrics.summary()
 
     def spawn_connection(self, key: selectors.SelectorKey, mask) -> None:
-        """Spawn a new client thread."""
+        """Accept the connections waiting, up to a batch of them.
+
+        Their handshakes are read by the event loop, a client is only
+        given a thread of its own once it has logged in.
+        """
+        for _ in range(self.config.accept_batch):
+            try:
+                sock, address = self.server.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.warning(f"Error: {e}")
+                return
+
+            self.metrics.accepts.inc()
+            if self.handshakes.full():
+                self.metrics.rejected.inc()
+                logging.warning(f"{address} turned away, too many logging in")
+                sock.close()
+                continue
+
+            # Writers batch frames themselves, Nagle would only hold them back
+            logging.info(f"{address} has connected")
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            sock.setblocking(False)
+            self.handshakes.add(sock, address, WireCodec())
+            self.sel.register(sock, selectors.EVENT_READ, self.read_handshake)
+
+    def read_handshake(self, sock: socket, mask) -> None:
+        """Read from a client logging in, starting its thread once it has."""
+        if (handshake := self.handshakes.get(sock)) is None:
+            return
         try:
-            sock, address = self.server.accept()
+            data = sock.recv(self.buf_size)
+        except BlockingIOError:
+            return
         except OSError as e:
-            logging.warning(f"Error: {e}")
+            logging.warning(f"Receive error: {e}")
+            data = b""
+
+        # The client closed the connection
+        if not data:
+            self.end_handshake(handshake)
             return
 
-        logging.info(f"{address} has connected")
+        # Decrypt the complete messages a read at a time, the first data
+        # tells the wire mode
+        self.metrics.bytes_in.inc(len(data))
+        while True:
+            start = time.perf_counter()
+            undecided = handshake.codec.mode is None
+            try:
+                messages = handshake.codec.feed(data, max_bytes=self.buf_size)
+            except FrameError as e:
+                logging.warning(f"Receive error: {e}")
+                self.end_handshake(handshake)
+                return
+            self.metrics.decrypt.observe(time.perf_counter() - start)
+            self.metrics.messages_in.inc(len(messages))
+            if handshake.step == HELLO or (
+                undecided and handshake.codec.mode == FRAMED
+            ):
+                self.greet(handshake)
 
-        # Say hello
-        message = "You have entered the lair!\nEnter your name!"
-        broadcast_to_client(message, sock)
+            for i, decrypted_data in enumerate(messages):
+                message = decrypted_data.decode("utf-8", "ignore")
+                if (username := self.handshake_message(handshake, message)) is None:
+                    continue
 
-        # Start the new thread
-        logging.info(f"Starting a client thread for {address}")
-        threading.Thread(target=self.handle_connection, args=(sock, address,)).start()
-        logging.info(f"Client thread for {address} started")
+                # What came after the name is read by the client thread first
+                self.handshakes.remove(sock)
+                self.sel.unregister(sock)
+                rest = [m.decode("utf-8", "ignore") for m in messages[i + 1 :]]
+                reads = itertools.chain(
+                    rest, self.read_messages(username, sock, handshake.codec)
+                )
+                threading.Thread(
+                    target=self.connection_thread_loop, args=(username, sock, reads)
+                ).start()
+                logging.info(f"Client thread for {handshake.address} started")
+                return
 
-    def handle_connection(self, sock: socket, address: Tuple[str, int]) -> None:
-        """Handles a single client connection."""
-        # Get a unique username from the client
-        if (username := self.prompt_username(sock)) != "":
-            self.connections[username] = {}
-            self.connections[username]["socket"] = sock
-            self.connections[username]["address"] = address
-        else:
+            # Decode what is left of the read before waiting for the next
+            if not handshake.codec.pending or self.handshakes.get(sock) is None:
+                return
+            data = b""
+
+    def handshake_message(
+        self, handshake: Handshake, message: str
+    ) -> Union[str, None]:
+        """Act on a message from a client logging in, its username once it has.
+
+        The socket blocks again for the client and writer threads once the
+        client has logged in or resumed.
+        """
+        sock, address, codec = handshake.connection, handshake.address, handshake.codec
+        if message == START and codec.inflater is not None:
+            self.accept_compression(sock, codec)
+            return None
+
+        # Sessions are asked for and resumed in place of a name
+        if message == SESSION:
+            handshake.resumable = True
+            return None
+        if message.startswith(RESUME):
+            handshake.resumable = True
+            sock.setblocking(True)
+            if (username := self.resume(message, sock, address, codec)) is None:
+                sock.setblocking(False)
+            return username
+
+        # Verify username
+        if (error := self.claim_username(message, address)) is not None:
+            broadcast_to_client(error, sock, codec)
+            return None
+        sock.setblocking(True)
+        if self.login(message, sock, address, codec, handshake.resumable):
+            return message
+        sock.setblocking(False)
+
+        # Another client took the name since it was checked
+        error = f"{message} is already taken, choose another name."
+        broadcast_to_client(error, sock, codec)
+        return None
+
+    def greet(self, handshake: Handshake) -> None:
+        """Say hello to a new client, legacy unless it said hello first.
+
+        Framed clients say hello as soon as they connect, legacy clients
+        wait to be greeted until hello_timeout is over.  Silence alone
+        doesn't make a client legacy, the first byte it sends does, so a
+        framed client whose hello came late is greeted again framed.
+        """
+        codec = handshake.codec
+        self.handshakes.start(handshake, NAME)
+        if codec.mode is None:
+            broadcast_to_client(GREETING, handshake.connection)
             return
+        self.offer_compression(handshake.connection, codec)
+        broadcast_to_client(GREETING, handshake.connection, codec)
+
+    def expire_handshakes(self) -> None:
+        """Greet clients that didn't say hello, drop those that didn't log in."""
+        for handshake in self.handshakes.expired(time.monotonic()):
+            if handshake.step == HELLO:
+                self.greet(handshake)
+                continue
+            self.metrics.timed_out.inc()
+            logging.info(f"{handshake.address} didn't log in in time")
+            self.end_handshake(handshake)
+
+    def end_handshake(self, handshake: Handshake) -> None:
+        """Close the connection of a client that didn't log in."""
+        self.handshakes.remove(handshake.connection)
+        self.sel.unregister(handshake.connection)
+        handshake.connection.close()
+
+    def offer_compression(self, sock: socket, codec: WireCodec) -> None:
+        """Offer to compress messages both ways if the client is framed."""
+        if self.config.compress and codec.mode != LEGACY:
+            codec.negotiating = True
+            broadcast_to_client(OFFER, sock, codec)
+
+    def accept_compression(self, sock: socket, codec: WireCodec) -> None:
+        """The client compresses what it sends, compress what it is sent too."""
+        broadcast_to_client(START, sock, codec)
+        codec.compress(streaming=True)
 
-        logging.info(f"{address} logged in as {username}")
+    def read_messages(
+        self, username: str, sock: socket, codec: WireCodec
+    ) -> Iterator[str]:
+        """Yield the messages a client sends until it disconnects.
 
-        # Welcome the new client to the lair
+        Nothing is read or decoded while the client has no tokens, what it
+        sends waits in its socket.  No more messages are decoded at once
+        than it may send, or than add up to a read.
+        """
+        while not self.exit_flag:
+            limit, wait = self.allowance(username)
+            if limit == 0:
+                self.metrics.throttled.inc()
+                time.sleep(wait)
+                continue
+
+            # Messages left from the last read are decoded first
+            data = b""
+            if not codec.pending:
+                try:
+                    data = sock.recv(self.buf_size)
+                except OSError as e:
+                    logging.warning(f"Receive error: {e}")
+                    return
+
+                # The client closed the connection
+                if not data:
+                    return
+
+            # Decrypt and decode the next complete messages
+            start = time.perf_counter()
+            try:
+                messages = codec.feed(data, limit, self.buf_size)
+            except FrameError as e:
+                logging.warning(f"Receive error: {e}")
+                return
+            self.metrics.decrypt.observe(time.perf_counter() - start)
+            self.metrics.bytes_in.inc(len(data))
+            self.metrics.messages_in.inc(len(messages))
+            for decrypted_data in messages:
+                yield decrypted_data.decode("utf-8", "ignore")
+
+    def login(
+        self,
+        username: str,
+        sock: socket,
+        address: Tuple[str, int],
+        codec: WireCodec,
+        resumable: bool = False,
+    ) -> bool:
+        """Register a client under its username and announce it.
+
+        Return False if another client logged in under the username first.
+        Clients that asked for a session are told its token first thing.
+        """
+        # Other threads may be broadcasting, only publish complete sessions
+        queue = self.create_queue(sock, codec)
+        session = Session(username, sock, address, codec, queue)
+        if resumable and self.config.resume_grace > 0 < self.config.resume_messages:
+            session.token = secrets.token_urlsafe(16)
+            session.sent = collections.deque(maxlen=self.config.resume_messages)
+        queue.policy = self.slow_policy(session)
+        if self.config.client_rate > 0:
+            session.bucket = TokenBucket(
+                self.config.client_rate, self.config.client_burst, time.monotonic()
+            )
+        if not self.connections.add(session):
+            queue.close()
+            return False
+        if session.token is not None:
+            self.send_to(username, f"{{session {username} {session.token}}}")
+            if self.bus is not None:
+                self.bus.keep_session(username, session.token)
+        self.watch(session)
+        self.join_room(username, LOBBY)
+
+        logging.info(f"{address} logged in as {username} ({codec.mode})")
+        if self.federation is not None:
+            self.federation.join(username, address[0])
+
+        # Welcome the new client to the lair, with what it missed if anything
+        self.mailboxes.know(username)
         message = f"Hello {username}!  Type {{help}} for commands."
-        broadcast_to_client(message, sock)
+        if not self.send_mail(username, message):
+            self.replay(username, LOBBY, message)
 
         # Inform other clients that a new one has connected
-        self.broadcast_to_all(f"{username} has entered the lair!", username)
+        message = f"{username} has entered the lair!"
+        presence = [username, address[0], GONE, HERE]
+        self.broadcast_to_all(message, username, presence=presence)
+        return True
 
-        # Start sending/receiving messages with client thread
-        self.connection_thread_loop(username)
+    def create_queue(self, sock: socket, codec: WireCodec) -> OutboundQueue:
+        """Create the outbound queue of a client and its writer thread."""
+        queue = OutboundQueue(
+            self.config.queue_high_water,
+            self.config.queue_low_water,
+            self.config.slow_policy,
+            flush_interval=self.config.flush_interval,
+            flush_bytes=self.config.flush_bytes,
+        )
 
-    def prompt_username(self, sock: socket) -> str:
-        """Get a unique username from the client."""
-        while True:
+        # Legacy clients read a message per recv, never merge their frames
+        queue.coalesce = codec.mode != LEGACY
+        threading.Thread(
+            target=self.connection_writer_loop, args=(sock, queue), daemon=True
+        ).start()
+        return queue
+
+    def slow_policy(self, session: Session) -> str:
+        """What to do with the frames of a client that falls behind.
+
+        A frame left out of a compression stream breaks every later one,
+        and one left out of a session is never noticed as its numbers skip
+        anyway.  Such clients are disconnected instead, those with a
+        session resume and are sent what they missed.
+        """
+        deflater = session.codec.deflater
+        streamed = deflater is not None and deflater.stream is not None
+        if session.sent is not None or streamed:
+            return DISCONNECT
+        return self.config.slow_policy
+
+    def connection_writer_loop(self, sock: socket, queue: OutboundQueue) -> None:
+        """Write queued frames to a client until its queue is closed."""
+        while frames := queue.get_batch():
             try:
-                data = sock.recv(self.buf_size)
+                queue.writes += send_batch(sock, frames)
             except OSError as e:
-                logging.warning(f"Error: {e}")
-                return ""
-
-            # Decrypt and decode data
-            if (decrypted := aes_cipher.decrypt(data)) is None:
-                return ""
-            username = decrypted.decode("utf-8", "ignore")
-
-            # Verify username
-            if username in self.connections.keys():
-                message = f"{username} is already taken, choose another name."
-                broadcast_to_client(message, sock)
-            elif not username.isalnum() or len(username) > 8:
-                message = "Your name must be alphanumeric only\n"
-                message = message + "and no longer than 8 characters.\n"
-                message = message + "e.g, The3vil1"
-                broadcast_to_client(message, sock)
-            else:
-                return username
+                logging.warning(f"Send error: {e}")
+                queue.close(discard=True)
+                self.disconnect(sock)
+
+    def check_username(self, username: str) -> Union[str, None]:
+        """Return why a username can't be used, or None if it is available."""
+        if username in self.connections:
+            return f"{username} is already taken, choose another name."
+        elif not username.isalnum() or len(username) > 8:
+            message = "Your name must be alphanumeric only\n"
+            message = message + "and no longer than 8 characters.\n"
+            message = message + "e.g, The3vil1"
+            return message
+        return None
+
+    def claim_username(
+        self, username: str, address: Tuple[str, int]
+    ) -> Union[str, None]:
+        """Reserve a username, return why it can't be used if it isn't free."""
+        if (message := self.check_username(username)) is not None:
+            return message
+
+        # Other shards or servers may have a client by that name
+        if self.federation is not None and self.federation.knows(username):
+            return f"{username} is already taken, choose another name."
+        if self.bus is not None and not self.bus.claim(username, address):
+            return f"{username} is already taken, choose another name."
+        return None
 
     def broadcast_to_all(
-        self, message: str, omit_username: Union[str, None] = None
+        self,
+        message: str,
+        omit_username: Union[str, None] = None,
+        relay: bool = True,
+        presence: Union[List[str], None] = None,
     ) -> None:
-        """Broadcast a message to clients."""
-        # Create the encrypted message
-        if (encrypted_message := aes_cipher.encrypt(message)) is None:
-            return
+        """Broadcast a message to clients, and those on other shards if relayed.
 
-        # Check message length, if too long inform client
-        if len(encrypted_message) >= (self.buf_size / 4) and omit_username:
-            info = self.connections[omit_username]
-            encrypted_message = "Message was too long to send."
-            broadcast_to_client(encrypted_message, info["socket"])
+        presence is the change of a dweller the message announces, as its
+        name, host, state before and state after.  An empty message only
+        tells presence subscribers.
+        """
+        if relay and self.bus is not None:
+            self.bus.publish(message, omit_username, presence=presence)
+        if relay and self.federation is not None:
+            self.federation.publish(message, presence=presence)
+        if presence is not None:
+            self.announce(*presence)
+        if message:
+            self.deliver(self.connections.sessions(), message, omit_username)
+
+    def announce(self, name: str, host: str, before: str, after: str) -> None:
+        """Tell presence subscribers about a change once the window is over."""
+        if not self.presence.change(name, host, before, after):
             return
+        if self.presence.window > 0:
+            self.schedule(self.presence.window, self.flush_presence)
+        else:
+            self.flush_presence()
 
-        # Broadcast message
-        for username in self.connections.keys():
-            # Don't send a client it's own message
-            if omit_username and username == omit_username:
-                continue
+    def flush_presence(self) -> None:
+        """Send the changes gathered during the window to the subscribers."""
+        message, subscribers = self.presence.take()
+        if message is not None:
+            self.deliver(self.find_sessions(subscribers), message, None)
 
-            # Send message
+    def schedule(self, delay: float, callback: Callable[[], None]) -> None:
+        """Call back on the event loop after delay seconds, to the tick."""
+        with self.wheel_lock:
+            self.wheel.schedule(delay, callback, time.monotonic())
+
+    def run_timers(self) -> None:
+        """Call back every timer of the wheel that is due."""
+        with self.wheel_lock:
+            callbacks = self.wheel.advance(time.monotonic())
+        for callback in callbacks:
             try:
-                self.connections[username]["socket"].sendall(encrypted_message)
-            except OSError as e:
-                logging.warning(f"Broadcast error: {e}")
-                self.remove_client(username)
+                callback()
+            except Exception as e:
+                logging.error(f"Error: {e}")
+
+    def broadcast_to_room(
+        self,
+        room: str,
+        message: str,
+        omit_username: Union[str, None] = None,
+        relay: bool = True,
+    ) -> None:
+        """Send a message to the members of a room, wherever they are."""
+        if relay and self.bus is not None:
+            self.bus.publish(message, omit_username, room=room)
+        if relay and self.federation is not None:
+            self.federation.publish(message, room=room)
+        self.history.append(room, message)
+        if self.message_log is not None:
+            self.message_log.append(room, message)
+        if self.search_index is not None:
+            # Leave the timestamp line out, results carry the date
+            self.search_index.add(room, message.partition("\n")[2] or message)
+        self.deliver(self.members(room), message, omit_username)
+
+    def members(self, room: str) -> List[Session]:
+        """The sessions of the local members of a room."""
+        return self.find_sessions(list(self.rooms.get(room, ())))
+
+    def find_sessions(self, usernames: Iterable[str]) -> List[Session]:
+        """The sessions of the usernames logged in here."""
+        return [
+            session
+            for username in usernames
+            if (session := self.connections.get(username)) is not None
+        ]
+
+    def deliver(
+        self,
+        sessions: Iterable[Session],
+        message: str,
+        omit_username: Union[str, None],
+    ) -> None:
+        """Queue a message for local clients, encrypting it once per variant.
+
+        Clients with a session get it numbered, which makes a variant of its
+        own, and kept until they acknowledge it.  Numbering and queueing go
+        together so every client is sent its numbers in order.
+        """
+        encrypted_messages: Dict[Tuple[str, bool], Union[bytes, None]] = {}
+        too_long = False
+        queued = queued_bytes = 0
+        start = time.perf_counter()
+
+        # Broadcast message
+        with self.sequence_lock:
+            seq = next(self.sequence)
+            for session in sessions:
+                # Don't send a client it's own message
+                if omit_username and session.username == omit_username:
+                    continue
+
+                codec = session.codec
+                variant = (codec.variant, session.sent is not None)
+                if variant not in encrypted_messages:
+                    encrypt_start = time.perf_counter()
+                    text = sequenced(seq, message) if variant[1] else message
+                    encrypted_messages[variant] = codec.encode(text)
+                    self.metrics.encrypt.observe(time.perf_counter() - encrypt_start)
+                if (encrypted_message := encrypted_messages[variant]) is None:
+                    return
+
+                # Legacy clients read a message with a single recv
+                if codec.mode == LEGACY and len(encrypted_message) >= (
+                    self.buf_size / 4
+                ):
+                    too_long = True
+                    continue
+
+                # Queue message
+                self.enqueue(session, encrypted_message)
+                if session.sent is not None:
+                    self.keep(session, seq, message)
+                queued += 1
+                queued_bytes += len(encrypted_message)
 
-    def connection_thread_loop(self, username: str) -> None:
+        # Count once per broadcast rather than once per recipient
+        self.metrics.broadcast.observe(time.perf_counter() - start)
+        self.metrics.messages_out.inc(queued)
+        self.metrics.bytes_out.inc(queued_bytes)
+
+        # If too long for some clients inform the sender
+        if too_long and omit_username in self.connections:
+            message = "Message was too long to send to legacy clients."
+            self.send_to(omit_username, message)
+
+    def send_to(self, username: str, message: str) -> None:
+        """Queue a message for a single logged in client."""
+        if (session := self.connections.get(username)) is None:
+            return
+        with self.sequence_lock:
+            seq = next(self.sequence)
+            text = sequenced(seq, message) if session.sent is not None else message
+            start = time.perf_counter()
+            encrypted_message = session.codec.encode(text)
+            self.metrics.encrypt.observe(time.perf_counter() - start)
+            if encrypted_message is None:
+                return
+            self.metrics.messages_out.inc()
+            self.metrics.bytes_out.inc(len(encrypted_message))
+            self.enqueue(session, encrypted_message)
+            if session.sent is not None:
+                self.keep(session, seq, message)
+
+    def enqueue(self, session: Session, encrypted_message: bytes) -> None:
+        """Queue an encrypted message, evicting the client if it is too slow."""
+        if not session.queue.put(encrypted_message):
+            self.evict(session.username)
+
+    def keep(self, session: Session, seq: int, message: str) -> None:
+        """Keep a message until the client acknowledges it, the lock is held.
+
+        The oldest message is forgotten once too many are kept, a client
+        resuming from before it has missed it for good.
+        """
+        if len(session.sent) == session.sent.maxlen:
+            session.lost = session.sent[0][0]
+        session.sent.append((seq, message))
+
+    def acknowledge(self, username: str, argument: str) -> None:
+        """Forget the messages a client has read."""
+        session = self.connections.get(username)
+        if session is None or session.sent is None or not argument.isdigit():
+            return
+        seq = int(argument)
+        with self.sequence_lock:
+            while session.sent and session.sent[0][0] <= seq:
+                session.sent.popleft()
+
+    def resume(
+        self, request: str, sock: Any, address: Tuple[str, int], codec: WireCodec
+    ) -> Union[str, None]:
+        """Give a session back to the client holding its token.
+
+        The client is sent every message after the last one it read, then
+        that it resumed, and how it went.  Return its username, or None
+        after telling it there is no such session.
+        """
+        try:
+            username, token, last = request[1:-1].split()[1:]
+            seq = int(last)
+        except ValueError:
+            username, token, seq = "", "", 0
+        session = self.connections.get(username)
+        if (
+            session is None
+            or session.token is None
+            or not hmac.compare_digest(session.token, token)
+        ):
+            # A session kept by another shard ends there, freeing the name
+            if session is None and self.bus is not None:
+                self.bus.abandon(username, token)
+            broadcast_to_client(SESSION_GONE, sock, codec)
+            return None
+
+        # Nothing is sent to the session while it moves over
+        with self.sequence_lock:
+            old_socket, old_queue = session.socket, session.queue
+            session.queue = self.create_queue(sock, codec)
+            session.codec = codec
+            session.queue.policy = self.slow_policy(session)
+            session.address = address
+            self.connections.rebind(session, sock)
+            old_queue.close(discard=True)
+            self.disconnect(old_socket)
+
+            missed = [(number, text) for number, text in session.sent if number > seq]
+            for number, text in missed:
+                if (encrypted_message := codec.encode(sequenced(number, text))) is None:
+                    continue
+                self.enqueue(session, encrypted_message)
+            self.send_to(username, f"{{resumed {username}}}")
+            if session.lost > seq:
+                self.send_to(username, "Some messages were lost while you were away.")
+            self.send_to(username, f"Welcome back!  {len(missed)} missed messages.")
+        self.watch(session)
+
+        logging.info(f"{address} resumed the session of {username}")
+        return username
+
+    def drop_client(self, username: str, sock: Any) -> None:
+        """The connection of a client was lost, keep its session a while."""
+        session = self.connections.get(username)
+        if session is None or session.socket is not sock:
+            return
+        if session.token is None or self.exit_flag:
+            self.remove_client(username)
+            return
+
+        # Messages are still kept for the session, the queue throws them away
+        queue = session.queue
+        queue.close(discard=True)
+        logging.info(f"{username} lost its connection, keeping its session")
+        self.schedule(self.config.resume_grace, lambda: self.expire(username, queue))
+
+    def abandon(self, username: str) -> None:
+        """The client of a session resumed on another shard, end it here."""
+        if (session := self.connections.get(username)) is None:
+            return
+        session.queue.close(discard=True)
+        self.disconnect(session.socket)
+        self.remove_client(username)
+
+    def expire(self, username: str, queue: OutboundQueue) -> None:
+        """Remove a client still on the queue it lost, it didn't resume in time."""
+        session = self.connections.get(username)
+        if session is not None and session.queue is queue:
+            self.remove_client(username)
+
+    def watch(self, session: Session) -> None:
+        """Check now and then that a client that logged in or resumed is there.
+
+        Legacy clients can't answer a ping, they are left alone.
+        """
+        session.seen = time.monotonic()
+        if self.config.heartbeat_interval > 0 and session.codec.mode != LEGACY:
+            self.schedule(
+                self.config.heartbeat_interval,
+                functools.partial(self.heartbeat, session, session.queue),
+            )
+
+    def heartbeat(self, session: Session, queue: OutboundQueue) -> None:
+        """Ping a client that went quiet, disconnect it if it stayed quiet.
+
+        A client that logged out or whose connection dropped or moved on
+        since is no longer watched by this timer.
+        """
+        if session.queue is not queue or queue.closed:
+            return
+        if self.connections.get(session.username) is not session:
+            return
+
+        interval = self.config.heartbeat_interval
+        quiet = time.monotonic() - session.seen
+        beat = functools.partial(self.heartbeat, session, queue)
+        if quiet < interval:
+            self.schedule(interval - quiet, beat)
+        elif quiet >= self.config.idle_timeout:
+            self.metrics.evicted.inc()
+            logging.info(f"{session.username} stayed quiet, disconnecting")
+            self.disconnect(session.socket)
+        else:
+            self.ping(session)
+            remaining = self.config.idle_timeout - quiet
+            self.schedule(min(interval, remaining), beat)
+
+    def ping(self, session: Session) -> None:
+        """Ask a client to answer, the ping isn't numbered."""
+        with self.sequence_lock:
+            if (encrypted_message := session.codec.encode(PING)) is not None:
+                self.enqueue(session, encrypted_message)
+        self.metrics.pings.inc()
+
+    def evict(self, username: str) -> None:
+        """Disconnect a client that doesn't keep up with its messages.
+
+        Its session is kept like that of any client that lost its connection.
+        """
+        if (session := self.connections.get(username)) is None:
+            return
+        logging.warning(f"{username} is too slow, disconnecting")
+        session.queue.close(discard=True)
+        self.disconnect(session.socket)
+        self.drop_client(username, session.socket)
+
+    def disconnect(self, sock: socket) -> None:
+        """Shut a client socket down, waking up its reader thread."""
+        try:
+            sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def connection_thread_loop(
+        self, username: str, sock: socket, messages: Iterator[str]
+    ) -> None:
         """Send/Receive loop for client thread."""
-        while not self.exit_flag:
-            try:
-                data = self.connections[username]["socket"].recv(self.buf_size)
-            except OSError as e:
-                logging.warning(f"Receive error: {e}")
-                self.remove_client(username)
+        # The client may have been evicted while it was being welcomed
+        if (session := self.connections.get(username)) is None:
+            return
+        for message in messages:
+            session.seen = time.monotonic()
+
+            # Reading stops while the client sends too fast
+            while (wait := self.throttle(username, message)) > 0:
+                self.metrics.throttled.inc()
+                time.sleep(wait)
+            if not self.handle_message(username, message):
                 return
 
-            # Decrypt and decode the message
-            if (decrypted_data := aes_cipher.decrypt(data)) is None:
+        # The connection was lost
+        self.drop_client(username, sock)
+
+    def allowance(self, username: str) -> Tuple[Union[int, None], float]:
+        """The messages a client may send now, and if none how long until one.
+
+        A client that isn't rate limited may send any number, None.
+        """
+        session = self.connections.get(username)
+        if session is None or session.bucket is None:
+            return None, 0.0
+        wait = session.bucket.wait(time.monotonic())
+        return int(session.bucket.tokens), wait
+
+    def throttle(self, username: str, message: str) -> float:
+        """Take tokens for a message, or return the seconds to wait for them.
+
+        Chat lines take a token from the room they go to as well as from
+        the client, answers to the server take none.
+        """
+        if self.config.client_rate <= 0 and self.config.room_rate <= 0:
+            return 0.0
+        if message == PONG or message.startswith("{ack "):
+            return 0.0
+        if (session := self.connections.get(username)) is None:
+            return 0.0
+        now = time.monotonic()
+        if session.bucket is not None and (wait := session.bucket.wait(now)) > 0:
+            return wait
+
+        command = message.startswith("{") and message.endswith("}")
+        if self.config.room_rate > 0 and not command and session.room is not None:
+            with self.rooms_lock:
+                if (bucket := self.room_buckets.get(session.room)) is None:
+                    bucket = self.room_buckets[session.room] = TokenBucket(
+                        self.config.room_rate, self.config.room_burst, now
+                    )
+                if (wait := bucket.wait(now)) > 0:
+                    return wait
+                bucket.take()
+        if session.bucket is not None:
+            session.bucket.take()
+        return 0.0
+
+    def handle_message(self, username: str, message: str) -> bool:
+        """Act on a message from a client, return False once it has quit.
+
+        Other threads may remove the client at any moment, its handlers look
+        its session up once and do nothing if it is gone.
+        """
+        if username not in self.connections:
+            return False
+        if message == "{quit}":
+            self.remove_client(username)
+            return False
+        elif message == PONG:
+            return True
+        elif message.startswith("{") and message.endswith("}"):
+            command, _, argument = message[1:-1].partition(" ")
+            self.handle_command(username, command, argument.strip())
+        else:
+            self.say(username, message)
+        return True
+
+    def handle_command(self, username: str, command: str, argument: str) -> None:
+        """Act on a command from a client."""
+        if command == "who":
+            self.tell_who(username, argument)
+        elif command == "away":
+            self.set_away(username, True)
+        elif command == "back":
+            self.set_away(username, False)
+        elif command == "presence":
+            self.subscribe(username, argument)
+        elif command == "join":
+            self.join(username, argument)
+        elif command == "part":
+            self.part(username, argument)
+        elif command == "msg":
+            name, _, text = argument.partition(" ")
+            self.whisper(username, name, text.strip())
+        elif command == "history":
+            self.tell_history(username, argument)
+        elif command == "mail":
+            if not self.send_mail(username, "Your mailbox:"):
+                self.send_to(username, "Your mailbox is empty.")
+        elif command == "search":
+            self.search(username, argument)
+        elif command == "help":
+            self.send_to(username, HELP)
+        elif command == "ack":
+            self.acknowledge(username, argument)
+        else:
+            self.send_to(username, "Unknown command, type {help} for commands.")
+
+    def say(self, username: str, message: str) -> None:
+        """Send a chat line to the room a client talks in."""
+        if (session := self.connections.get(username)) is None:
+            return
+        if (room := session.room) is None:
+            self.send_to(username, "You are in no room, {join #room} to talk.")
+            return
+
+        # Lobby lines look the way they always have
+        if room == LOBBY:
+            message = f"{timestamp()}\n{username}: {message}"
+        else:
+            message = f"{timestamp()}\n{room} {username}: {message}"
+        self.broadcast_to_room(room, message, username)
+
+    def join(self, username: str, room: str) -> None:
+        """Move a client into a room, joining it first if need be."""
+        if (error := check_room(room)) is not None:
+            self.send_to(username, error)
+            return
+
+        if not self.join_room(username, room):
+            self.send_to(username, f"You are talking in {room}.")
+            return
+
+        self.replay(username, room, f"You are talking in {room}.")
+        self.broadcast_to_room(room, f"{username} has joined {room}.", username)
+
+    def part(self, username: str, room: str) -> None:
+        """Take a client out of a room, the one it talks in if none is given."""
+        if (session := self.connections.get(username)) is None:
+            return
+        room = room or session.room
+        if room is None or not self.part_room(username, room):
+            self.send_to(username, f"You are not in {room or 'a room'}.")
+            return
+
+        self.broadcast_to_room(room, f"{username} has left {room}.", username)
+        if (current := session.room) is not None:
+            self.send_to(username, f"You left {room}, talking in {current}.")
+        else:
+            self.send_to(username, f"You left {room}.")
+
+    def whisper(self, username: str, name: str, text: str) -> None:
+        """Send a message to a single client, wherever it is."""
+        if username not in self.connections:
+            return
+        if not text:
+            self.send_to(username, "Usage: {msg name text}")
+            return
+
+        message = f"{timestamp()}\n{username} whispers: {text}"
+        if name in self.connections:
+            self.send_to(name, message)
+        elif name in [user for user, host in self.roster()]:
+            if self.bus is not None:
+                self.bus.publish(message, None, to=name)
+            if self.federation is not None:
+                self.federation.publish(message, to=name)
+        elif self.mailboxes.known(name):
+            if self.mailboxes.put(name, message):
+                self.send_to(username, f"{name} is away, the message will wait.")
+            else:
+                self.send_to(username, f"The mailbox of {name} is full.")
+        else:
+            self.send_to(username, f"{name} is not in the lair.")
+
+    def replay(self, username: str, room: str, message: str) -> None:
+        """Send a client a message followed by the recent messages of a room."""
+        records = self.history.recent(room, self.config.history_replay)
+        self.send_lines(username, message, [record.text for record in records])
+
+    def send_mail(self, username: str, message: str) -> bool:
+        """Send a client a message followed by its mail, False if it has none.
+
+        It all goes out as one message.  Legacy clients read that with a
+        single recv, so they get what fits and {mail} brings the rest.
+        """
+        if (session := self.connections.get(username)) is None:
+            return False
+        max_bytes = None
+        if session.codec.mode == LEGACY:
+            max_bytes = (self.buf_size // 4 - 64) * 3 // 4 - len(message) - 96
+        mail, left = self.mailboxes.take(username, max_bytes)
+        if not mail:
+            return False
+
+        lines = [f"{len(mail)} messages came while you were away:".encode("utf-8")]
+        lines += mail
+        if left:
+            lines.append(f"{{mail}} for {left} more.".encode("utf-8"))
+        self.send_lines(username, message, lines)
+        return True
+
+    def tell_history(self, username: str, argument: str) -> None:
+        """Send a client earlier messages of the room it talks in."""
+        if (session := self.connections.get(username)) is None:
+            return
+        if (room := session.room) is None:
+            self.send_to(username, "You are in no room, {join #room} first.")
+            return
+
+        word, _, rest = argument.partition(" ")
+        since = None
+        if word == "since":
+            if (since := parse_time(rest.strip())) is None:
+                self.send_to(username, "Usage: {history since 12:30}")
                 return
-            message = decrypted_data.decode("utf-8", "ignore")
+            count = HISTORY_LIMIT
+        elif not word:
+            count = self.config.history_replay
+        elif word.isdigit():
+            count = min(int(word), HISTORY_LIMIT)
+        else:
+            self.send_to(username, "Usage: {history N} or {history since 12:30}")
+            return
+
+        def answer(lines: List[bytes]) -> None:
+            """Send the history."""
+            self.send_lines(username, f"History of {room}:", lines)
+
+        # The durable log reaches further back than the memory of the room,
+        # reading its segments may take a while, keep it off the event loop
+        if (log := self.message_log) is not None:
+
+            def read() -> List[bytes]:
+                """Read the messages from the log."""
+                if since is None:
+                    return [text for _, text in log.last(room, count)]
+                return [text for _, text in log.since(room, since, count)]
+
+            self.run_blocking(read, answer)
+        elif since is None:
+            answer([record.text for record in self.history.recent(room, count)])
+        else:
+            answer([record.text for record in self.history.since(room, since, count)])
 
-            if message == "{quit}":
-                self.remove_client(username)
-                break
-            elif message == "{who}":
-                self.tell_who(username)
+    def search(self, username: str, argument: str) -> None:
+        """Send a client a page of the messages holding some words."""
+        if self.search_index is None:
+            self.send_to(username, "Search is not enabled in this lair.")
+            return
+
+        terms = []
+        room = None
+        page = 1
+        for token in argument.split():
+            if token.startswith("page:") and token[5:].isdigit():
+                page = max(1, int(token[5:]))
+            elif token.startswith("#") and check_room(token) is None:
+                room = token
             else:
-                message = f"{timestamp()}\n{username}: {message}"
-                self.broadcast_to_all(message, username)
+                terms.append(token)
+        if not (words := split_words(" ".join(terms))):
+            self.send_to(username, "Usage: {search words} [#room] [page:N]")
+            return
+
+        def answer(result: Tuple[List[Tuple[float, str, str]], bool]) -> None:
+            """Send the page of results."""
+            found, more = result
+            query = " ".join(terms + ([room] if room else []))
+            if not found:
+                self.send_to(username, f"No messages found for {query}.")
+                return
+
+            header = f"Page {page} of the messages holding {query}"
+            if more:
+                header += f", {{search {query} page:{page + 1}}} for more"
+            lines = []
+            for when, found_room, text in found:
+                date = datetime.datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M")
+                if not text.startswith(found_room):
+                    text = f"{found_room} {text}"
+                lines.append(f"[{date}] {text}".encode("utf-8"))
+            self.send_lines(username, f"{header}:", lines)
+
+        # Looking up a common word may take a while, keep it off the event loop
+        self.run_blocking(
+            lambda: self.search_index.search(
+                words, room, (page - 1) * SEARCH_PAGE, SEARCH_PAGE
+            ),
+            answer,
+        )
+
+    def run_blocking(
+        self, work: Callable[[], Any], done: Callable[[Any], None]
+    ) -> None:
+        """Do slow work for a client, then pass its result to done.
+
+        Every client has a thread of its own here, so it simply waits.
+        """
+        done(work())
+
+    def send_lines(self, username: str, message: str, lines: List[bytes]) -> None:
+        """Send a client a message followed by lines of UTF-8 text.
+
+        It all goes out as one message, encrypted once, which legacy clients
+        also need to read it with a single recv.
+        """
+        if (session := self.connections.get(username)) is None:
+            return
+        lines = [message.encode("utf-8")] + lines
+
+        # Base64 makes legacy messages a third larger
+        if session.codec.mode == LEGACY:
+            while len(lines) > 1 and len(b"\n".join(lines)) * 4 // 3 + 64 >= (
+                self.buf_size / 4
+            ):
+                del lines[1]
+
+        self.send_to(username, b"\n".join(lines).decode("utf-8", "ignore"))
+
+    def join_room(self, username: str, room: str) -> bool:
+        """Add a client to a room and talk in it, False if already a member."""
+        if (session := self.connections.get(username)) is None:
+            return False
+        with self.rooms_lock:
+            members = self.rooms.setdefault(room, set())
+            joined = username not in members
+            members.add(username)
+            session.rooms.add(room)
+        session.room = room
+        return joined
+
+    def part_room(self, username: str, room: str) -> bool:
+        """Take a client out of a room, False if it wasn't a member."""
+        session = self.connections.get(username)
+        if session is None or room not in session.rooms:
+            return False
+        self.forget_member(username, room)
+        session.rooms.discard(room)
+
+        # Talk in another room, if there is one left
+        if session.room == room:
+            session.room = min(session.rooms, default=None)
+        return True
+
+    def forget_member(self, username: str, room: str) -> None:
+        """Remove a client from the index of a room, dropping empty rooms."""
+        with self.rooms_lock:
+            if (members := self.rooms.get(room)) is None:
+                return
+            members.discard(username)
+            if not members:
+                del self.rooms[room]
+                self.room_buckets.pop(room, None)
 
     def remove_client(self, username: str) -> None:
         """Remove a client connection."""
-        info = self.connections[username]
-        logging.info(f'{username} @ {info["address"]} has disconnected.')
-        self.broadcast_to_all(f"{username} has left the lair.", username)
-        del self.connections[username]
-
-    def tell_who(self, username: str) -> None:
-        """Send a list of connected username's to a client."""
-        sock = self.connections[username]["socket"]
-        for username, info in self.connections.items():
-            broadcast_to_client(f'{username} @ {info["address"][0]}', sock)
-            time.sleep(0.1)
+        if (session := self.connections.remove(username)) is None:
+            return
+        session.queue.close()
+        self.presence.unsubscribe(username)
+        for room in list(session.rooms):
+            self.forget_member(username, room)
+        if self.bus is not None:
+            self.bus.release(username)
+        if self.federation is not None:
+            self.federation.leave(username)
+        logging.info(f"{username} @ {session.address} has disconnected.")
+        before = AWAY if username in self.presence.away else HERE
+        message = f"{username} has left the lair."
+        presence = [username, session.address[0], before, GONE]
+        self.broadcast_to_all(message, username, presence=presence)
+
+    def tell_who(self, username: str, argument: str) -> None:
+        """Send a client a page of the dwellers of the lair or of a room."""
+        room = None
+        page = 1
+        for token in argument.split():
+            if token.startswith("page:") and token[5:].isdigit():
+                page = max(1, int(token[5:]))
+            elif token.startswith("#"):
+                if (error := check_room(token)) is not None:
+                    self.send_to(username, error)
+                    return
+                room = token
+            else:
+                self.send_to(username, "Usage: {who} or {who #room} [page:N]")
+                return
+
+        # The whole roster goes out a page at a time, one message per page
+        users = self.sorted_roster(room)
+        place = room or "the lair"
+        if not users:
+            self.send_to(username, f"Nobody is in {place}.")
+            return
+        if (session := self.connections.get(username)) is None:
+            return
+        size = WHO_PAGE
+        if session.codec.mode == LEGACY:
+            size = WHO_LEGACY_PAGE
+        pages = (len(users) + size - 1) // size
+        if page > pages:
+            self.send_to(username, f"The last page of {place} is page {pages}.")
+            return
+
+        header = f"{len(users)} dwellers in {place}, page {page} of {pages}"
+        if page < pages:
+            query = f"{room} page:{page + 1}" if room else f"page:{page + 1}"
+            header += f", {{who {query}}} for more"
+        away = self.presence.away
+        lines = [
+            f"{name} @ {host}{' (away)' if name in away else ''}".encode("utf-8")
+            for name, host in users[(page - 1) * size : page * size]
+        ]
+        self.send_lines(username, f"{header}:", lines)
+
+    def sorted_roster(self, room: Union[str, None]) -> List[Tuple[str, str]]:
+        """The roster sorted by username, kept until somebody logs in or out."""
+        if room is not None or self.bus is not None or self.federation is not None:
+            return sorted(self.roster(room))
+        version = self.connections.version
+        if self.roster_cache[0] != version:
+            self.roster_cache = (version, sorted(self.roster()))
+        return self.roster_cache[1]
+
+    def set_away(self, username: str, away: bool) -> None:
+        """Tell the others whether a client is around."""
+        if (session := self.connections.get(username)) is None:
+            return
+        if (username in self.presence.away) == away:
+            self.send_to(username, "You are away." if away else "You are not away.")
+            return
+        host = session.address[0]
+        before, after = (HERE, AWAY) if away else (AWAY, HERE)
+        self.broadcast_to_all("", presence=[username, host, before, after])
+        self.send_to(username, "You are away." if away else "Welcome back!")
+
+    def subscribe(self, username: str, argument: str) -> None:
+        """Start or stop telling a client who comes, goes or is away."""
+        if (session := self.connections.get(username)) is None:
+            return
+        if argument == "on":
+            if session.codec.mode == LEGACY:
+                self.send_to(username, "Presence updates need a framed client.")
+            elif self.presence.subscribe(username):
+                self.send_to(username, "Presence updates on, {who} for the roster.")
+            else:
+                self.send_to(username, "Presence updates are already on.")
+        elif argument == "off":
+            if self.presence.unsubscribe(username):
+                self.send_to(username, "Presence updates off.")
+            else:
+                self.send_to(username, "Presence updates are already off.")
+        else:
+            self.send_to(username, "Usage: {presence on} or {presence off}")
+
+    def roster(self, room: Union[str, None] = None) -> List[Tuple[str, str]]:
+        """Usernames and hosts of everybody in the lair, or in a room here."""
+        if room is not None:
+            return [
+                (session.username, session.address[0])
+                for session in self.members(room)
+            ]
+        if self.bus is not None:
+            users = self.bus.roster()
+        else:
+            users = [
+                (session.username, session.address[0])
+                for session in self.connections.sessions()
+            ]
+        if self.federation is not None:
+            users += self.federation.users()
+        return users
@@ -0,0 +1,112 @@
+"""Handshake.py
+
+The Lair: connections that haven't logged in yet.
+
+A new connection is read by the event loop of the server, without
+blocking, from its hello until it picks a name or resumes a session, so
+a crowd of connections that never get that far costs no threads.  Every
+step has a deadline, a client that doesn't say hello in time is greeted
+the legacy way, one that doesn't log in in time is dropped.  What the
+client sends first still tells whether it is a legacy one.  Every
+deadline of a step is as far from when the step began, so they come due
+in the order they were set and a queue per step keeps them sorted.
+"""
+
+import collections
+import time
+from typing import *
+
+from lairchat.net.Framing import WireCodec
+
+# Waiting for a framed client to say hello, then for a name
+HELLO = "hello"
+NAME = "name"
+
+
+class Handshake:
+    """A connection on its way to logging in."""
+
+    __slots__ = ("connection", "address", "codec", "step", "deadline", "resumable")
+
+    def __init__(
+        self, connection: Any, address: Tuple[str, int], codec: WireCodec
+    ) -> None:
+        """Initialize the handshake, waiting for a hello."""
+        self.connection = connection
+        self.address = address
+        self.codec = codec
+        self.step = HELLO
+        self.deadline = 0.0
+        self.resumable = False
+
+
+class Handshakes:
+    """The handshakes going on, at most limit of them, by connection."""
+
+    def __init__(self, limit: int, hello_timeout: float, timeout: float) -> None:
+        """Initialize with no handshakes."""
+        self.limit = limit
+        self.timeouts = {HELLO: hello_timeout, NAME: timeout}
+        self.pending: Dict[Any, Handshake] = {}
+        self.deadlines: Dict[str, Deque[Tuple[float, Handshake]]] = {
+            HELLO: collections.deque(),
+            NAME: collections.deque(),
+        }
+
+    def __len__(self) -> int:
+        """The number of handshakes going on."""
+        return len(self.pending)
+
+    def full(self) -> bool:
+        """Whether a new connection must be turned away."""
+        return len(self.pending) >= self.limit
+
+    def get(self, connection: Any) -> Union[Handshake, None]:
+        """The handshake of a connection, None once it is over."""
+        return self.pending.get(connection)
+
+    def add(
+        self, connection: Any, address: Tuple[str, int], codec: WireCodec
+    ) -> Handshake:
+        """Start the handshake of a new connection."""
+        handshake = Handshake(connection, address, codec)
+        self.pending[connection] = handshake
+        self.start(handshake, HELLO)
+        return handshake
+
+    def start(self, handshake: Handshake, step: str) -> None:
+        """Move a handshake on to a step, with a deadline of its own."""
+        handshake.step = step
+        handshake.deadline = time.monotonic() + self.timeouts[step]
+        self.deadlines[step].append((handshake.deadline, handshake))
+
+    def remove(self, connection: Any) -> Union[Handshake, None]:
+        """End the handshake of a connection, its deadline is forgotten."""
+        return self.pending.pop(connection, None)
+
+    def current(self, deadline: float, handshake: Handshake) -> bool:
+        """Whether a queued deadline is still the one of its handshake."""
+        return (
+            handshake.deadline == deadline
+            and self.pending.get(handshake.connection) is handshake
+        )
+
+    def next_deadline(self) -> Union[float, None]:
+        """When the next handshake is due, None if there are none."""
+        due = []
+        for deadlines in self.deadlines.values():
+            while deadlines and not self.current(*deadlines[0]):
+                deadlines.popleft()
+            if deadlines:
+                due.append(deadlines[0][0])
+        return min(due, default=None)
+
+    def expired(self, now: float) -> List[Handshake]:
+        """The handshakes due by now, still going on."""
+        handshakes = []
+        for deadlines in self.deadlines.values():
+            while deadlines and deadlines[0][0] <= now:
+                deadline, handshake = deadlines.popleft()
+                if self.current(deadline, handshake):
+                    handshakes.append(handshake)
+        return handshakes
@@ -0,0 +1,100 @@
+"""History.py
+
+The Lair: recent messages of every room, kept in memory.
+
+Every room has a ring buffer bounded both by a number of messages and by
+the bytes of text they hold; appending past either limit drops the oldest
+messages.  Records are slotted objects holding the time and the UTF-8
+text as it was broadcast, so replaying them needs no formatting.
+
+Anybody can name a new room, so only so many rooms are remembered; the
+history of the room least recently talked in or asked about is dropped
+to make room for another.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import *
+
+
+class HistoryRecord:
+    """A message broadcast to a room."""
+
+    __slots__ = ("time", "text")
+
+    def __init__(self, time: float, text: bytes) -> None:
+        """Initialize the record."""
+        self.time = time
+        self.text = text
+
+
+class RoomHistory:
+    """A ring buffer of the recent messages of a room."""
+
+    __slots__ = ("records", "max_count", "max_bytes", "size")
+
+    def __init__(self, max_count: int, max_bytes: int) -> None:
+        """Initialize the buffer."""
+        self.records: Deque[HistoryRecord] = deque()
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.size = 0
+
+    def append(self, record: HistoryRecord) -> None:
+        """Add a record, dropping the oldest ones beyond the limits."""
+        records = self.records
+        records.append(record)
+        self.size += len(record.text)
+        while len(records) > self.max_count or self.size > self.max_bytes:
+            self.size -= len(records.popleft().text)
+
+    def recent(self, count: int) -> List[HistoryRecord]:
+        """The last count records, oldest first."""
+        records = self.records
+        count = min(count, len(records))
+        return [records[i] for i in range(len(records) - count, len(records))]
+
+
+class History:
+    """The recent messages of every room."""
+
+    def __init__(self, max_count: int, max_bytes: int, max_rooms: int) -> None:
+        """Initialize the history, max_count of zero keeps nothing."""
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_rooms = max_rooms
+        self.rooms: OrderedDict[str, RoomHistory] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def append(self, room: str, text: str) -> None:
+        """Remember a message broadcast to a room."""
+        if self.max_count <= 0:
+            return
+        with self.lock:
+            if (history := self.find(room)) is None:
+                history = self.rooms[room] = RoomHistory(self.max_count, self.max_bytes)
+                while len(self.rooms) > self.max_rooms:
+                    self.rooms.popitem(last=False)
+            history.append(HistoryRecord(time.time(), text.encode("utf-8")))
+
+    def find(self, room: str) -> Union[RoomHistory, None]:
+        """The history of a room as the most recently used, the lock is held."""
+        if (history := self.rooms.get(room)) is not None:
+            self.rooms.move_to_end(room)
+        return history
+
+    def recent(self, room: str, count: int) -> List[HistoryRecord]:
+        """The last count messages of a room, oldest first."""
+        with self.lock:
+            if (history := self.find(room)) is None:
+                return []
+            return history.recent(count)
+
+    def since(self, room: str, since: float, count: int) -> List[HistoryRecord]:
+        """Up to count messages of a room from since on, oldest first."""
+        with self.lock:
+            if (history := self.find(room)) is None:
+                return []
+            records = [record for record in history.records if record.time >= since]
+            return records[:count]
@@ -0,0 +1,179 @@
+"""LogPipeline.py
+
+The Lair: logging that stays off the paths serving clients.
+
+Threads logging a record only put it on a queue; a single background
+thread formats it and writes it to the log file and the terminal.  The
+same message logged from the same place more than burst times per
+interval seconds, like a send error repeated for every client of a
+broken network, has the rest of its records dropped before they are
+queued, and the next one that gets through says how many were.  The
+level can be changed while the lair runs, from the admin console.
+
+Nothing is set up on import, the program entry point calls configure.
+Forked processes, like the workers of a sharded server, start a writer
+thread of their own.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from typing import *
+
+# Where the log is written by default
+LOG_FILE = os.path.join(os.path.expanduser("~"), ".lair.log")
+
+LOG_FORMAT = "%(asctime)-15s [%(threadName)-12s][%(levelname)-8s]  %(message)s"
+
+# Level names accepted on the command line and the admin console
+LEVELS = ["debug", "info", "warning", "error", "critical"]
+
+# Messages remembered by the sampling filter before old ones are forgotten
+SAMPLED_MESSAGES = 4096
+
+
+class SamplingFilter(logging.Filter):
+    """Let a burst of every message from a place through every interval."""
+
+    def __init__(self, burst: int, interval: float) -> None:
+        """Initialize the filter, a burst of zero lets everything through."""
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.sites: Dict[Tuple[str, int, Any], List[Any]] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Drop a record if its message has used up its burst."""
+        if self.burst <= 0 or record.levelno >= logging.CRITICAL:
+            return True
+
+        # A site is the time its interval started, records passed and dropped
+        key = (record.pathname, record.lineno, record.msg)
+        with self.lock:
+            if len(self.sites) >= SAMPLED_MESSAGES:
+                self.forget(record.created)
+            site = self.sites.get(key)
+            if site is None or record.created - site[0] >= self.interval:
+                dropped = site[2] if site is not None else 0
+                self.sites[key] = [record.created, 1, 0]
+            elif site[1] < self.burst:
+                site[1] += 1
+                dropped = 0
+            else:
+                site[2] += 1
+                return False
+
+        if dropped:
+            record.msg = f"{record.getMessage()} ({dropped} more like it dropped)"
+            record.args = None
+        return True
+
+    def forget(self, now: float) -> None:
+        """Forget the messages whose interval is over, the lock is held.
+
+        If they are all recent, that many different messages aren't a
+        flood of one message, forget them all.
+        """
+        self.sites = {
+            key: site
+            for key, site in self.sites.items()
+            if now - site[0] < self.interval
+        }
+        if len(self.sites) >= SAMPLED_MESSAGES // 2:
+            self.sites = {}
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Queue records for a writer thread in the same process."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Leave formatting to the writer thread."""
+        return record
+
+
+class LogPipeline:
+    """The root logger writing through a queue from a background thread."""
+
+    def __init__(
+        self,
+        level: str = "info",
+        path: Union[str, None] = LOG_FILE,
+        console: bool = True,
+        burst: int = 20,
+        interval: float = 1.0,
+    ) -> None:
+        """Send every record logged to the writer thread."""
+        formatter = logging.Formatter(LOG_FORMAT)
+        self.handlers: List[logging.Handler] = []
+        if path:
+            self.handlers.append(logging.FileHandler(path))
+        if console:
+            self.handlers.append(logging.StreamHandler())
+        for handler in self.handlers:
+            handler.setFormatter(formatter)
+
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.handler = LocalQueueHandler(self.queue)
+        self.handler.addFilter(SamplingFilter(burst, interval))
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        set_log_level(level)
+
+        self.listener.start()
+        self.running = True
+        atexit.register(self.stop)
+        os.register_at_fork(after_in_child=self.forked)
+
+    def forked(self) -> None:
+        """The writer thread didn't survive a fork, start another one."""
+        self.queue = queue.SimpleQueue()
+        self.handler.queue = self.queue
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers)
+        self.listener.start()
+
+        # Worker processes skip atexit, multiprocessing finalizers still run.
+        # Only processes forked by multiprocessing load it, and already have.
+        import multiprocessing.util
+
+        multiprocessing.util.Finalize(self, self.stop, exitpriority=10)
+
+    def stop(self) -> None:
+        """Write what is queued and stop the writer thread."""
+        if not self.running:
+            return
+        self.running = False
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+def configure(
+    level: str = "info",
+    path: Union[str, None] = LOG_FILE,
+    console: bool = True,
+    burst: int = 20,
+    interval: float = 1.0,
+) -> LogPipeline:
+    """Log through a background writer, called once by the entry point."""
+    return LogPipeline(level, path, console, burst, interval)
+
+
+def set_log_level(level: str) -> bool:
+    """Change the level of every logger of the lair, False if unknown."""
+    if level not in LEVELS:
+        return False
+    logging.getLogger().setLevel(level.upper())
+    return True
+
+
+def log_level() -> str:
+    """The level the lair is logging at."""
+    return logging.getLevelName(logging.getLogger().level).lower()
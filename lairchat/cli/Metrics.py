@@ -0,0 +1,243 @@
+"""Metrics.py
+
+The Lair: counters and histograms describing a running chat server.
+
+Updating a metric is a couple of attribute writes without locks, cheap
+enough for the receive and broadcast paths.  Threads updating the same
+counter at the same moment may rarely lose an increment, which doesn't
+matter for monitoring.  Gauges are read through callbacks only when the
+metrics are rendered, either for the stats admin command or as
+Prometheus text served over HTTP.
+"""
+
+import bisect
+import http.server
+import logging
+import threading
+import time
+from typing import *
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (
+    0.000001,
+    0.0000025,
+    0.000005,
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+class Counter:
+    """A value that only goes up."""
+
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name: str, help: str) -> None:
+        """Initialize the counter."""
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        """Add to the counter."""
+        self.value += amount
+
+    def render(self) -> List[str]:
+        """Prometheus text lines for the counter."""
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Histogram:
+    """Durations counted in fixed buckets."""
+
+    __slots__ = ("name", "help", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str, bounds: Sequence[float] = BUCKETS) -> None:
+        """Initialize the histogram."""
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Count a duration."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        """Prometheus text lines for the histogram."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def summary(self) -> str:
+        """A line for people."""
+        mean = self.sum / self.count if self.count else 0.0
+        return (
+            f"{self.count} observed, mean {mean * 1e6:.1f} us,"
+            f" p50 <= {self.quantile(0.5) * 1e6:.1f} us,"
+            f" p99 <= {self.quantile(0.99) * 1e6:.1f} us"
+        )
+
+
+class Metrics:
+    """All the metrics of a chat server."""
+
+    def __init__(self) -> None:
+        """Create the metrics."""
+        self.started = time.monotonic()
+        self.accepts = Counter("lair_accepts_total", "Connections accepted.")
+        self.rejected = Counter(
+            "lair_handshakes_rejected_total",
+            "Connections turned away with too many logging in.",
+        )
+        self.timed_out = Counter(
+            "lair_handshakes_timed_out_total", "Connections that didn't log in in time."
+        )
+        self.pings = Counter("lair_pings_total", "Heartbeats sent to quiet clients.")
+        self.evicted = Counter(
+            "lair_idle_evictions_total", "Clients disconnected for staying quiet."
+        )
+        self.throttled = Counter(
+            "lair_throttled_total", "Times a client was paused for sending too fast."
+        )
+        self.messages_in = Counter("lair_messages_in_total", "Messages received.")
+        self.bytes_in = Counter("lair_bytes_in_total", "Bytes received.")
+        self.messages_out = Counter("lair_messages_out_total", "Messages queued.")
+        self.bytes_out = Counter("lair_bytes_out_total", "Bytes queued.")
+        self.decrypt = Histogram(
+            "lair_decrypt_seconds", "Time to decode and decrypt a read."
+        )
+        self.encrypt = Histogram("lair_encrypt_seconds", "Time to encrypt a message.")
+        self.broadcast = Histogram(
+            "lair_broadcast_seconds", "Time to fan a message out to its recipients."
+        )
+        self.gauges: List[Tuple[str, str, str, Callable[[], Dict[str, float]]]] = []
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], Dict[str, float]],
+        label: str = "",
+    ) -> None:
+        """Add a gauge read when rendered, with a value per label if labelled.
+
+        Unlabelled gauges return their value under the empty label.
+        """
+        self.gauges.append((name, help, label, read))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text format."""
+        lines = []
+        for metric in (
+            self.accepts,
+            self.rejected,
+            self.timed_out,
+            self.pings,
+            self.evicted,
+            self.throttled,
+            self.messages_in,
+            self.bytes_in,
+            self.messages_out,
+            self.bytes_out,
+            self.decrypt,
+            self.encrypt,
+            self.broadcast,
+        ):
+            lines += metric.render()
+
+        for name, help, label, read in self.gauges:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            for key, value in read().items():
+                if label:
+                    key = key.replace("\\", "\\\\").replace('"', '\\"')
+                    lines.append(f'{name}{{{label}="{key}"}} {value}')
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Lines for people, as shown by the stats admin command."""
+        uptime = time.monotonic() - self.started
+        return [
+            f"uptime: {uptime:.0f} s,"
+            f" {self.accepts.value} accepts ({self.accepts.value / uptime:.2f}/sec)",
+            f"handshakes: {self.rejected.value} rejected,"
+            f" {self.timed_out.value} timed out",
+            f"heartbeats: {self.pings.value} pings,"
+            f" {self.evicted.value} idle clients evicted",
+            f"in: {self.messages_in.value} messages, {self.bytes_in.value} B,"
+            f" {self.throttled.value} pauses for sending too fast",
+            f"out: {self.messages_out.value} messages, {self.bytes_out.value} B",
+            f"decrypt: {self.decrypt.summary()}",
+            f"encrypt: {self.encrypt.summary()}",
+            f"broadcast: {self.broadcast.summary()}",
+        ]
+
+    def serve(self, host: str, port: int) -> http.server.HTTPServer:
+        """Serve the metrics over HTTP from a daemon thread."""
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            """Answer scrapes of /metrics."""
+
+            def do_GET(self) -> None:
+                """Send the metrics."""
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                """Keep scrapes out of the log."""
+
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(
+            target=server.serve_forever, name="metrics", daemon=True
+        ).start()
+        logging.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+        return server
@@ -0,0 +1,89 @@
+"""Presence.py
+
+The Lair: who is in the lair, told as it changes.
+
+Clients that ask for presence updates are sent the changes since the
+last update instead of polling {who}.  Changes are gathered for a short
+window and only the net change of each dweller goes out, so somebody
+who logs in and straight out again is never mentioned.  An update is a
+single message, a {presence} line followed by a line per dweller:
+
+    +name host    is here
+    ~name host    is away
+    -name         has left
+
+Away dwellers are known across shards and servers, since their changes
+travel with the broadcasts that announce them.
+"""
+
+import threading
+from typing import *
+
+# The states of a dweller
+HERE = "+"
+AWAY = "~"
+GONE = "-"
+
+# First line of a presence update
+PRESENCE = "{presence}"
+
+
+class Presence:
+    """Subscribers to presence updates and the changes waiting for them."""
+
+    def __init__(self, window: float) -> None:
+        """Initialize presence, changes are gathered for window seconds."""
+        self.window = window
+        self.subscribers: Set[str] = set()
+        self.away: Set[str] = set()
+        self.pending: Dict[str, Tuple[str, str, str]] = {}
+        self.lock = threading.Lock()
+        self.version = 0
+
+    def subscribe(self, username: str) -> bool:
+        """Send updates to a client, False if it already gets them."""
+        with self.lock:
+            if username in self.subscribers:
+                return False
+            self.subscribers.add(username)
+        return True
+
+    def unsubscribe(self, username: str) -> bool:
+        """Stop sending updates to a client, False if it didn't get them."""
+        with self.lock:
+            if username not in self.subscribers:
+                return False
+            self.subscribers.discard(username)
+        return True
+
+    def change(self, name: str, host: str, before: str, after: str) -> bool:
+        """Record a change of a dweller, True if a window has to be started."""
+        with self.lock:
+            self.version += 1
+            if after == AWAY:
+                self.away.add(name)
+            else:
+                self.away.discard(name)
+            if not self.subscribers:
+                return False
+
+            # Keep the state the window started with and the latest one
+            started = not self.pending
+            if (known := self.pending.get(name)) is not None:
+                before = known[0]
+            self.pending[name] = (before, after, host)
+        return started
+
+    def take(self) -> Tuple[Union[str, None], List[str]]:
+        """The update for the window that ended and who to send it to."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            subscribers = list(self.subscribers)
+        lines = [PRESENCE]
+        for name, (before, after, host) in pending.items():
+            if before == after:
+                continue
+            lines.append(f"{after}{name}" if after == GONE else f"{after}{name} {host}")
+        if len(lines) == 1 or not subscribers:
+            return None, []
+        return "\n".join(lines), subscribers
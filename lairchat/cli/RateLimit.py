@@ -0,0 +1,34 @@
+"""RateLimit.py
+
+The Lair: keeping a flood from one client off everybody else.
+
+Every client, and every room, can have a token bucket filled at rate
+tokens a second up to burst tokens.  A message takes a token from the
+bucket of its client and, for chat lines, of the room it goes to.  A
+client whose buckets are empty isn't read from until they refill, so
+what it sends waits in its socket and then in its own send buffer,
+instead of being decrypted and fanned out to the room.
+"""
+
+
+class TokenBucket:
+    """Tokens filled at a steady rate, up to a burst."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int, now: float) -> None:
+        """Initialize a full bucket."""
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = now
+
+    def wait(self, now: float) -> float:
+        """Seconds until there is a token, 0 if there is one now."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        """Take a token, there must be one."""
+        self.tokens -= 1
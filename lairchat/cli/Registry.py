@@ -0,0 +1,141 @@
+"""Registry.py
+
+The Lair: the clients logged in to a server.
+
+Client threads log in and out while others broadcast, so every change
+goes through a lock and readers never iterate the live tables.  They
+iterate a snapshot instead, an immutable tuple of sessions rebuilt at
+most once per change, the first time somebody asks for it after one.
+Broadcasts between logins and logouts share the same tuple without
+taking the lock at all.  Sessions are slotted objects found by username
+or by socket in constant time.
+"""
+
+import threading
+import time
+from typing import *
+
+from lairchat.cli.RateLimit import TokenBucket
+
+
+class Session:
+    """A client logged in under a username."""
+
+    __slots__ = (
+        "username",
+        "socket",
+        "address",
+        "codec",
+        "queue",
+        "rooms",
+        "room",
+        "token",
+        "sent",
+        "lost",
+        "seen",
+        "bucket",
+    )
+
+    def __init__(
+        self,
+        username: str,
+        socket: Any,
+        address: Tuple[str, int],
+        codec: Any,
+        queue: Any,
+    ) -> None:
+        """Initialize the session, the client is in no room yet.
+
+        Clients that can resume have a token, the messages they were sent
+        that they haven't acknowledged, and the sequence number of the
+        last one forgotten before it was.  The server last heard from the
+        client when it was seen, and takes a token from its bucket for
+        every message if it is rate limited.
+        """
+        self.username = username
+        self.socket = socket
+        self.address = address
+        self.codec = codec
+        self.queue = queue
+        self.rooms: Set[str] = set()
+        self.room: Union[str, None] = None
+        self.token: Union[str, None] = None
+        self.sent: Union[Deque[Tuple[int, str]], None] = None
+        self.lost = 0
+        self.seen = time.monotonic()
+        self.bucket: Union[TokenBucket, None] = None
+
+
+class Registry:
+    """Sessions by username and by socket, with snapshots to iterate."""
+
+    def __init__(self) -> None:
+        """Initialize an empty registry."""
+        self.by_name: Dict[str, Session] = {}
+        self.by_socket: Dict[Any, Session] = {}
+        self.lock = threading.Lock()
+        self.version = 0
+        self.snapshot: Union[Tuple[Session, ...], None] = ()
+
+    def __len__(self) -> int:
+        """The number of sessions."""
+        return len(self.by_name)
+
+    def __contains__(self, username: str) -> bool:
+        """Whether a client is logged in under a username."""
+        return username in self.by_name
+
+    def add(self, session: Session) -> bool:
+        """Register a session, False if its username is taken."""
+        with self.lock:
+            if session.username in self.by_name:
+                return False
+            self.by_name[session.username] = session
+            self.by_socket[session.socket] = session
+            self.changed()
+        return True
+
+    def remove(self, username: str) -> Union[Session, None]:
+        """Unregister the session of a username, if it has one."""
+        with self.lock:
+            if (session := self.by_name.pop(username, None)) is None:
+                return None
+            if self.by_socket.get(session.socket) is session:
+                del self.by_socket[session.socket]
+            self.changed()
+        return session
+
+    def rebind(self, session: Session, socket: Any) -> None:
+        """Find a session by the socket of the connection it resumed on."""
+        with self.lock:
+            if self.by_socket.get(session.socket) is session:
+                del self.by_socket[session.socket]
+            session.socket = socket
+            self.by_socket[socket] = session
+            self.changed()
+
+    def changed(self) -> None:
+        """Drop the snapshot, the lock is held."""
+        self.version += 1
+        self.snapshot = None
+
+    def get(self, username: str) -> Union[Session, None]:
+        """The session of a username."""
+        return self.by_name.get(username)
+
+    def find(self, socket: Any) -> Union[Session, None]:
+        """The session of a socket."""
+        return self.by_socket.get(socket)
+
+    def sessions(self) -> Tuple[Session, ...]:
+        """Every session at this moment, safe to iterate while others change."""
+        if (snapshot := self.snapshot) is not None:
+            return snapshot
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = tuple(self.by_name.values())
+            return self.snapshot
+
+    def names(self) -> List[str]:
+        """Every username at this moment."""
+        return [session.username for session in self.sessions()]
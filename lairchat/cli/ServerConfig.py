@@ -0,0 +1,96 @@
+"""ServerConfig.py
+
+The Lair: tunable settings shared by the chat server engines.
+"""
+
+from dataclasses import dataclass, field
+from typing import *
+
+from lairchat.net.OutboundQueue import DISCONNECT
+
+
+@dataclass
+class ServerConfig:
+    """Settings for a chat server, the defaults suit a small lair."""
+
+    # Outbound queue watermarks in bytes and what to do with slow clients
+    queue_high_water: int = 1024 * 1024
+    queue_low_water: int = 256 * 1024
+    slow_policy: str = DISCONNECT
+
+    # Coalesce queued frames for this many seconds or bytes, 0 sends at once
+    flush_interval: float = 0.0
+    flush_bytes: int = 64 * 1024
+
+    # Let several processes listen on the same port
+    reuse_port: bool = False
+
+    # Connections the kernel queues for accepting, and accepted per wakeup
+    listen_backlog: int = 1024
+    accept_batch: int = 64
+
+    # Connections logging in at once, and seconds they are given to log in
+    max_handshakes: int = 1024
+    handshake_timeout: float = 30.0
+
+    # Listen for peer servers on link_port and link up with the peers, the
+    # links sealed with link_secret which every peer must share
+    link_port: Union[int, None] = None
+    peers: List[Tuple[str, int]] = field(default_factory=list)
+    link_secret: Union[str, None] = None
+
+    # Recent messages kept per room, and how many a client is sent on joining,
+    # for up to history_rooms rooms, the least recently used are forgotten
+    history_lines: int = 100
+    history_bytes: int = 64 * 1024
+    history_replay: int = 20
+    history_rooms: int = 1024
+
+    # Keep the history of every room on disk in history_dir, None for memory only
+    history_dir: Union[str, None] = None
+    history_segment_bytes: int = 16 * 1024 * 1024
+    history_segment_age: float = 24 * 60 * 60
+    history_retain_bytes: int = 1024 * 1024 * 1024
+    history_retain_age: float = 30 * 24 * 60 * 60
+
+    # Gather messages this many seconds into each fsync of the log, and keep
+    # the logs of this many rooms open
+    history_commit_interval: float = 0.005
+    history_open_rooms: int = 128
+
+    # Index room messages for {search} in search_dir, None for no search
+    search_dir: Union[str, None] = None
+    search_flush: int = 100000
+
+    # Keep whispers for dwellers who are away, spilling large mailboxes to
+    # mailbox_dir, or only up to mailbox_memory bytes each without one
+    mailbox_dir: Union[str, None] = None
+    mailbox_memory: int = 4096
+    mailbox_cap: int = 1024 * 1024
+    mailbox_ttl: float = 7 * 24 * 60 * 60
+
+    # Ping framed clients quiet this many seconds and disconnect those quiet
+    # for idle_timeout, 0 for neither
+    heartbeat_interval: float = 30.0
+    idle_timeout: float = 90.0
+
+    # Messages a second a client may send, and a room may be sent, in bursts
+    # of up to so many, 0 for no limit.  Clients over a limit are paused
+    client_rate: float = 0.0
+    client_burst: int = 20
+    room_rate: float = 0.0
+    room_burst: int = 100
+
+    # Gather presence changes this many seconds into each update
+    presence_window: float = 0.5
+
+    # Keep this many unacknowledged messages for clients with a session, and
+    # their session this many seconds after their connection drops, 0 for none
+    resume_messages: int = 1000
+    resume_grace: float = 30.0
+
+    # Offer framed clients to compress messages with deflate
+    compress: bool = False
+
+    # Serve Prometheus metrics on this local port, None for no endpoint
+    metrics_port: Union[int, None] = None
@@ -0,0 +1,116 @@
+"""ShardedServer.py
+
+The Lair: run a chat server engine in several worker processes.
+
+The workers all listen on the same port with SO_REUSEPORT so the kernel
+spreads new connections between them, and every worker owns the clients
+it accepted.  The parent process runs the ShardHub that relays broadcasts
+between workers and keeps the lair-wide roster and mailboxes, and the
+admin console.
+"""
+
+import dataclasses
+import logging
+import multiprocessing
+import os
+import sys
+from socket import *
+from typing import *
+
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.ShardBus import ShardHub
+from lairchat.store.Mailboxes import Mailboxes
+
+
+class ShardedServer:
+    """A chat room server spread over several processes."""
+
+    def __init__(
+        self,
+        engine: Type[ChatServer],
+        host: str,
+        port: int,
+        workers: int,
+        admin_console: bool = True,
+        config: Union[ServerConfig, None] = None,
+    ) -> None:
+        """Initialize the sharded server."""
+        self.engine = engine
+        self.workers = workers
+        self.admin_console = admin_console
+        self.config = dataclasses.replace(config or ServerConfig(), reuse_port=True)
+
+        # Mail waits in the hub, whichever shard its dweller comes back to
+        try:
+            mailboxes = Mailboxes(
+                self.config.mailbox_dir,
+                self.config.mailbox_memory,
+                self.config.mailbox_cap,
+                self.config.mailbox_ttl,
+            )
+        except OSError as e:
+            logging.critical(f"Error: {e}")
+            sys.exit(1)
+        self.hub = ShardHub(workers, mailboxes)
+
+        # Hold on to the port so every worker binds the same one, even port 0
+        try:
+            self.server = socket(AF_INET, SOCK_STREAM)
+            self.server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            self.server.bind((host, port))
+        except OSError as e:
+            logging.critical(f"Error: {e}")
+            sys.exit(1)
+        self.address = self.server.getsockname()
+
+    def run(self) -> None:
+        """Start the workers and relay between them until they have exited."""
+        logging.info(f"Starting {self.workers} workers on {self.address}")
+
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(
+                target=self.run_worker, args=(shard,), name=f"shard-{shard}"
+            )
+            for shard in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        self.hub.forked()
+
+        self.hub.run(self.admin_console)
+
+        for process in processes:
+            process.join()
+        self.server.close()
+
+        logging.info("All workers exited")
+
+    def run_worker(self, shard: int) -> None:
+        """Serve the clients of one shard."""
+        config = self.config
+
+        # Every shard serves its own metrics, on consecutive ports
+        if config.metrics_port:
+            config = dataclasses.replace(
+                config, metrics_port=config.metrics_port + shard
+            )
+
+        # Every shard hears every room message, and keeps its own log of them
+        if config.history_dir is not None:
+            config = dataclasses.replace(
+                config, history_dir=os.path.join(config.history_dir, f"shard{shard}")
+            )
+        if config.search_dir is not None:
+            config = dataclasses.replace(
+                config, search_dir=os.path.join(config.search_dir, f"shard{shard}")
+            )
+
+        # Mail is kept by the hub, the mailboxes of a shard are never used
+        config = dataclasses.replace(config, mailbox_dir=None)
+
+        server = self.engine(*self.address, admin_console=False, config=config)
+        server.attach_bus(self.hub.worker_bus(shard))
+        server.run()
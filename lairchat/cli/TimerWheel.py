@@ -0,0 +1,73 @@
+"""TimerWheel.py
+
+The Lair: timers for a great many clients at once.
+
+A hashed timer wheel keeps timers in a ring of slots, one slot per tick.
+Setting a timer appends it to the slot its tick falls in, and every tick
+the wheel turns one slot on and takes out whatever is due there, so both
+cost the same however many timers are set.  Timers further off than a
+turn of the wheel wait in their slot for the turns in between.
+
+Timers are never cancelled, whoever set one checks whether it still
+matters once it is due, which is cheaper than finding it in its slot.
+The wheel is only turned by the event loop of a server, other threads
+set timers on it under a lock of the server.
+"""
+
+import math
+from typing import *
+
+# Seconds per slot, and slots in the ring
+TICK = 1.0
+SLOTS = 512
+
+
+class TimerWheel:
+    """Items due after a delay, to the tick."""
+
+    def __init__(self, now: float, tick: float = TICK, slots: int = SLOTS) -> None:
+        """Initialize an empty wheel starting at now."""
+        self.tick = tick
+        self.slots: List[List[Tuple[int, Any]]] = [[] for _ in range(slots)]
+        self.current = int(now / tick)
+        self.count = 0
+
+    def __len__(self) -> int:
+        """The number of timers set."""
+        return self.count
+
+    def schedule(self, delay: float, item: Any, now: Union[float, None] = None) -> None:
+        """Set a timer for item, due delay seconds after now or the current tick.
+
+        Given now a timer is never due early, however long ago the wheel
+        last turned.
+        """
+        if now is None:
+            due = self.current + max(1, math.ceil(delay / self.tick))
+        else:
+            due = max(self.current + 1, math.ceil((now + delay) / self.tick))
+        self.slots[due % len(self.slots)].append((due, item))
+        self.count += 1
+
+    def next_tick(self) -> Union[float, None]:
+        """When the wheel turns next, None if no timers are set."""
+        return (self.current + 1) * self.tick if self.count else None
+
+    def advance(self, now: float) -> List[Any]:
+        """Turn the wheel up to now, the items of every timer due."""
+        target = int(now / self.tick)
+        if target <= self.current:
+            return []
+
+        # After a long pause every slot is looked at, once
+        due_items = []
+        last = min(target, self.current + len(self.slots))
+        for tick in range(self.current + 1, last + 1):
+            index = tick % len(self.slots)
+            if not (slot := self.slots[index]):
+                continue
+            due_items += [item for due, item in slot if due <= target]
+            self.slots[index] = [(due, item) for due, item in slot if due > target]
+        self.current = target
+        self.count -= len(due_items)
+        return due_items
@@ -6,21 +6,12 @@ AES Cipher class for encrypting and decrypting string data.
 import base64
 import hashlib
 import logging
-import os
+from typing import *
 
 from Cryptodome.Cipher import AES
 from Cryptodome.Random import get_random_bytes
 from Cryptodome.Util.Padding import pad, unpad
 
-logfilename = os.path.join(os.path.expanduser("~"), ".lair.log")
-
-# Enable logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)-15s [%(threadName)-12s]" + "[%(levelname)-8s]  %(message)s",
-    handlers=[logging.FileHandler(logfilename), logging.StreamHandler()],
-)
-
 
 def catch_value_error_exception(func):
     """Catch common exceptions."""
@@ -40,25 +31,44 @@ def catch_value_error_exception(func):
 class AESCipher:
     """Implement AES Cipher Block Chaining encryption and decryption."""
 
-    def __init__(self, key: str) -> None:
-        """Make a fixed sha256 bit length key."""
-        self.key = hashlib.sha256(key.encode("utf-8")).digest()
+    def __init__(self, secret: str) -> None:
+        """Keep the secret, the key is derived from it when first needed."""
+        self.secret = secret
+        self.derived_key: Union[bytes, None] = None
+
+    @property
+    def key(self) -> bytes:
+        """A fixed sha256 bit length key."""
+        if self.derived_key is None:
+            self.derived_key = hashlib.sha256(self.secret.encode("utf-8")).digest()
+        return self.derived_key
 
     @catch_value_error_exception
     def encrypt(self, rawdata: str) -> bytes:
         """Encrypt raw data."""
+        if (encrypted := self.encrypt_raw(rawdata)) is None:
+            return None
+        return base64.b64encode(encrypted)
+
+    @catch_value_error_exception
+    def decrypt(self, encdata: bytes) -> bytes:
+        """Decrypt encoded data."""
+        return self.decrypt_raw(base64.b64decode(encdata))
+
+    @catch_value_error_exception
+    def encrypt_raw(self, rawdata: str) -> bytes:
+        """Encrypt raw data without base64 encoding the result."""
         raw_data = pad(rawdata.encode("utf-8"), AES.block_size)
         iv = get_random_bytes(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return base64.b64encode(iv + cipher.encrypt(raw_data))
+        return iv + cipher.encrypt(raw_data)
 
     @catch_value_error_exception
-    def decrypt(self, encdata: bytes) -> bytes:
-        """Decrypt encoded data."""
-        enc_data = base64.b64decode(encdata)
-        iv = enc_data[: AES.block_size]
+    def decrypt_raw(self, encdata: bytes) -> bytes:
+        """Decrypt data that is not base64 encoded."""
+        iv = encdata[: AES.block_size]
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return unpad(cipher.decrypt(enc_data[AES.block_size :]), AES.block_size)
+        return unpad(cipher.decrypt(encdata[AES.block_size :]), AES.block_size)
 
 
 # Create an AESCipher object
@@ -0,0 +1,185 @@
+"""Ciphers.py
+
+Pluggable session ciphers over raw bytes for the framed wire protocol.
+
+Every sealed payload starts with the id of the cipher suite that sealed
+it, so a peer can open whatever suite it receives.  AES-GCM and
+ChaCha20-Poly1305 authenticate each message instead of relying on
+padding errors the way AES-CBC does.
+
+pycryptodomex doesn't let a cipher object be reused with a new nonce, so
+the per-session work that can be cached is: the derived key, a random
+nonce prefix combined with a message counter instead of fresh random
+bytes per message, and the output buffer, which is allocated once per
+message with room for the frame header and filled in place.
+"""
+
+import hashlib
+import logging
+import struct
+from typing import *
+
+from Cryptodome.Cipher import AES, ChaCha20_Poly1305
+from Cryptodome.Random import get_random_bytes
+from Cryptodome.Util.Padding import pad, unpad
+
+from lairchat.crypto.AESCipher import aes_cipher
+from lairchat.crypto.Suites import CBC, CHACHA20, GCM
+
+NONCE = struct.Struct("!8sI")
+
+
+class SessionCipher:
+    """Seal and open messages with one cipher suite for a session."""
+
+    suite = 0
+    name = ""
+
+    def __init__(self, key: bytes) -> None:
+        """Initialize the session."""
+        self.key = key
+
+    def seal(self, data: bytes, headroom: int = 0) -> bytearray:
+        """Encrypt data, leaving headroom bytes free at the start for a header."""
+        raise NotImplementedError
+
+    def open(self, payload: bytes) -> Union[bytes, None]:
+        """Decrypt a sealed payload, None if it is not authentic."""
+        raise NotImplementedError
+
+
+class CBCCipher(SessionCipher):
+    """AES-CBC, the cipher legacy clients speak, without base64."""
+
+    suite = CBC
+    name = "cbc"
+
+    def seal(self, data: bytes, headroom: int = 0) -> bytearray:
+        """Encrypt data, leaving headroom bytes free at the start for a header."""
+        padded = pad(data, AES.block_size)
+        iv = get_random_bytes(AES.block_size)
+
+        out = bytearray(headroom + 1 + AES.block_size + len(padded))
+        view = memoryview(out)
+        out[headroom] = self.suite
+        view[headroom + 1 : headroom + 1 + AES.block_size] = iv
+        cipher = AES.new(self.key, AES.MODE_CBC, iv)
+        cipher.encrypt(padded, output=view[headroom + 1 + AES.block_size :])
+        return out
+
+    def open(self, payload: bytes) -> Union[bytes, None]:
+        """Decrypt a sealed payload, None if it is not authentic."""
+        try:
+            iv = payload[1 : 1 + AES.block_size]
+            cipher = AES.new(self.key, AES.MODE_CBC, iv)
+            data = cipher.decrypt(payload[1 + AES.block_size :])
+            return unpad(data, AES.block_size)
+        except ValueError as e:
+            logging.info(f"Cipher error: {e}")
+            return None
+
+
+class AEADCipher(SessionCipher):
+    """An authenticated cipher using counter based 12 byte nonces."""
+
+    tag_size = 16
+
+    def __init__(self, key: bytes) -> None:
+        """Initialize the session with a random nonce prefix."""
+        super().__init__(key)
+        self.prefix = get_random_bytes(8)
+        self.counter = 0
+
+    def new(self, nonce: bytes) -> Any:
+        """Create a cipher object for a nonce."""
+        raise NotImplementedError
+
+    def next_nonce(self) -> bytes:
+        """Return a nonce never used with this key before."""
+        self.counter += 1
+        if self.counter > 0xFFFFFFFF:
+            self.prefix = get_random_bytes(8)
+            self.counter = 1
+        return NONCE.pack(self.prefix, self.counter)
+
+    def seal(self, data: bytes, headroom: int = 0) -> bytearray:
+        """Encrypt data, leaving headroom bytes free at the start for a header."""
+        nonce = self.next_nonce()
+        start = headroom + 1 + NONCE.size
+
+        out = bytearray(start + len(data) + self.tag_size)
+        view = memoryview(out)
+        out[headroom] = self.suite
+        view[headroom + 1 : start] = nonce
+        cipher = self.new(nonce)
+        cipher.encrypt(data, output=view[start : start + len(data)])
+        view[start + len(data) :] = cipher.digest()
+        return out
+
+    def open(self, payload: bytes) -> Union[bytes, None]:
+        """Decrypt a sealed payload, None if it is not authentic."""
+        start = 1 + NONCE.size
+        if len(payload) < start + self.tag_size:
+            return None
+
+        view = memoryview(payload)
+        cipher = self.new(bytes(view[1:start]))
+        try:
+            return cipher.decrypt_and_verify(
+                view[start : -self.tag_size], view[-self.tag_size :]
+            )
+        except ValueError as e:
+            logging.info(f"Cipher error: {e}")
+            return None
+
+
+class GCMCipher(AEADCipher):
+    """AES-256 in Galois/Counter Mode."""
+
+    suite = GCM
+    name = "gcm"
+
+    def new(self, nonce: bytes) -> Any:
+        """Create a cipher object for a nonce."""
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+
+
+class ChaChaCipher(AEADCipher):
+    """ChaCha20-Poly1305, fast where AES has no hardware support."""
+
+    suite = CHACHA20
+    name = "chacha20"
+
+    def new(self, nonce: bytes) -> Any:
+        """Create a cipher object for a nonce."""
+        return ChaCha20_Poly1305.new(key=self.key, nonce=nonce)
+
+
+SUITES: Dict[int, Type[SessionCipher]] = {
+    cipher.suite: cipher for cipher in (CBCCipher, GCMCipher, ChaChaCipher)
+}
+
+
+def suite_key(suite: int, secret: Union[str, None] = None) -> bytes:
+    """Derive a key of its own for every suite from the shared secret.
+
+    Peers other than clients, like linked servers, have a secret of their own.
+    """
+    if secret is None:
+        key = aes_cipher.key
+    else:
+        key = hashlib.sha256(secret.encode("utf-8")).digest()
+    if suite == CBC:
+        return key
+    return hashlib.sha256(key + bytes([suite])).digest()
+
+
+# Keys are derived once when first used, session ciphers are cheap to create
+SUITE_KEYS: Dict[Tuple[int, Union[str, None]], bytes] = {}
+
+
+def new_cipher(suite: int, secret: Union[str, None] = None) -> SessionCipher:
+    """Create a session cipher for a suite, keyed with secret if given."""
+    if (key := SUITE_KEYS.get((suite, secret))) is None:
+        key = SUITE_KEYS[(suite, secret)] = suite_key(suite, secret)
+    return SUITES[suite](key)
@@ -0,0 +1,24 @@
+"""Suites.py
+
+The ids and names of the session cipher suites.
+
+Kept apart from the ciphers so picking a suite on the command line
+doesn't load the cryptography library.
+"""
+
+from typing import *
+
+# Cipher suite ids, the first byte of every sealed payload
+CBC = 1
+GCM = 2
+CHACHA20 = 3
+
+SUITE_NAMES: Dict[str, int] = {"cbc": CBC, "gcm": GCM, "chacha20": CHACHA20}
+
+# The cheapest authenticated suite to set up per message with pycryptodomex
+DEFAULT_SUITE = CHACHA20
+
+
+def suite_name(suite: int) -> str:
+    """The name of a suite id."""
+    return next(name for name, known in SUITE_NAMES.items() if known == suite)
@@ -3,14 +3,14 @@
 Main gui window for gui chat app.
 """
 
-from socket import *
+import sys
 
 from PyQt5 import QtCore, QtGui
 
-from lairchat.crypto.AESCipher import aes_cipher
-from lairchat.gui.ClientThread import ClientThread
+from lairchat.gui.ClientConnection import ClientConnection
 from lairchat.gui.ConnectionDialog import ConnectionDialog
 from lairchat.gui.GuiCommon import *
+from lairchat.gui.MessageView import MessageBatcher, MessageView
 
 
 class ChatWindow(QtWidgets.QMainWindow):
@@ -19,11 +19,16 @@ class ChatWindow(QtWidgets.QMainWindow):
     def __init__(self):
         """Initialize the chat window."""
         super().__init__()
-        self.ct = ClientThread(self)
-        self.chat_view = QtWidgets.QTextEdit()
+        self.chat_view = MessageView()
+        self.batcher = MessageBatcher()
+        self.batcher.batch.connect(self.chat_view.add_batch)
+        self.connection = ClientConnection(self)
+        self.connection.connected.connect(self.connected)
+        self.connection.received.connect(self.batcher.post)
+        self.connection.closed.connect(self.disconnected)
+        self.connection.reconnecting.connect(self.reconnecting)
         self.chat_text_field = QtWidgets.QLineEdit(self)
         self.initUI()
-        self.sock = socket(AF_INET, SOCK_STREAM)
         self.conn = []
 
     def initUI(self):
@@ -65,7 +70,6 @@ class ChatWindow(QtWidgets.QMainWindow):
         btn_send.clicked.connect(self.send)
 
         splitter = QtWidgets.QSplitter(QtCore.Qt.Vertical)
-        self.chat_view.setReadOnly(True)
         splitter.addWidget(self.chat_view)
         splitter.addWidget(self.chat_text_field)
         splitter.setSizes([400, 100])
@@ -85,52 +89,69 @@ class ChatWindow(QtWidgets.QMainWindow):
 
     def closeEvent(self, event):
         """Quit app when the window is closed."""
+        self.connection.shutdown()
         exit(0)
 
     def connect(self):
-        """Create a client connection in a new thread."""
+        """Connect to the lair asked for, in the background."""
         conn_win = ConnectionDialog(self.conn)
-        conn_win.exec_()
-        self.ct.communicator.close_app.connect(self.close)
-        self.ct.start()
+        if conn_win.exec_() != QtWidgets.QDialog.Accepted:
+            return
+        address, port = self.conn[-1]
+        self.statusBar().showMessage(f"Connecting to {address}:{port}...")
+        self.connection.connect_to(address, port)
+
+    def connected(self):
+        """The connection is up."""
+        address, port = self.conn[-1]
+        self.statusBar().showMessage(f"Connected to {address}:{port}")
+
+    def disconnected(self, reason):
+        """The connection is down, say why."""
+        if reason:
+            self.batcher.flush()
+            self.chat_view.add(reason, "blue")
+            self.statusBar().showMessage(reason)
+
+    def reconnecting(self, delay):
+        """The connection is tried again after delay seconds."""
+        self.statusBar().showMessage(f"Reconnecting in {delay:.1f} seconds...")
 
     def send(self):
         """Send text to the lair server."""
-        global announce_exit
         text = self.chat_text_field.text()
 
         if text == "{help}":
             self.chat_text_field.setText("")
             return self.help()
-        elif text == "{quit}":
-            self.ct.communicator.close_app.emit()
 
-        # Encrypt the text
-        if (data := aes_cipher.encrypt(text)) is None:
-            critical_error(self, "unable to encrypt data.")
-            exit(0)
-
-        # Send the text
-        try:
-            self.sock.sendall(data)
-        except OSError as e:
-            critical_error(self.window, e)
-            exit(0)
-
-        # Decrypt the text
-        decrypted = aes_cipher.decrypt(data)
-        msg = decrypted.decode("utf-8", "ignore")
+        # Queue the text, it is written as the server can take it
+        if not self.connection.send(text):
+            self.statusBar().showMessage("Not connected, press F2 to connect.")
+            return
 
         # Update UI
-        self.chat_view.append(msg)
+        self.chat_view.add(text)
         self.chat_text_field.setText("")
+        if text == "{quit}":
+            self.close()
 
     def help(self):
         """Print a list of available commands."""
-        self.chat_view.append("Available Commands:\n")
-        self.chat_view.append("\t{help}:\tThis help menu")
-        self.chat_view.append("\t{quit}:\tExit program")
-        self.chat_view.append("\t{who}\tList of user names in the lair.")
+        self.chat_view.add("Available Commands:")
+        self.chat_view.add("\t{help}:\tThis help menu")
+        self.chat_view.add("\t{quit}:\tExit program")
+        self.chat_view.add("\t{who}\tList of user names in the lair.")
+        self.chat_view.add("\t{who #room}\tList of user names in a room.")
+        self.chat_view.add("\t{away}\tTell the others you are away.")
+        self.chat_view.add("\t{back}\tTell the others you are back.")
+        self.chat_view.add("\t{join #room}\tJoin a room and talk in it.")
+        self.chat_view.add("\t{part #room}\tLeave a room.")
+        self.chat_view.add("\t{msg name text}\tSend a message to one user.")
+        self.chat_view.add("\t{mail}\tRead the rest of your messages.")
+        self.chat_view.add("\t{history N}\tShow the last N messages of the room.")
+        self.chat_view.add("\t{history since 12:30}\tShow messages since then.")
+        self.chat_view.add("\t{search words}\tFind messages, newest first.")
 
     def aboutTheLair(self):
         """Display an about message box with Program/Author information."""
@@ -145,3 +166,11 @@ class ChatWindow(QtWidgets.QMainWindow):
     def aboutQt(self):
         """Display information about Qt."""
         QtWidgets.QMessageBox.aboutQt(self, "About Qt")
+
+
+def launch():
+    """Run the chat window in this process until it is closed."""
+    app = QtWidgets.QApplication(sys.argv)
+    main_win = ChatWindow()
+    main_win.show()
+    app.exec_()
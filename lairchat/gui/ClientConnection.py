@@ -0,0 +1,222 @@
+"""ClientConnection.py
+
+The Lair: the connection of the gui client to a lair.
+
+The socket is a QTcpSocket driven by the Qt event loop, so nothing ever
+blocks the gui thread.  Connecting goes on in the background and is
+given up after a timeout, what arrives is fed to the codec as it comes
+and every complete message is handed on with a signal, and what is sent
+is buffered by the socket and written whenever the server can take it.
+A server that stops reading until too much is waiting for it is given
+up on as well.
+
+A connection that drops after it was up is made again, backing off, and
+the session resumed, unless the lair said it is closed.
+"""
+
+from PyQt5 import QtCore, QtNetwork
+
+from lairchat.net.Compression import OFFER, START
+from lairchat.net.Framing import (
+    DEFAULT_SUITE,
+    FRAMED,
+    FrameError,
+    WireCodec,
+    encode_hello,
+)
+from lairchat.net.Heartbeat import PING, PONG
+from lairchat.net.Resume import GREETING, SessionState, backoff
+
+# Seconds to wait for a connection
+CONNECT_TIMEOUT = 10.0
+
+# Bytes waiting to be written before the server is given up on
+MAX_UNSENT = 1 << 20
+
+
+class ClientConnection(QtCore.QObject):
+    """A connection to a lair, reading and writing from the event loop."""
+
+    connected = QtCore.pyqtSignal()
+    received = QtCore.pyqtSignal(str)
+    closed = QtCore.pyqtSignal(str)
+    reconnecting = QtCore.pyqtSignal(float)
+
+    def __init__(
+        self,
+        parent=None,
+        mode=FRAMED,
+        suite=DEFAULT_SUITE,
+        timeout=CONNECT_TIMEOUT,
+        max_unsent=MAX_UNSENT,
+    ):
+        """Initialize the connection, it connects when asked to."""
+        super().__init__(parent)
+        self.mode = mode
+        self.suite = suite
+        self.timeout = timeout
+        self.max_unsent = max_unsent
+        self.codec = WireCodec(mode, suite)
+        self.session = SessionState()
+        self.address = None
+        self.open = False
+        self.closing = False
+        self.ended = False
+        self.was_open = False
+        self.delays = None
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.timed_out)
+
+        self.retry = QtCore.QTimer(self)
+        self.retry.setSingleShot(True)
+        self.retry.timeout.connect(self.attempt)
+
+        self.socket = QtNetwork.QTcpSocket(self)
+        self.socket.connected.connect(self.established)
+        self.socket.readyRead.connect(self.read)
+        self.socket.disconnected.connect(self.lost)
+        # Qt before 5.15 calls the signal error
+        failed = getattr(self.socket, "errorOccurred", None) or self.socket.error
+        failed.connect(self.failed)
+
+    def connect_to(self, host, port):
+        """Start connecting, connected or closed is emitted when it is done."""
+        self.ended = True
+        self.retry.stop()
+        if self.socket.state() != QtNetwork.QAbstractSocket.UnconnectedState:
+            self.close("")
+        self.session = SessionState()
+        self.address = (host, port)
+        self.ended = self.was_open = False
+        self.delays = None
+        self.attempt()
+
+    def attempt(self):
+        """Connect to the address, again if reconnecting."""
+        self.codec = WireCodec(self.mode, self.suite)
+        self.closing = False
+        self.timer.start(int(self.timeout * 1000))
+        self.socket.connectToHost(*self.address)
+
+    def established(self):
+        """Say hello, framed clients do so straight away."""
+        self.timer.stop()
+        self.open = self.was_open = True
+        self.delays = None
+        if self.mode == FRAMED:
+            self.write(encode_hello(self.suite))
+        self.connected.emit()
+
+    def timed_out(self):
+        """Give up connecting."""
+        self.close(f"connect: timed out after {self.timeout:g} seconds")
+
+    def failed(self, error):
+        """The socket failed to connect or broke."""
+        if error == QtNetwork.QAbstractSocket.RemoteHostClosedError:
+            return self.lost()
+        self.close(self.socket.errorString())
+
+    def lost(self):
+        """The server closed the connection."""
+        self.close("disconnected from the lair.")
+
+    def read(self):
+        """Decrypt every complete message received so far."""
+        try:
+            messages = self.codec.feed(bytes(self.socket.readAll()))
+        except FrameError as e:
+            return self.close(f"recv: {e}")
+
+        for decrypted in messages:
+            msg = decrypted.decode("utf-8", "ignore")
+
+            # Compression is negotiated out of sight
+            if msg == OFFER:
+                self.accept_compression()
+                continue
+            elif msg == START and self.codec.inflater is not None:
+                continue
+
+            # Sessions are asked for or resumed once greeted, and numbered
+            if self.mode == FRAMED:
+                if msg == GREETING:
+                    self.send(self.session.greeted())
+                    if self.session.resuming:
+                        continue
+                msg, reply = self.session.receive(msg)
+                if reply is not None:
+                    self.send(reply)
+                if msg is None:
+                    continue
+
+            # Heartbeats are answered out of sight
+            if msg == PING:
+                self.send(PONG)
+                continue
+
+            if msg == "The lair is closed.":
+                self.ended = True
+            self.received.emit(msg)
+
+    def accept_compression(self):
+        """Compress what is sent as one stream from now on."""
+        if self.write(self.codec.encode(START)):
+            self.codec.compress(streaming=True)
+
+    def send(self, text):
+        """Queue a message for the server, False if it can't be."""
+        if not self.open:
+            return False
+        if (data := self.codec.encode(text)) is None:
+            self.close("unable to encrypt data.")
+            return False
+        return self.write(data)
+
+    def write(self, data):
+        """Buffer data for the socket to write, False if it is closed."""
+        if self.socket.bytesToWrite() + len(data) > self.max_unsent:
+            self.close("send: the lair stopped reading")
+            return False
+        self.socket.write(data)
+        return True
+
+    def shutdown(self, wait=1.0):
+        """Write what is buffered, waiting a little, and disconnect."""
+        self.open = False
+        self.closing = self.ended = True
+        self.timer.stop()
+        self.retry.stop()
+        if self.socket.state() == QtNetwork.QAbstractSocket.ConnectedState:
+            self.socket.disconnectFromHost()
+            if self.socket.state() != QtNetwork.QAbstractSocket.UnconnectedState:
+                self.socket.waitForDisconnected(int(wait * 1000))
+        self.socket.abort()
+
+    def close(self, reason):
+        """Drop the connection at once and say why, once.
+
+        A connection that was up is tried again after a while, without a
+        word until the attempts run out.
+        """
+        if self.closing:
+            return
+        self.open = False
+        self.closing = True
+        self.timer.stop()
+        self.socket.abort()
+        if self.ended or not self.was_open or self.mode != FRAMED:
+            self.closed.emit(reason)
+            return
+
+        if self.delays is None:
+            self.closed.emit(reason)
+            self.delays = backoff()
+        if (delay := next(self.delays, None)) is None:
+            self.delays = None
+            self.closed.emit("Unable to reconnect to the lair.")
+            return
+        self.reconnecting.emit(delay)
+        self.retry.start(int(delay * 1000))
@@ -0,0 +1,264 @@
+"""MessageView.py
+
+The Lair: the messages of the gui client.
+
+Every message is written to a scrollback file, the list view shows a
+window of at most scrollback lines of it, so a busy lair doesn't grow
+the window forever.  Scrolling to the top pages older lines in from the
+file and drops lines at the bottom, scrolling back down pages the newer
+ones in again and follows the conversation once it reaches the end.
+
+Messages received by the network thread are gathered by a batcher and
+reach the window through a signal, all of those received during a frame
+at once, at most fps times a second.
+"""
+
+import collections
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+# Lines the view holds at most, and lines paged in from the file at once
+SCROLLBACK = 2000
+PAGE = 200
+
+# Batches of received messages shown per second at most
+FPS = 30
+
+# A line is stored as its length, its color and its text
+HEADER = struct.Struct("!IB")
+
+COLORS = ["black", "blue"]
+
+
+class Scrollback:
+    """Every line shown so far, in a file, read back by line number."""
+
+    def __init__(self):
+        """Initialize an empty scrollback in a temporary file."""
+        self.file = tempfile.TemporaryFile()
+        self.offsets = array("Q")
+        self.end = 0
+
+    def __len__(self):
+        """The number of lines."""
+        return len(self.offsets)
+
+    def append(self, lines):
+        """Add lines of (text, color) at the end."""
+        chunks = []
+        for text, color in lines:
+            data = text.encode("utf-8", "ignore")
+            self.offsets.append(self.end)
+            chunks.append(HEADER.pack(len(data), COLORS.index(color)) + data)
+            self.end += HEADER.size + len(data)
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(b"".join(chunks))
+
+    def read(self, start, stop):
+        """The lines from start up to stop."""
+        if start >= stop:
+            return []
+        end = self.offsets[stop] if stop < len(self.offsets) else self.end
+        self.file.seek(self.offsets[start])
+        data = self.file.read(end - self.offsets[start])
+        lines = []
+        position = 0
+        while position < len(data):
+            length, color = HEADER.unpack_from(data, position)
+            position += HEADER.size
+            lines.append(
+                (data[position : position + length].decode("utf-8"), COLORS[color])
+            )
+            position += length
+        return lines
+
+    def close(self):
+        """Remove the file."""
+        self.file.close()
+
+
+class MessageModel(QtCore.QAbstractListModel):
+    """A window of the scrollback, following its end unless paged back."""
+
+    def __init__(self, scrollback=SCROLLBACK, page=PAGE, parent=None):
+        """Initialize an empty model."""
+        super().__init__(parent)
+        self.scrollback = scrollback
+        self.page = page
+        self.store = Scrollback()
+        self.lines = collections.deque()
+        self.first = 0
+        self.following = True
+        self.brushes = {color: QtGui.QBrush(QtGui.QColor(color)) for color in COLORS}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        """The number of lines shown."""
+        return 0 if parent.isValid() else len(self.lines)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        """The text or the color of a line."""
+        if not index.isValid() or index.row() >= len(self.lines):
+            return None
+        text, color = self.lines[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return text
+        if role == QtCore.Qt.ForegroundRole:
+            return self.brushes[color]
+        return None
+
+    def append(self, lines):
+        """Add lines at the end, shown only if the model follows the end."""
+        self.store.append(lines)
+        if self.following:
+            self.insert_bottom(lines)
+
+    def insert_bottom(self, lines):
+        """Show lines after the last one, dropping the oldest beyond the limit."""
+        skipped = max(0, len(lines) - self.scrollback)
+        lines = lines[skipped:]
+        self.drop_top(len(self.lines) + len(lines) - self.scrollback)
+        self.first += skipped
+        count = len(self.lines)
+        self.beginInsertRows(QtCore.QModelIndex(), count, count + len(lines) - 1)
+        self.lines.extend(lines)
+        self.endInsertRows()
+
+    def drop_top(self, count):
+        """Stop showing the first count lines."""
+        count = min(count, len(self.lines))
+        if count <= 0:
+            return
+        self.beginRemoveRows(QtCore.QModelIndex(), 0, count - 1)
+        for _ in range(count):
+            self.lines.popleft()
+        self.first += count
+        self.endRemoveRows()
+
+    def drop_bottom(self, count):
+        """Stop showing the last count lines, the model stops following."""
+        count = min(count, len(self.lines))
+        if count <= 0:
+            return
+        last = len(self.lines)
+        self.beginRemoveRows(QtCore.QModelIndex(), last - count, last - 1)
+        for _ in range(count):
+            self.lines.pop()
+        self.endRemoveRows()
+        self.following = False
+
+    def page_older(self):
+        """Show a page of the lines before the first, how many were."""
+        count = min(self.page, self.first)
+        if count == 0:
+            return 0
+        lines = self.store.read(self.first - count, self.first)
+        self.beginInsertRows(QtCore.QModelIndex(), 0, count - 1)
+        self.lines.extendleft(reversed(lines))
+        self.first -= count
+        self.endInsertRows()
+        self.drop_bottom(len(self.lines) - self.scrollback)
+        return count
+
+    def page_newer(self):
+        """Show a page of the lines after the last, how many were."""
+        last = self.first + len(self.lines)
+        count = min(self.page, len(self.store) - last)
+        if count > 0:
+            self.insert_bottom(self.store.read(last, last + count))
+        if self.first + len(self.lines) == len(self.store):
+            self.following = True
+        return count
+
+
+class MessageView(QtWidgets.QListView):
+    """The chat messages, paging the scrollback as it is scrolled."""
+
+    def __init__(self, parent=None, scrollback=SCROLLBACK, page=PAGE):
+        """Initialize the view and its model."""
+        super().__init__(parent)
+        self.messages = MessageModel(scrollback, page, self)
+        self.setModel(self.messages)
+        self.setWordWrap(True)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.ContiguousSelection)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setLayoutMode(QtWidgets.QListView.Batched)
+        self.setBatchSize(100)
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
+
+    def at_bottom(self):
+        """Whether the last line is in sight."""
+        bar = self.verticalScrollBar()
+        return bar.value() >= bar.maximum()
+
+    def add(self, text, color="black"):
+        """Show a line, as the gui writes them."""
+        self.add_batch([(text, color)])
+
+    def add_batch(self, lines):
+        """Show lines, scrolling along if the last line was in sight."""
+        follow = self.messages.following and self.at_bottom()
+        self.messages.append(lines)
+        if follow:
+            self.scrollToBottom()
+
+    def scrolled(self, value):
+        """Page older lines in at the top and newer ones at the bottom."""
+        bar = self.verticalScrollBar()
+        if value == bar.minimum() and self.messages.first > 0:
+            if count := self.messages.page_older():
+                self.scrollTo(self.messages.index(count), self.PositionAtTop)
+        elif value == bar.maximum() and not self.messages.following:
+            self.messages.page_newer()
+
+    def closeEvent(self, event):
+        """Remove the scrollback file."""
+        self.messages.store.close()
+        super().closeEvent(event)
+
+
+class MessageBatcher(QtCore.QObject):
+    """Messages from any thread, sent to the gui thread a frame at a time."""
+
+    ready = QtCore.pyqtSignal()
+    batch = QtCore.pyqtSignal(list)
+
+    def __init__(self, fps=FPS, parent=None):
+        """Initialize the batcher, it lives in the gui thread."""
+        super().__init__(parent)
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.interval = 1.0 / fps
+        self.last = 0.0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+        self.ready.connect(self.schedule)
+
+    def post(self, text, color="blue"):
+        """Queue a message, waking the gui thread for the first of a frame."""
+        with self.lock:
+            first = not self.pending
+            self.pending.append((text, color))
+        if first:
+            self.ready.emit()
+
+    def schedule(self):
+        """Flush when the frame since the last flush is over."""
+        if not self.timer.isActive():
+            wait = self.last + self.interval - time.monotonic()
+            self.timer.start(max(0, int(wait * 1000)))
+
+    def flush(self):
+        """Send everything queued as one batch."""
+        with self.lock:
+            lines = list(self.pending)
+            self.pending.clear()
+        self.last = time.monotonic()
+        if lines:
+            self.batch.emit(lines)
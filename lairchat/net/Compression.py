@@ -0,0 +1,144 @@
+"""Compression.py
+
+Deflate compression of framed messages against a preset dictionary.
+
+Compression is negotiated while the server waits for a username.  A
+server that compresses offers it to framed clients before asking for a
+name, a client that accepts says START and compresses everything it
+sends after that, and the server answers START and does the same.  Once
+a peer has said START every message it sends begins with a marker byte
+telling how the rest is packed, so tiny messages can be sent as they are.
+
+Both peers compress their messages as one stream per connection, each
+one flushed to a byte boundary, so later messages also compress against
+earlier ones.  The server encodes a broadcast once per compressing
+recipient rather than once per variant for it, which still costs less
+than deflating every message afresh and sends about a quarter less.
+
+The dictionary holds the notices of the server and the words and
+phrases most common in chat text, most frequent last where deflate
+finds them cheapest to refer to.  Its version is part of the offer, a
+changed dictionary needs a new one.
+"""
+
+import zlib
+from typing import *
+
+# Sent by the server before asking for a name, and by a client accepting
+OFFER = "{compress zlib1}"
+START = "{deflate zlib1}"
+
+# Marker bytes of the messages of a peer that has said START
+STORED = 0
+DEFLATED = 1
+STREAMED = 2
+
+# Shorter messages gain too little from compression to be worth it
+MIN_SIZE = 32
+
+# A 4 KiB window keeps per message set up cheap and inflate state small
+WBITS = -12
+MEM_LEVEL = 5
+LEVEL = 6
+
+# Largest message inflated, anything bigger is not chat
+MAX_MESSAGE = 1 << 20
+
+# Trailer of a sync flush, always the same so it is left off the wire
+SYNC_TRAILER = b"\x00\x00\xff\xff"
+
+DICTIONARY = (
+    b"http://https://www..com/ .org/ .png .jpg .gif youtube github "
+    b"{help} {quit} {who} {join #} {part #} {msg } {history } {search } {mail} "
+    b"Available commands Unknown command, type {help} for commands. "
+    b"is already taken, choose another name. is not in the lair. "
+    b"is away, the message will wait. The mailbox of is full. "
+    b"messages came while you were away: Your mailbox: History of "
+    b"Page of the messages holding for more: No messages found for "
+    b"You are in no room, You left You are not in "
+    b"The lair is closed. You have entered the lair! Enter your name! "
+    b"Type {help} for commands. Hello "
+    b"sorry please maybe because really think about would could should "
+    b"something anyone someone everyone tonight tomorrow yesterday today "
+    b"morning night weekend working playing going doing looking getting "
+    b"haha hahaha lol lmao omg btw brb afk idk imo tbh np thx ty gg wp "
+    b"yeah yep nope okay ok sure cool nice great awesome thanks thank you "
+    b"hey hi hello bye see you later good night good morning welcome back "
+    b"I don't know I think I'm not sure what do you mean how are you "
+    b"doing fine are you there? did you see that? "
+    b"there their they're this that these those what when where which who "
+    b"why how with from have has had was were will would been being "
+    b"just like know get got can can't don't didn't isn't it's that's "
+    b"and the you for not but all any out one our your about "
+    b" has joined # has left # You are talking in #"
+    b" whispers: has left the lair. has entered the lair!"
+    b"\n[00:][01:][02:][03:][04:][05:][06:][07:][08:][09:][10:][11:]"
+    b"[12:][13:][14:][15:][16:][17:][18:][19:][20:][21:][22:][23:]"
+)
+
+
+def new_deflater() -> Any:
+    """A compressor primed with the dictionary."""
+    return zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, MEM_LEVEL, zdict=DICTIONARY)
+
+
+def new_inflater() -> Any:
+    """A decompressor primed with the dictionary."""
+    return zlib.decompressobj(WBITS, zdict=DICTIONARY)
+
+
+class Deflater:
+    """Pack the messages sent to a peer."""
+
+    def __init__(self, streaming: bool = False) -> None:
+        """Initialize, compressing as one stream or every message on its own."""
+        self.stream = new_deflater() if streaming else None
+
+    def pack(self, data: bytes) -> bytes:
+        """A marker byte and the data, compressed unless it wouldn't pay."""
+        if len(data) < MIN_SIZE:
+            return bytes([STORED]) + data
+
+        # Once in the stream data has to be sent compressed
+        if self.stream is not None:
+            packed = self.stream.compress(data) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+            return bytes([STREAMED]) + packed[: -len(SYNC_TRAILER)]
+
+        deflater = new_deflater()
+        packed = deflater.compress(data) + deflater.flush()
+        if len(packed) >= len(data):
+            return bytes([STORED]) + data
+        return bytes([DEFLATED]) + packed
+
+
+class Inflater:
+    """Unpack the messages received from a peer that has said START."""
+
+    def __init__(self) -> None:
+        """Initialize, the stream is only set up if the peer streams."""
+        self.stream: Any = None
+
+    def unpack(self, payload: bytes) -> Union[bytes, None]:
+        """The data of a packed message, None if it can't be unpacked."""
+        if not payload:
+            return None
+        marker, data = payload[0], payload[1:]
+        try:
+            if marker == STORED:
+                return data
+            elif marker == DEFLATED:
+                inflater = new_inflater()
+                unpacked = inflater.decompress(data, MAX_MESSAGE)
+                if inflater.unconsumed_tail or not inflater.eof:
+                    return None
+                return unpacked
+            elif marker == STREAMED:
+                if self.stream is None:
+                    self.stream = new_inflater()
+                unpacked = self.stream.decompress(data + SYNC_TRAILER, MAX_MESSAGE)
+                if self.stream.unconsumed_tail:
+                    return None
+                return unpacked
+        except zlib.error:
+            pass
+        return None
@@ -0,0 +1,389 @@
+"""Federation.py
+
+Links between lair servers so their clients share one lair.
+
+Every server is a node with a random id.  Nodes peer over TCP links that
+carry events as frames of JSON, sealed with a link secret of their own
+rather than the one clients use, so only nodes knowing it can join.  An
+event that isn't what its op says it is drops the link it came over.  A
+broadcast is sealed once and forwarded once per link, never once per
+remote user.
+
+Events carry an id made of the node they started at and a counter.  A
+node remembers the ids it has seen and forwards an event on every link
+but the one it arrived on, so events cross meshes and rings exactly once.
+Presence travels the same way: join and leave events, plus the whole
+roster a node knows, sent as a hello whenever a link comes up.  Users are
+dropped when the link they were learned on goes down, which is exact for
+nodes linked as a tree.
+"""
+
+import itertools
+import json
+import logging
+import secrets
+import selectors
+import threading
+import time
+from collections import deque
+from socket import *
+from typing import *
+
+from lairchat.cli.Presence import GONE
+from lairchat.net.Framing import DEFAULT_SUITE, FRAMED, FrameError, WireCodec
+from lairchat.net.OutboundQueue import DISCONNECT, OutboundQueue, send_batch
+
+# Event ids remembered to break forwarding loops
+SEEN_LIMIT = 65536
+
+# Bytes queued for a peer before the link is considered dead
+LINK_HIGH_WATER = 16 * 1024 * 1024
+LINK_LOW_WATER = 4 * 1024 * 1024
+
+# Seconds between attempts to dial a peer that is down
+REDIAL_INTERVAL = 1.0
+
+# The text fields every event of an op has, and those it may have
+FIELDS = {
+    "hello": ("node",),
+    "broadcast": ("id", "node", "text"),
+    "join": ("id", "node", "name", "host"),
+    "leave": ("id", "node", "name"),
+}
+OPTIONAL_FIELDS = ("room", "to", "text")
+
+
+def strings(value: Any, count: int) -> bool:
+    """Tell if a value is a list of count strings."""
+    return (
+        isinstance(value, list)
+        and len(value) == count
+        and all(isinstance(item, str) for item in value)
+    )
+
+
+def valid_event(event: Any) -> bool:
+    """Tell if an event a peer sent has every field its op needs."""
+    if not isinstance(event, dict) or event.get("op") not in FIELDS:
+        return False
+    if not all(isinstance(event.get(key), str) for key in FIELDS[event["op"]]):
+        return False
+    if event["op"] == "hello":
+        users = event.get("users")
+        return isinstance(users, list) and all(strings(user, 3) for user in users)
+    if not all(isinstance(event.get(key, ""), str) for key in OPTIONAL_FIELDS):
+        return False
+    return "presence" not in event or strings(event["presence"], 4)
+
+
+class Link:
+    """A connection to a peer node."""
+
+    def __init__(self, sock: socket, address: Tuple[str, int], secret: str) -> None:
+        """Initialize the link, sealed with the secret of the lair's links."""
+        self.sock = sock
+        self.address = address
+        self.node = ""
+        self.codec = WireCodec(FRAMED, DEFAULT_SUITE, secret)
+        self.queue = OutboundQueue(LINK_HIGH_WATER, LINK_LOW_WATER, DISCONNECT)
+
+
+class Federation:
+    """The node a chat server uses to talk to its peers."""
+
+    def __init__(
+        self,
+        host: str,
+        link_port: Union[int, None],
+        peers: List[Tuple[str, int]],
+        secret: str,
+        buf_size: int = 65536,
+    ) -> None:
+        """Initialize the node, listening for peers on link_port if given.
+
+        Links are sealed with secret, which every peer must be given too.
+        """
+        self.node = secrets.token_hex(4)
+        self.peers = list(peers)
+        self.secret = secret
+        self.buf_size = buf_size
+        self.codec = WireCodec(FRAMED, DEFAULT_SUITE, secret)
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.seen: Set[str] = set()
+        self.seen_order: Deque[str] = deque()
+        self.links: Dict[socket, Link] = {}
+        self.dialed: Dict[Tuple[str, int], Link] = {}
+        self.local: Dict[str, str] = {}
+        self.remote: Dict[str, Tuple[str, str, Link]] = {}
+        self.deliver: Callable[[Dict[str, Any]], None] = lambda event: None
+        self.exit_flag = False
+        self.sel = selectors.DefaultSelector()
+
+        self.listener: Union[socket, None] = None
+        self.address: Union[Tuple[str, int], None] = None
+        if link_port is not None:
+            self.listener = socket(AF_INET, SOCK_STREAM)
+            self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.listener.bind((host, link_port))
+            self.listener.listen(16)
+            self.address = self.listener.getsockname()
+            self.sel.register(self.listener, selectors.EVENT_READ, self.accept)
+
+    def start(self, deliver: Callable[[Dict[str, Any]], None]) -> None:
+        """Link up with the peers, deliver is called with remote broadcasts."""
+        self.deliver = deliver
+        logging.info(f"Federation node {self.node} starting")
+        threading.Thread(target=self.event_loop, name="federation", daemon=True).start()
+
+    def event_loop(self) -> None:
+        """Read events from peers and keep dialing the ones that are down."""
+        redial = 0.0
+        while not self.exit_flag:
+            if (now := time.monotonic()) >= redial:
+                self.dial()
+                redial = now + REDIAL_INTERVAL
+
+            for key, mask in self.sel.select(timeout=REDIAL_INTERVAL):
+                key.data(key.fileobj)
+
+    def dial(self) -> None:
+        """Connect to every configured peer without a live link."""
+        for address in self.peers:
+            if address in self.dialed:
+                continue
+            try:
+                sock = create_connection(address, timeout=REDIAL_INTERVAL)
+                sock.settimeout(None)
+            except OSError as e:
+                logging.debug(f"Unable to link with {address}: {e}")
+                continue
+            self.dialed[address] = self.add_link(sock, address)
+
+    def accept(self, listener: socket) -> None:
+        """Accept a link from a peer."""
+        try:
+            sock, address = listener.accept()
+        except OSError as e:
+            logging.warning(f"Error: {e}")
+            return
+        self.add_link(sock, address)
+
+    def add_link(self, sock: socket, address: Tuple[str, int]) -> Link:
+        """Start using a new link, introducing ourselves with a hello."""
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        link = Link(sock, address, self.secret)
+        self.links[sock] = link
+        self.sel.register(sock, selectors.EVENT_READ, self.read)
+        threading.Thread(
+            target=self.link_writer_loop, args=(link,), daemon=True
+        ).start()
+        logging.info(f"Linked with peer {address}")
+
+        with self.lock:
+            users = [(name, host, self.node) for name, host in self.local.items()]
+            users += [
+                (name, host, node) for name, (node, host, _) in self.remote.items()
+            ]
+            self.send(link, {"op": "hello", "node": self.node, "users": users})
+        return link
+
+    def link_writer_loop(self, link: Link) -> None:
+        """Write queued events to a peer until the link is closed."""
+        while frames := link.queue.get_batch():
+            try:
+                link.queue.writes += send_batch(link.sock, frames)
+            except OSError as e:
+                logging.warning(f"Link error: {e}")
+                link.queue.close(discard=True)
+                self.disconnect(link)
+
+    def read(self, sock: socket) -> None:
+        """Act on the events a peer sent."""
+        link = self.links[sock]
+        try:
+            data = sock.recv(self.buf_size)
+            events = [json.loads(event) for event in link.codec.feed(data)]
+        except (OSError, FrameError, ValueError, RecursionError) as e:
+            logging.warning(f"Link error: {e}")
+            data = b""
+        if not data:
+            self.drop_link(link)
+            return
+
+        for event in events:
+            if not valid_event(event):
+                logging.warning(f"Peer {link.address} sent a malformed event")
+                self.drop_link(link)
+                return
+            if event["op"] == "hello":
+                self.hello(link, event)
+            elif self.first_sighting(event["id"]):
+                self.forward(event, link)
+                if event["op"] == "broadcast":
+                    self.deliver(event)
+                elif event["op"] == "join":
+                    self.learn(event["name"], event["host"], event["node"], link)
+                elif event["op"] == "leave":
+                    if self.forget(event["name"], event["node"]) and "text" in event:
+                        self.deliver(event)
+
+    def hello(self, link: Link, event: Dict[str, Any]) -> None:
+        """Learn who is on the far side of a new link."""
+        if event["node"] == self.node:
+            logging.warning(f"Link {link.address} loops back to this node")
+            self.drop_link(link)
+            return
+        link.node = event["node"]
+
+        # Pass users nobody here knew about on as if they had just joined
+        for name, host, node in event["users"]:
+            if self.learn(name, host, node, link):
+                join = self.stamp({"op": "join", "name": name, "host": host})
+                join["node"] = node
+                self.forward(join, link)
+
+    def learn(self, name: str, host: str, node: str, link: Link) -> bool:
+        """Add a user on another node to the roster, False if already known."""
+        with self.lock:
+            if name in self.local or name in self.remote:
+                if self.remote.get(name, (None,))[0] != node:
+                    logging.warning(f"{name} is logged in on two nodes")
+                return False
+            self.remote[name] = (node, host, link)
+        return True
+
+    def forget(self, name: str, node: str) -> bool:
+        """Remove a user on another node from the roster, False if unknown."""
+        with self.lock:
+            if self.remote.get(name, (None,))[0] != node:
+                return False
+            del self.remote[name]
+        return True
+
+    def drop_link(self, link: Link) -> None:
+        """Stop using a link and forget the users learned through it."""
+        if self.links.pop(link.sock, None) is None:
+            return
+        self.sel.unregister(link.sock)
+        link.queue.close(discard=True)
+        link.sock.close()
+        for address, dialed in list(self.dialed.items()):
+            if dialed is link:
+                del self.dialed[address]
+        logging.info(f"Link with peer {link.address} is down")
+
+        with self.lock:
+            lost = [
+                (name, node)
+                for name, (node, _, via) in self.remote.items()
+                if via is link
+            ]
+            for name, node in lost:
+                del self.remote[name]
+        # Nobody else will say goodbye for them
+        for name, node in lost:
+            text = f"{name} has left the lair."
+            event = self.stamp({"op": "leave", "name": name, "text": text})
+            event["node"] = node
+            # A presence change of name, from a state unknown here to gone
+            event["presence"] = [name, "", "", GONE]
+            self.forward(event, link)
+            self.deliver(event)
+
+    def first_sighting(self, event_id: str) -> bool:
+        """Remember an event id, False if it has been seen before."""
+        with self.lock:
+            if event_id in self.seen:
+                return False
+            self.seen.add(event_id)
+            self.seen_order.append(event_id)
+            if len(self.seen_order) > SEEN_LIMIT:
+                self.seen.discard(self.seen_order.popleft())
+        return True
+
+    def stamp(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        """Give an event started here a unique id."""
+        event["id"] = f"{self.node}:{next(self.counter)}"
+        event["node"] = self.node
+        self.first_sighting(event["id"])
+        return event
+
+    def forward(self, event: Dict[str, Any], source: Union[Link, None]) -> None:
+        """Seal an event once and queue it on every link but its source."""
+        with self.lock:
+            frame = bytes(self.codec.encode(json.dumps(event, separators=(",", ":"))))
+        for link in list(self.links.values()):
+            if link is not source:
+                self.enqueue(link, frame)
+
+    def send(self, link: Link, event: Dict[str, Any]) -> None:
+        """Seal an event and queue it on a single link."""
+        frame = bytes(self.codec.encode(json.dumps(event, separators=(",", ":"))))
+        self.enqueue(link, frame)
+
+    def enqueue(self, link: Link, frame: bytes) -> None:
+        """Queue a frame on a link, cutting the link if the peer can't keep up."""
+        if not link.queue.put(frame):
+            logging.warning(f"Peer {link.address} is too slow, dropping link")
+            link.queue.close(discard=True)
+            self.disconnect(link)
+
+    def disconnect(self, link: Link) -> None:
+        """Shut a link down, the event loop drops it once it reads the end."""
+        try:
+            link.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def publish(
+        self,
+        text: str,
+        room: Union[str, None] = None,
+        to: Union[str, None] = None,
+        presence: Union[List[str], None] = None,
+    ) -> None:
+        """Send a broadcast, room or direct message from a local client on.
+
+        presence is the change of a dweller the message announces, if any.
+        """
+        event = {"op": "broadcast", "text": text}
+        if room is not None:
+            event["room"] = room
+        if to is not None:
+            event["to"] = to
+        if presence is not None:
+            event["presence"] = presence
+        self.forward(self.stamp(event), None)
+
+    def join(self, name: str, host: str) -> None:
+        """Announce a user that logged in here."""
+        with self.lock:
+            self.local[name] = host
+        self.forward(self.stamp({"op": "join", "name": name, "host": host}), None)
+
+    def leave(self, name: str) -> None:
+        """Announce a user that logged out here."""
+        with self.lock:
+            if self.local.pop(name, None) is None:
+                return
+        self.forward(self.stamp({"op": "leave", "name": name}), None)
+
+    def knows(self, name: str) -> bool:
+        """Tell if a user is logged in on another node."""
+        return name in self.remote
+
+    def users(self) -> List[Tuple[str, str]]:
+        """Usernames and hosts of everybody on the other nodes."""
+        with self.lock:
+            return [(name, host) for name, (_, host, _) in self.remote.items()]
+
+    def close(self) -> None:
+        """Drop every link and stop listening for peers."""
+        self.exit_flag = True
+        for link in list(self.links.values()):
+            link.queue.close()
+            link.queue.wait_written(1.0)
+            self.disconnect(link)
+        if self.listener is not None:
+            self.listener.close()
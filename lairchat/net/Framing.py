@@ -0,0 +1,245 @@
+"""Framing.py
+
+Length-prefixed framing for the lair wire protocol.
+
+A frame is a 4 byte big-endian payload length followed by the raw binary
+ciphertext, sealed by one of the session ciphers.  Payloads are capped
+below 2**24 bytes so the first byte of every frame is zero, a value that
+never starts a base64 encoded legacy message.  That lets a server tell
+framed clients from legacy ones by the first byte they send.  Framed
+clients announce themselves as soon as they connect with a hello frame
+holding only the id of the cipher suite they speak.
+
+Framed peers may also agree to compress their messages, see Compression.
+"""
+
+import collections
+import struct
+from typing import *
+
+from lairchat.crypto.AESCipher import aes_cipher
+from lairchat.crypto.Ciphers import SUITES, SessionCipher, new_cipher
+from lairchat.crypto.Suites import DEFAULT_SUITE
+from lairchat.net.Compression import START, Deflater, Inflater
+
+# Wire modes
+LEGACY = "legacy"
+FRAMED = "framed"
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = (1 << 24) - 1
+
+
+class FrameError(ValueError):
+    """Data received from a peer can't be decoded."""
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """Prefix a payload with its length."""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"frame of {len(payload)} bytes is too large")
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_hello(suite: int = DEFAULT_SUITE) -> bytes:
+    """Create the frame a framed client says hello with."""
+    return encode_frame(bytes([suite]))
+
+
+def detect_mode(data: bytes) -> str:
+    """Tell the wire mode of a peer from the first bytes it sent."""
+    return FRAMED if data[:1] == b"\x00" else LEGACY
+
+
+def encode_message(
+    message: str,
+    mode: str,
+    cipher: Union[SessionCipher, None] = None,
+    deflater: Union[Deflater, None] = None,
+) -> Union[bytes, None]:
+    """Encrypt a message, compressed if there is a deflater, for the wire."""
+    if mode == LEGACY:
+        return aes_cipher.encrypt(message)
+
+    data = message.encode("utf-8", "ignore")
+    if deflater is not None:
+        data = deflater.pack(data)
+
+    # Seal straight into the frame, leaving room for the header
+    cipher = cipher or new_cipher(DEFAULT_SUITE)
+    frame = cipher.seal(data, HEADER.size)
+    if len(frame) - HEADER.size > MAX_FRAME_SIZE:
+        return None
+    HEADER.pack_into(frame, 0, len(frame) - HEADER.size)
+    return frame
+
+
+class FrameDecoder:
+    """Incrementally split a byte stream into frames.
+
+    A single read may hold many frames, the tail of one frame or both;
+    incomplete frames are kept until the rest arrives.
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE) -> None:
+        """Initialize the decoder."""
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add data read from the stream, return every completed frame."""
+        buf = self.buffer
+        buf += data
+
+        frames = []
+        pos = 0
+        end = len(buf)
+        while end - pos >= HEADER.size:
+            (length,) = HEADER.unpack_from(buf, pos)
+            if length > self.max_frame_size:
+                raise FrameError(f"frame of {length} bytes is too large")
+            if pos + HEADER.size + length > end:
+                break
+            pos += HEADER.size
+            frames.append(bytes(buf[pos : pos + length]))
+            pos += length
+
+        # Drop consumed bytes in one go
+        if pos:
+            del buf[:pos]
+        return frames
+
+
+class WireCodec:
+    """Encode and decode the messages exchanged with one peer.
+
+    The mode is either fixed up front or detected from the first data fed.
+    In legacy mode every read is taken to be exactly one base64 message.
+    Framed messages are opened with whichever suite sealed them.  Without
+    a suite of its own the codec answers in the suite the peer last used.
+
+    Messages are inflated once the peer has said START, which is only
+    heeded while negotiating, and deflated once compress has been called.
+    Peers that aren't clients seal messages with a secret of their own.
+    A codec framed up front skips what comes before the first frame, the
+    legacy greeting of a server that heard its hello too late.
+
+    Frames are split off as data comes in but only decrypted and inflated
+    when fed for, a limited number of messages or bytes at a time if told
+    so, the others are pending until the next feed.
+    """
+
+    def __init__(
+        self,
+        mode: Union[str, None] = None,
+        suite: Union[int, None] = None,
+        secret: Union[str, None] = None,
+    ) -> None:
+        """Initialize the codec."""
+        self.mode = mode
+        self.follow = suite is None
+        self.secret = secret
+        self.cipher = new_cipher(DEFAULT_SUITE if suite is None else suite, secret)
+        self.ciphers: Dict[int, SessionCipher] = {self.cipher.suite: self.cipher}
+        self.decoder = FrameDecoder()
+        self.payloads: Deque[bytes] = collections.deque()
+        self.deflater: Union[Deflater, None] = None
+        self.inflater: Union[Inflater, None] = None
+        self.negotiating = False
+        self.skipping = mode == FRAMED
+
+    @property
+    def variant(self) -> str:
+        """Peers with the same variant can be sent the same encoded bytes."""
+        if self.mode == LEGACY:
+            return LEGACY
+        elif self.deflater is None:
+            return f"{self.mode}/{self.cipher.name}"
+        elif self.deflater.stream is None:
+            return f"{self.mode}/{self.cipher.name}/deflate"
+
+        # A stream compresses against what this peer was sent before
+        return f"{self.mode}/{self.cipher.name}/stream/{id(self)}"
+
+    def encode(self, message: str) -> Union[bytes, None]:
+        """Encrypt a message and encode it for the wire."""
+        return encode_message(message, self.mode, self.cipher, self.deflater)
+
+    def compress(self, streaming: bool = False) -> None:
+        """Compress every later message, the peer must have been sent START."""
+        self.deflater = Deflater(streaming)
+        self.negotiating = self.inflater is None
+
+    def open(self, payload: bytes) -> Union[bytes, None]:
+        """Open a sealed payload with the suite named in its first byte."""
+        suite = payload[0]
+        if (cipher := self.ciphers.get(suite)) is None:
+            if suite not in SUITES:
+                raise FrameError(f"unknown cipher suite {suite}")
+            cipher = self.ciphers[suite] = new_cipher(suite, self.secret)
+        if self.follow:
+            self.cipher = cipher
+
+        # A suite id alone is a hello
+        if len(payload) == 1:
+            return b""
+        return cipher.open(payload)
+
+    @property
+    def pending(self) -> bool:
+        """Whether messages were received that haven't been decoded yet."""
+        return bool(self.payloads)
+
+    def feed(
+        self,
+        data: bytes,
+        max_messages: Union[int, None] = None,
+        max_bytes: Union[int, None] = None,
+    ) -> List[bytes]:
+        """Decode data read from the peer, return the decrypted messages.
+
+        At most max_messages are decoded, and no more once they add up to
+        max_bytes, the rest wait for a later feed, with or without data.
+        """
+        if self.mode is None and data:
+            self.mode = detect_mode(data)
+
+        # Base64 never holds the zero byte every frame header starts with
+        if self.skipping and data:
+            if (start := data.find(b"\x00")) < 0:
+                return []
+            data = data[start:]
+            self.skipping = False
+
+        if self.mode == LEGACY:
+            if data:
+                self.payloads.append(data)
+            decrypt = aes_cipher.decrypt
+        else:
+            # Empty frames carry nothing
+            self.payloads += [payload for payload in self.decoder.feed(data) if payload]
+            decrypt = self.open
+
+        messages: List[bytes] = []
+        decoded = 0
+        while self.payloads:
+            if max_messages is not None and len(messages) >= max_messages:
+                break
+            if max_bytes is not None and decoded >= max_bytes:
+                break
+            payload = self.payloads.popleft()
+            if (decrypted := decrypt(payload)) is None:
+                raise FrameError("unable to decrypt message")
+            if not decrypted:
+                continue
+
+            # Everything after the START of the peer is compressed
+            if self.inflater is not None:
+                if (decrypted := self.inflater.unpack(decrypted)) is None:
+                    raise FrameError("unable to inflate message")
+            elif self.negotiating and decrypted == START.encode():
+                self.inflater = Inflater()
+                self.negotiating = False
+            messages.append(decrypted)
+            decoded += len(decrypted)
+        return messages
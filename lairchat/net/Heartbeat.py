@@ -0,0 +1,14 @@
+"""Heartbeat.py
+
+The Lair: telling a quiet client from a dead one.
+
+A framed client the server has heard nothing from for a heartbeat
+interval is sent PING, and answers PONG straight away.  Anything a
+client sends counts, so busy clients are never pinged, and one that
+stays quiet until the idle timeout is disconnected.  Neither message is
+numbered for clients with a session or shown to the user.
+"""
+
+# Sent by the server to a quiet client, and the answer
+PING = "{ping}"
+PONG = "{pong}"
@@ -0,0 +1,187 @@
+"""OutboundQueue.py
+
+Bounded per-client queues of frames waiting to be written.
+
+Senders only ever append to a queue, the I/O layer of the server engine
+drains it, so a client that stops reading can't stall anybody else.  When
+the queued bytes reach the high watermark the client is congested until
+the queue has drained below the low watermark; while congested new frames
+are either dropped or the client is disconnected, depending on the policy.
+
+Frames are drained in batches so several of them can be written with a
+single scatter-gather send.  A batch is flushed after flush_interval
+seconds or as soon as flush_bytes are queued, whichever comes first; an
+interval of zero sends whatever is queued right away.
+"""
+
+import threading
+import time
+from collections import deque
+from socket import *
+from typing import *
+
+# Slow consumer policies
+DROP = "drop"
+DISCONNECT = "disconnect"
+
+# Most buffers a single sendmsg call accepts on common platforms
+IOV_MAX = 1024
+
+
+class OutboundQueue:
+    """Frames waiting to be written to a single client."""
+
+    def __init__(
+        self,
+        high_water: int,
+        low_water: int,
+        policy: str = DISCONNECT,
+        notify: Union[Callable[[], None], None] = None,
+        flush_interval: float = 0.0,
+        flush_bytes: int = 64 * 1024,
+    ) -> None:
+        """Initialize the queue.
+
+        notify is called whenever a frame is put in an empty queue or the
+        queue reaches flush_bytes, so engines without a writer thread know
+        when to start draining.
+        """
+        self.frames: Deque[bytes] = deque()
+        self.cond = threading.Condition()
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+        self.notify = notify
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.coalesce = True
+        self.congested = False
+        self.closed = False
+        self.writing = False
+
+        # Counters
+        self.queued_bytes = 0
+        self.peak_bytes = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.writes = 0
+
+    def put(self, frame: bytes) -> bool:
+        """Queue a frame, return False if the client should be disconnected."""
+        with self.cond:
+            if self.closed:
+                return True
+
+            if self.queued_bytes + len(frame) > self.high_water:
+                self.congested = True
+
+            if self.congested:
+                if self.policy == DISCONNECT:
+                    return False
+                self.dropped_frames += 1
+                self.dropped_bytes += len(frame)
+                return True
+
+            was_empty = not self.frames
+            was_short = self.queued_bytes < self.flush_bytes
+            self.frames.append(frame)
+            self.queued_bytes += len(frame)
+            self.peak_bytes = max(self.peak_bytes, self.queued_bytes)
+            is_full = was_short and self.queued_bytes >= self.flush_bytes
+            self.cond.notify()
+
+        if (was_empty or is_full) and self.notify is not None:
+            self.notify()
+        return True
+
+    def get_batch(self) -> List[bytes]:
+        """Wait for the next batch of frames, empty once the queue is closed.
+
+        Frames are collected for up to flush_interval seconds or until
+        flush_bytes are queued.  Without coalescing a batch is one frame.
+        """
+        with self.cond:
+            self.writing = False
+            self.cond.notify_all()
+            while not self.frames and not self.closed:
+                self.cond.wait()
+
+            if self.coalesce and self.flush_interval > 0:
+                deadline = time.monotonic() + self.flush_interval
+                while self.queued_bytes < self.flush_bytes and not self.closed:
+                    if (remaining := deadline - time.monotonic()) <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+            self.writing = bool(self.frames)
+            return self.pop_batch()
+
+    def get_batch_nowait(self) -> List[bytes]:
+        """Return the next batch of frames without waiting."""
+        with self.cond:
+            return self.pop_batch()
+
+    def pop_batch(self) -> List[bytes]:
+        """Remove up to flush_bytes worth of frames, the caller holds the lock."""
+        batch = []
+        size = 0
+        while self.frames:
+            if batch and (
+                not self.coalesce or size + len(self.frames[0]) > self.flush_bytes
+            ):
+                break
+            frame = self.pop()
+            batch.append(frame)
+            size += len(frame)
+        return batch
+
+    def pop(self) -> bytes:
+        """Remove the next frame, the caller holds the lock."""
+        frame = self.frames.popleft()
+        self.queued_bytes -= len(frame)
+        self.sent_frames += 1
+        self.sent_bytes += len(frame)
+        if self.congested and self.queued_bytes <= self.low_water:
+            self.congested = False
+        return frame
+
+    def wait_written(self, timeout: float) -> bool:
+        """Wait until a writer has taken and written every queued frame."""
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: not self.frames and not self.writing, timeout
+            )
+
+    def close(self, discard: bool = False) -> None:
+        """Stop accepting frames, optionally throwing away what is queued."""
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.dropped_frames += len(self.frames)
+                self.dropped_bytes += self.queued_bytes
+                self.frames.clear()
+                self.queued_bytes = 0
+            self.cond.notify_all()
+
+
+def send_batch(sock: socket, frames: List[bytes]) -> int:
+    """Write frames with as few send calls as possible, return the calls made."""
+    if len(frames) == 1 or not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(frames))
+        return 1
+
+    # sendmsg may write only part of the batch, carry on from where it stopped
+    buffers = [memoryview(frame) for frame in frames]
+    first = 0
+    calls = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first : first + IOV_MAX])
+        calls += 1
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+    return calls
@@ -0,0 +1,117 @@
+"""Resume.py
+
+The Lair: sessions that survive a dropped connection.
+
+A framed client that says SESSION once it is greeted gets a session.
+Every message the server sends it from then on starts with a sequence
+number and a record separator.  The numbers come from a single counter
+of the server, so they grow with every message a client is sent but
+skip those sent to the others.  The first message of a session is
+
+    {session name token}
+
+and the client acknowledges what it has read every ACK_EVERY messages
+with {ack N}.  The server keeps the messages not acknowledged yet.
+
+When the connection drops the server holds on to the session for a
+grace period, still keeping what the client is sent.  The client
+reconnects, backing off exponentially with jitter, and once greeted
+again says
+
+    {resume name token N}
+
+where N is the last sequence number it read.  The server sends every
+message after N again, each with its own number, then
+
+    {resumed name}
+
+A session the server no longer has can't be resumed, the client is told
+so and logs in again.
+"""
+
+import random
+from typing import *
+
+# What the server says to a new connection before anything else
+GREETING = "You have entered the lair!\nEnter your name!"
+
+# Sent by a client, after the greeting, to get a session or resume one
+SESSION = "{session}"
+RESUME = "{resume "
+
+# The answer to a resume the server can't do
+SESSION_GONE = "Your session is gone, enter your name!"
+
+# Ends the sequence number in front of a message
+SEPARATOR = "\x1e"
+
+# Messages a client reads between acknowledgements
+ACK_EVERY = 32
+
+
+def sequenced(seq: int, message: str) -> str:
+    """A message numbered for a client with a session."""
+    return f"{seq}{SEPARATOR}{message}"
+
+
+class SessionState:
+    """What a client knows about its session, enough to resume it."""
+
+    def __init__(self) -> None:
+        """Initialize the state, there is no session yet."""
+        self.username: Union[str, None] = None
+        self.token: Union[str, None] = None
+        self.seq = 0
+        self.acked = 0
+        self.resuming = False
+
+    def greeted(self) -> str:
+        """The message to answer a greeting with."""
+        self.resuming = self.token is not None
+        if self.resuming:
+            return f"{RESUME}{self.username} {self.token} {self.seq}}}"
+        return SESSION
+
+    def receive(self, message: str) -> Tuple[Union[str, None], Union[str, None]]:
+        """Take the number off a message.
+
+        Return the message to show, None for those already read and
+        those about the session itself, and a message to answer with.
+        """
+        if self.resuming and message == SESSION_GONE:
+            self.token = None
+            self.resuming = False
+        number, separator, text = message.partition(SEPARATOR)
+        if not separator or not number.isdigit():
+            return message, None
+        seq = int(number)
+
+        # A new session starts counting wherever the server is at
+        if text.startswith("{session "):
+            _, self.username, self.token = text[1:-1].split(" ", 2)
+            self.seq = self.acked = seq
+            self.resuming = False
+            return None, None
+        if seq <= self.seq:
+            return None, None
+        self.seq = seq
+
+        if text.startswith("{resumed "):
+            self.resuming = False
+            text = None
+        if self.seq - self.acked >= ACK_EVERY:
+            self.acked = self.seq
+            return text, f"{{ack {self.seq}}}"
+        return text, None
+
+
+def backoff(
+    base: float = 0.5, cap: float = 30.0, attempts: int = 10
+) -> Iterator[float]:
+    """Seconds to wait before every attempt to reconnect.
+
+    The limit doubles every attempt, and the wait is anywhere below it,
+    so clients dropped at once don't come back at once.
+    """
+    for attempt in range(attempts):
+        yield random.uniform(0, min(cap, base * 2**attempt))
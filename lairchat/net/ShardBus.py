@@ -0,0 +1,385 @@
+"""ShardBus.py
+
+Links the worker processes of a sharded lair server.
+
+Every worker owns its own clients.  A hub in the parent process relays
+broadcasts between workers and keeps the roster of the whole lair, so a
+username stays unique across shards and {who} lists everybody.  Each
+worker has two Unix socket pairs to the hub: events carries broadcasts in
+both directions and is read by the worker's event loop, rpc carries
+blocking requests, like claiming a username, that the hub answers in order.
+The hub also keeps the mailboxes of the lair, a dweller who is away may
+log in again on any shard.
+
+Sessions stay on the shard a client logged in on, and the kernel may
+well hand a reconnecting client to another.  That shard can't resume the
+session, but with its token it has the hub end it, so the client told its
+session is gone gets its name back at once.
+
+Nothing but a writer thread ever writes to a link.  Events are put in a
+bounded queue per link that its thread drains, so a worker's event loop
+never waits on the hub while the hub waits on the worker.  A link that
+falls too far behind drops events rather than stall the lair.
+"""
+
+import hmac
+import json
+import logging
+import selectors
+import sys
+import threading
+from socket import *
+from typing import *
+
+from lairchat.cli.LogPipeline import LEVELS, log_level, set_log_level
+from lairchat.net.Framing import FrameDecoder, encode_frame
+from lairchat.net.OutboundQueue import DROP, OutboundQueue, send_batch
+from lairchat.store.Mailboxes import Mailboxes
+
+# Bytes queued for a link before its events are dropped, and until when
+LINK_HIGH_WATER = 64 * 1024 * 1024
+LINK_LOW_WATER = 32 * 1024 * 1024
+
+
+def encode_event(event: Dict[str, Any]) -> bytes:
+    """Encode a bus event as a frame of compact JSON."""
+    return encode_frame(json.dumps(event, separators=(",", ":")).encode("utf-8"))
+
+
+def link_queue(sock: socket) -> OutboundQueue:
+    """Create the queue of frames for a link, and the thread writing them."""
+    queue = OutboundQueue(LINK_HIGH_WATER, LINK_LOW_WATER, DROP)
+    threading.Thread(target=write_link, args=(sock, queue), daemon=True).start()
+    return queue
+
+
+def write_link(sock: socket, queue: OutboundQueue) -> None:
+    """Write the frames queued for a link until it is closed or gone."""
+    while frames := queue.get_batch():
+        try:
+            queue.writes += send_batch(sock, frames)
+        except OSError as e:
+            logging.warning(f"Shard bus error: {e}")
+            queue.close(discard=True)
+
+
+def link_summary(queue: OutboundQueue) -> str:
+    """What a link has queued, written and dropped."""
+    return (
+        f"queued {queue.queued_bytes} B (peak {queue.peak_bytes} B),"
+        f" sent {queue.sent_frames} in {queue.writes} writes,"
+        f" dropped {queue.dropped_frames}"
+    )
+
+
+class ShardBus:
+    """The worker side of the shard bus."""
+
+    def __init__(self, events: socket, rpc: socket) -> None:
+        """Initialize the bus."""
+        self.events = events
+        self.rpc = rpc
+        self.decoder = FrameDecoder()
+        self.rpc_decoder = FrameDecoder()
+        self.queue = link_queue(events)
+        self.rpc_lock = threading.Lock()
+
+    def publish(
+        self,
+        message: str,
+        omit_username: Union[str, None],
+        room: Union[str, None] = None,
+        to: Union[str, None] = None,
+        presence: Union[List[str], None] = None,
+    ) -> None:
+        """Relay a message to the other shards, to a room or a user if given.
+
+        presence is the change of a dweller the message announces, if any.
+        """
+        event = {"op": "broadcast", "text": message, "omit": omit_username}
+        if room is not None:
+            event["room"] = room
+        if to is not None:
+            event["to"] = to
+        if presence is not None:
+            event["presence"] = presence
+        self.queue.put(encode_event(event))
+
+    def report(self, lines: List[str]) -> None:
+        """Send the hub the statistics of this shard."""
+        self.queue.put(encode_event({"op": "stats", "lines": lines}))
+
+    def summary(self) -> str:
+        """What the link to the hub has queued, written and dropped."""
+        return link_summary(self.queue)
+
+    def receive(self) -> List[Dict[str, Any]]:
+        """Read the events the hub sent, a lost hub closes the shard."""
+        try:
+            data = self.events.recv(65536)
+        except OSError as e:
+            logging.warning(f"Shard bus error: {e}")
+            data = b""
+        if not data:
+            return [{"op": "close"}]
+        return [json.loads(frame) for frame in self.decoder.feed(data)]
+
+    def call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Send a request to the hub and wait for the answer.
+
+        Without a hub there is nobody to agree with, every claim is refused.
+        """
+        with self.rpc_lock:
+            try:
+                self.rpc.sendall(encode_event(request))
+                frames = []
+                while not frames:
+                    if not (data := self.rpc.recv(65536)):
+                        break
+                    frames = self.rpc_decoder.feed(data)
+            except OSError as e:
+                logging.warning(f"Shard bus error: {e}")
+                frames = []
+        if not frames:
+            return {"ok": False, "users": []}
+        return json.loads(frames[0])
+
+    def claim(self, username: str, address: Tuple[str, int]) -> bool:
+        """Reserve a username across all shards, False if it is taken."""
+        return self.call({"op": "claim", "name": username, "host": address[0]})["ok"]
+
+    def release(self, username: str) -> None:
+        """Give a username back."""
+        self.call({"op": "release", "name": username})
+
+    def roster(self) -> List[Tuple[str, str]]:
+        """Usernames and hosts of everybody on every shard."""
+        return [tuple(user) for user in self.call({"op": "roster"})["users"]]
+
+    def keep_session(self, username: str, token: str) -> None:
+        """Tell the hub the token of a session kept on this shard."""
+        self.call({"op": "session", "name": username, "token": token})
+
+    def abandon(self, username: str, token: str) -> bool:
+        """End a session kept on another shard, False if there is none."""
+        return self.call({"op": "abandon", "name": username, "token": token})["ok"]
+
+
+class HubMailboxes:
+    """The mailboxes of a shard, kept by the hub for the whole lair."""
+
+    def __init__(self, bus: ShardBus) -> None:
+        """Initialize the mailboxes."""
+        self.bus = bus
+
+    def know(self, username: str) -> None:
+        """Remember that somebody has logged in under a name."""
+        self.bus.call({"op": "know", "name": username})
+
+    def known(self, username: str) -> bool:
+        """Tell if somebody has ever logged in under a name."""
+        return self.bus.call({"op": "known", "name": username})["ok"]
+
+    def put(self, username: str, text: str) -> bool:
+        """Keep a message for somebody, False if their mailbox is full."""
+        return self.bus.call({"op": "put", "name": username, "text": text})["ok"]
+
+    def take(
+        self, username: str, max_bytes: Union[int, None] = None
+    ) -> Tuple[List[bytes], int]:
+        """Empty a mailbox, see Mailboxes.take."""
+        reply = self.bus.call({"op": "take", "name": username, "max": max_bytes})
+        mail = [text.encode("utf-8") for text in reply.get("mail", [])]
+        return mail, reply.get("left", 0)
+
+    def summary(self) -> str:
+        """A line for people."""
+        return "kept by the shard hub"
+
+
+class ShardHub:
+    """The parent side of the shard bus, relays events between workers."""
+
+    def __init__(self, workers: int, mailboxes: Union[Mailboxes, None] = None) -> None:
+        """Create the socket pairs linking the hub with every worker."""
+        self.links = [
+            (socketpair(AF_UNIX), socketpair(AF_UNIX)) for _ in range(workers)
+        ]
+        self.roster: Dict[str, Tuple[int, str]] = {}
+        self.tokens: Dict[str, str] = {}
+        self.mailboxes = mailboxes or Mailboxes()
+        self.decoders: Dict[socket, FrameDecoder] = {}
+        self.queues: Dict[socket, OutboundQueue] = {}
+        self.sel = selectors.DefaultSelector()
+
+    def worker_bus(self, shard: int) -> ShardBus:
+        """Create the bus a forked worker process talks to the hub with.
+
+        The worker closes every other end it inherited, so the hub sees
+        end of file as soon as a worker exits.
+        """
+        for other, ((events, hub_events), (rpc, hub_rpc)) in enumerate(self.links):
+            hub_events.close()
+            hub_rpc.close()
+            if other != shard:
+                events.close()
+                rpc.close()
+        (events, _), (rpc, _) = self.links[shard]
+        return ShardBus(events, rpc)
+
+    def forked(self) -> None:
+        """Close the worker ends in the hub once the workers have been forked."""
+        for (events, _), (rpc, _) in self.links:
+            events.close()
+            rpc.close()
+
+    def run(self, admin_console: bool = True) -> None:
+        """Relay events until every worker has gone.
+
+        The writer threads only start now, the workers have been forked.
+        """
+        for shard, ((_, events), (_, rpc)) in enumerate(self.links):
+            self.decoders[events] = FrameDecoder()
+            self.decoders[rpc] = FrameDecoder()
+            self.queues[events] = link_queue(events)
+            self.queues[rpc] = link_queue(rpc)
+            self.sel.register(events, selectors.EVENT_READ, (shard, self.relay))
+            self.sel.register(rpc, selectors.EVENT_READ, (shard, self.answer))
+        if admin_console:
+            self.sel.register(sys.stdin, selectors.EVENT_READ, (None, self.admin_input))
+
+        while any(key.data[0] is not None for key in self.sel.get_map().values()):
+            for key, mask in self.sel.select():
+                shard, callback = key.data
+                callback(shard, key.fileobj)
+
+        self.sel.close()
+        for queue in self.queues.values():
+            queue.close(discard=True)
+
+    def read(self, shard: int, sock: socket) -> List[Dict[str, Any]]:
+        """Read events from a worker, stop listening to it once it has gone."""
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            data = b""
+        if not data:
+            self.sel.unregister(sock)
+            self.queues[sock].close(discard=True)
+            for name in [
+                name for name, user in self.roster.items() if user[0] == shard
+            ]:
+                del self.roster[name]
+                self.tokens.pop(name, None)
+            return []
+        return [json.loads(frame) for frame in self.decoders[sock].feed(data)]
+
+    def relay(self, shard: int, sock: socket) -> None:
+        """Forward broadcasts from one worker to all the others."""
+        for event in self.read(shard, sock):
+            if event["op"] == "stats":
+                self.print_stats(shard, event["lines"])
+                continue
+            frame = encode_event(event)
+            for other, ((_, events), _) in enumerate(self.links):
+                if other != shard:
+                    self.send(events, frame)
+
+    def answer(self, shard: int, sock: socket) -> None:
+        """Answer requests from a worker."""
+        for request in self.read(shard, sock):
+            reply: Dict[str, Any] = {}
+            if request["op"] == "claim":
+                reply["ok"] = request["name"] not in self.roster
+                if reply["ok"]:
+                    self.roster[request["name"]] = (shard, request["host"])
+            elif request["op"] == "release":
+                if self.roster.get(request["name"], (None,))[0] == shard:
+                    del self.roster[request["name"]]
+                    self.tokens.pop(request["name"], None)
+            elif request["op"] == "session":
+                if self.roster.get(request["name"], (None,))[0] == shard:
+                    self.tokens[request["name"]] = request["token"]
+            elif request["op"] == "abandon":
+                reply["ok"] = self.abandon(shard, request["name"], request["token"])
+            elif request["op"] == "roster":
+                reply["users"] = [
+                    (name, host) for name, (_, host) in self.roster.items()
+                ]
+            elif request["op"] == "know":
+                self.mailboxes.know(request["name"])
+            elif request["op"] == "known":
+                reply["ok"] = self.mailboxes.known(request["name"])
+            elif request["op"] == "put":
+                reply["ok"] = self.mailboxes.put(request["name"], request["text"])
+            elif request["op"] == "take":
+                mail, reply["left"] = self.mailboxes.take(
+                    request["name"], request["max"]
+                )
+                reply["mail"] = [text.decode("utf-8") for text in mail]
+            self.send(sock, encode_event(reply))
+
+    def abandon(self, shard: int, name: str, token: str) -> bool:
+        """Free the name of a session kept on another shard, and end it there."""
+        owner = self.roster.get(name, (shard,))[0]
+        if owner == shard or not hmac.compare_digest(self.tokens.get(name, ""), token):
+            return False
+        del self.roster[name]
+        del self.tokens[name]
+        (_, events), _ = self.links[owner]
+        self.send(events, encode_event({"op": "abandon", "name": name}))
+        return True
+
+    def send(self, sock: socket, frame: bytes) -> None:
+        """Queue a frame for a worker, it is dropped if the worker has gone."""
+        self.queues[sock].put(frame)
+
+    def admin_input(self, shard: None, stdin: Any) -> None:
+        """Read administrative commands for the whole lair."""
+        command = input("")
+        if command == "quit":
+            self.close()
+        elif command == "who":
+            print(f'{" The lair dwellers! ":*^60}')
+            for name, (shard, host) in self.roster.items():
+                print(f"{name} @ {host} (shard {shard})")
+        elif command == "stats":
+            self.stats()
+        elif command.startswith("log"):
+            self.log_command(command[3:].strip())
+        else:
+            print(f"error: unknown command {command}")
+
+    def stats(self) -> None:
+        """Print the links to the workers, and ask every worker for its stats."""
+        print(f'{" Shard bus ":*^60}')
+        print(f"dwellers: {len(self.roster)}, shards: {len(self.links)}")
+        print(f"mail: {self.mailboxes.summary()}")
+        frame = encode_event({"op": "stats"})
+        for shard, ((_, events), _) in enumerate(self.links):
+            print(f"shard {shard}: {link_summary(self.queues[events])}")
+            self.send(events, frame)
+
+    def print_stats(self, shard: int, lines: List[str]) -> None:
+        """Print the stats a worker sent back."""
+        print(f'{f" Shard {shard} ":*^60}')
+        for line in lines:
+            print(line)
+
+    def log_command(self, level: str) -> None:
+        """Show the log level, or change it here and on every worker."""
+        if not level:
+            print(f"log level: {log_level()}")
+        elif not set_log_level(level):
+            print(f"error: log level must be one of {', '.join(LEVELS)}")
+        else:
+            frame = encode_event({"op": "log", "level": level})
+            for (_, events), _ in self.links:
+                self.send(events, frame)
+
+    def close(self) -> None:
+        """Tell every worker to close."""
+        if sys.stdin in self.sel.get_map():
+            self.sel.unregister(sys.stdin)
+        for (_, events), _ in self.links:
+            self.send(events, encode_event({"op": "close"}))
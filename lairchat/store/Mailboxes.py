@@ -0,0 +1,239 @@
+"""Mailboxes.py
+
+Messages kept for dwellers who are away.
+
+A mailbox holds records, each the time a message was sent and its length
+followed by its UTF-8 text, in a single byte buffer, so a small mailbox
+costs little more than its text.  A mailbox growing past the memory
+limit is spilled to a file of its own in the same format, later messages
+are appended to the file.  Every mailbox is capped in bytes, and
+messages older than the time to live are dropped by a sweep run at most
+once a minute and when a mailbox is emptied.  Without a directory there
+is nowhere to spill to and mailboxes are capped at the memory limit.
+
+Spilled mailboxes and the names of everybody who has logged in survive
+restarts, messages still in memory don't.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+from typing import *
+
+# Time a message was sent and the length of its text
+RECORD = struct.Struct("<dI")
+
+# Seconds between sweeps for expired messages
+SWEEP_INTERVAL = 60.0
+
+USERS = "users"
+
+
+def parse(data: bytes, since: float) -> List[Tuple[float, bytes]]:
+    """The time and text of the records in data sent since a time."""
+    records = []
+    position = 0
+    while position + RECORD.size <= len(data):
+        sent, length = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        if sent >= since:
+            records.append((sent, data[position : position + length]))
+        position += length
+    return records
+
+
+class Mailbox:
+    """The messages of one dweller."""
+
+    __slots__ = ("buffer", "spilled", "disk_bytes", "newest")
+
+    def __init__(self) -> None:
+        """Initialize an empty mailbox."""
+        self.buffer = bytearray()
+        self.spilled = False
+        self.disk_bytes = 0
+        self.newest = 0.0
+
+    @property
+    def size(self) -> int:
+        """Bytes held in memory and on disk."""
+        return len(self.buffer) + self.disk_bytes
+
+
+class Mailboxes:
+    """The mailboxes of everybody who has logged in."""
+
+    def __init__(
+        self,
+        directory: Union[str, None] = None,
+        memory_bytes: int = 4096,
+        cap_bytes: int = 1024 * 1024,
+        ttl: float = 7 * 24 * 60 * 60,
+    ) -> None:
+        """Initialize the mailboxes, spilling to directory unless it is None."""
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.cap_bytes = cap_bytes if directory is not None else memory_bytes
+        self.ttl = ttl
+        self.boxes: Dict[str, Mailbox] = {}
+        self.users: Set[str] = set()
+        self.lock = threading.Lock()
+        self.swept = time.time()
+
+        # Counters
+        self.spills = 0
+        self.refused = 0
+        self.expired = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+
+    def path(self, username: str) -> str:
+        """The file a mailbox spills to, named so any username is safe."""
+        return os.path.join(self.directory, f'{username.encode("utf-8").hex()}.box')
+
+    def load(self) -> None:
+        """Read the known names and find the spilled mailboxes."""
+        users_path = os.path.join(self.directory, USERS)
+        if os.path.exists(users_path):
+            with open(users_path, encoding="utf-8") as f:
+                self.users = {line.rstrip("\n") for line in f if line.strip()}
+
+        for filename in os.listdir(self.directory):
+            stem, extension = os.path.splitext(filename)
+            if extension != ".box":
+                continue
+            stat = os.stat(os.path.join(self.directory, filename))
+            box = self.boxes[bytes.fromhex(stem).decode("utf-8")] = Mailbox()
+            box.spilled = True
+            box.disk_bytes = stat.st_size
+            box.newest = stat.st_mtime
+
+    def know(self, username: str) -> None:
+        """Remember that somebody has logged in under a name."""
+        with self.lock:
+            if username in self.users:
+                return
+            self.users.add(username)
+            if self.directory is not None:
+                try:
+                    with open(
+                        os.path.join(self.directory, USERS), "a", encoding="utf-8"
+                    ) as f:
+                        f.write(f"{username}\n")
+                except OSError as e:
+                    logging.warning(f"Unable to remember {username}: {e}")
+
+    def known(self, username: str) -> bool:
+        """Tell if somebody has ever logged in under a name."""
+        return username in self.users
+
+    def put(self, username: str, text: str) -> bool:
+        """Keep a message for somebody, False if their mailbox is full."""
+        now = time.time()
+        payload = text.encode("utf-8")
+        record = RECORD.pack(now, len(payload)) + payload
+        with self.lock:
+            if now - self.swept >= SWEEP_INTERVAL:
+                self.sweep(now)
+            if (box := self.boxes.get(username)) is None:
+                box = self.boxes[username] = Mailbox()
+            if box.size + len(record) > self.cap_bytes:
+                self.refused += 1
+                return False
+            self.store(username, box, record)
+            box.newest = now
+        return True
+
+    def store(self, username: str, box: Mailbox, data: bytes) -> None:
+        """Add records to a mailbox, spilling it once it grows too large."""
+        if not box.spilled:
+            box.buffer += data
+            if len(box.buffer) <= self.memory_bytes or self.directory is None:
+                return
+            data = bytes(box.buffer)
+            box.buffer = bytearray()
+            box.spilled = True
+            self.spills += 1
+        try:
+            with open(self.path(username), "ab") as f:
+                f.write(data)
+            box.disk_bytes += len(data)
+        except OSError as e:
+            logging.warning(f"Unable to keep mail for {username}: {e}")
+
+    def take(
+        self, username: str, max_bytes: Union[int, None] = None
+    ) -> Tuple[List[bytes], int]:
+        """Empty a mailbox, oldest message first.
+
+        Returns the messages, up to max_bytes of them but at least one if
+        max_bytes isn't None, and how many are left in the mailbox.
+        """
+        now = time.time()
+        with self.lock:
+            if (box := self.boxes.pop(username, None)) is None:
+                return [], 0
+            data = b""
+            if box.spilled:
+                try:
+                    with open(self.path(username), "rb") as f:
+                        data = f.read()
+                    os.remove(self.path(username))
+                except OSError as e:
+                    logging.warning(f"Unable to read mail for {username}: {e}")
+            records = parse(data + box.buffer, now - self.ttl)
+
+            taken = len(records)
+            if max_bytes is not None:
+                size = 0
+                for i, (_, text) in enumerate(records):
+                    size += len(text) + 1
+                    if size > max_bytes and i:
+                        taken = i
+                        break
+
+            # Whatever didn't fit goes back in
+            if left := records[taken:]:
+                box = self.boxes[username] = Mailbox()
+                box.newest = left[-1][0]
+                self.store(
+                    username,
+                    box,
+                    b"".join(RECORD.pack(t, len(text)) + text for t, text in left),
+                )
+        return [text for _, text in records[:taken]], len(left)
+
+    def sweep(self, now: float) -> None:
+        """Drop expired messages, emptying whole mailboxes where it can."""
+        self.swept = now
+        since = now - self.ttl
+        for username, box in list(self.boxes.items()):
+            if box.newest < since:
+                if box.spilled:
+                    try:
+                        os.remove(self.path(username))
+                    except OSError as e:
+                        logging.warning(f"Unable to remove mail of {username}: {e}")
+                del self.boxes[username]
+                self.expired += 1
+            elif box.buffer and RECORD.unpack_from(box.buffer)[0] < since:
+                records = parse(bytes(box.buffer), since)
+                box.buffer = bytearray(
+                    b"".join(RECORD.pack(t, len(text)) + text for t, text in records)
+                )
+
+    def summary(self) -> str:
+        """A line for people."""
+        with self.lock:
+            memory = sum(len(box.buffer) for box in self.boxes.values())
+            disk = sum(box.disk_bytes for box in self.boxes.values())
+            spilled = sum(1 for box in self.boxes.values() if box.spilled)
+            boxes = len(self.boxes)
+        return (
+            f"{boxes} mailboxes, {spilled} on disk, {memory} B in memory,"
+            f" {disk} B on disk, {self.refused} refused, {self.expired} expired"
+        )
@@ -0,0 +1,485 @@
+"""MessageLog.py
+
+Durable chat history kept in segmented append-only logs.
+
+Every room has a directory of segments.  A segment is a log file of
+records, each a header holding the payload length, its CRC-32 and the
+time it was written followed by the UTF-8 text, and an index file of
+fixed-width entries, the position of a record in the log and its time.
+Entry n of a segment describes its record n, so the index of a mapped
+segment leads straight to any record by number, and as times only grow
+a binary search of the index finds the first record since any time.
+
+Broadcasts only queue their records.  A background writer takes whatever
+has been queued, appends it to the logs and indexes, then flushes every
+file it touched with a single fsync each: a group commit.  Segments roll
+once they grow too large or too old, and whole segments are deleted to
+keep a room's history within its size and age limits.  On start up a
+torn write at the end of the last segment is cut off.
+
+Only so many rooms have their logs open at once, the files of the room
+least recently written or read are closed to make room for another.  A
+room is a directory named after it, so only a # and letters or digits
+are taken for a room name.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import *
+
+# Payload length, CRC-32 of the payload and time of a record
+RECORD = struct.Struct("!IId")
+
+# Position of a record in the log and its time
+INDEX = struct.Struct("!Qd")
+
+
+def valid_room(room: str) -> bool:
+    """Tell if a room name is safe to name a directory after."""
+    return room[:1] == "#" and room[1:].isalnum()
+
+
+class Segment:
+    """A log file and the index of its records."""
+
+    def __init__(self, directory: str, base: int) -> None:
+        """Initialize the segment holding records from number base on."""
+        self.base = base
+        self.log_path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.idx")
+        self.log: Union[BinaryIO, None] = None
+        self.index: Union[BinaryIO, None] = None
+        self.map: Union[mmap.mmap, None] = None
+        self.count = 0
+        self.size = 0
+        self.created = time.time()
+        self.last_time = 0.0
+
+    @property
+    def end(self) -> int:
+        """Number of the record after the last one in the segment."""
+        return self.base + self.count
+
+    def open(self) -> None:
+        """Open the segment for appending, cutting off any torn write."""
+        self.log = open(self.log_path, "ab")
+        self.index = open(self.index_path, "ab")
+        log_size = os.path.getsize(self.log_path)
+
+        # Keep whole index entries of complete and intact records only
+        with open(self.log_path, "rb") as log, open(self.index_path, "rb") as index:
+            entries = index.read()
+            count = len(entries) // INDEX.size
+            while count:
+                position, _ = INDEX.unpack_from(entries, (count - 1) * INDEX.size)
+                log.seek(position)
+                if self.intact(log.read(log_size - position)):
+                    break
+                count -= 1
+
+        self.count = count
+        if count:
+            first = INDEX.unpack_from(entries, 0)
+            last = INDEX.unpack_from(entries, (count - 1) * INDEX.size)
+            self.created = first[1]
+            self.last_time = last[1]
+            with open(self.log_path, "rb") as log:
+                log.seek(last[0])
+                length, _, _ = RECORD.unpack(log.read(RECORD.size))
+            self.size = last[0] + RECORD.size + length
+        self.log.truncate(self.size)
+        self.index.truncate(count * INDEX.size)
+
+    @staticmethod
+    def intact(data: bytes) -> bool:
+        """Tell if data starts with a whole record that isn't corrupt."""
+        if len(data) < RECORD.size:
+            return False
+        length, crc, _ = RECORD.unpack_from(data)
+        payload = data[RECORD.size : RECORD.size + length]
+        return len(payload) == length and zlib.crc32(payload) == crc
+
+    def append(self, records: List[Tuple[float, bytes]]) -> None:
+        """Append records, each a time and a payload, to the log and index."""
+        log_data = []
+        index_data = []
+        for record_time, payload in records:
+            index_data.append(INDEX.pack(self.size, record_time))
+            log_data.append(RECORD.pack(len(payload), zlib.crc32(payload), record_time))
+            log_data.append(payload)
+            self.size += RECORD.size + len(payload)
+            self.last_time = record_time
+        self.count += len(records)
+
+        # Records before their index entries, readers only follow the index
+        self.log.write(b"".join(log_data))
+        self.log.flush()
+        self.index.write(b"".join(index_data))
+        self.index.flush()
+
+    def sync(self) -> None:
+        """Make everything appended durable."""
+        os.fsync(self.log.fileno())
+        os.fsync(self.index.fileno())
+
+    def seal(self) -> None:
+        """Stop appending, the index of a sealed segment stays mapped."""
+        self.sync()
+        self.log.close()
+        self.index.close()
+        self.log = self.index = None
+
+    def entries(self) -> Union[mmap.mmap, bytes]:
+        """The index entries, mapped into memory."""
+        if self.map is not None:
+            return self.map
+        if self.count == 0:
+            return b""
+        with open(self.index_path, "rb") as index:
+            entries = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.log is None:
+            self.map = entries
+        return entries
+
+    def read(self, start: int, stop: int) -> List[Tuple[float, bytes]]:
+        """Read records start to stop, numbered within the segment."""
+        if start >= stop:
+            return []
+        entries = self.entries()
+        first, _ = INDEX.unpack_from(entries, start * INDEX.size)
+        if stop < self.count:
+            last, _ = INDEX.unpack_from(entries, stop * INDEX.size)
+        else:
+            last = self.size
+
+        # The records are next to each other, read them in one go
+        with open(self.log_path, "rb") as log:
+            log.seek(first)
+            data = log.read(last - first)
+
+        records = []
+        position = 0
+        while position < len(data):
+            length, _, record_time = RECORD.unpack_from(data, position)
+            position += RECORD.size
+            records.append((record_time, data[position : position + length]))
+            position += length
+        return records
+
+    def find(self, since: float) -> int:
+        """Number within the segment of the first record at or after since."""
+        entries = self.entries()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX.unpack_from(entries, middle * INDEX.size)[1] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def close(self) -> None:
+        """Close the files of the segment."""
+        if self.log is not None:
+            self.seal()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def delete(self) -> None:
+        """Remove the segment from disk."""
+        self.close()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"Unable to remove {path}: {e}")
+
+
+class RoomLog:
+    """The segments holding the history of a room."""
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int,
+        segment_age: float,
+        retain_bytes: int,
+        retain_age: float,
+    ) -> None:
+        """Open the history of a room, creating it if need be."""
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.retain_bytes = retain_bytes
+        self.retain_age = retain_age
+        self.lock = threading.Lock()
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(
+            int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log")
+        )
+        self.segments = [Segment(directory, base) for base in bases]
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+
+        # Sealed segments are read through their index alone
+        for segment in self.segments[:-1]:
+            segment.count = os.path.getsize(segment.index_path) // INDEX.size
+            segment.size = os.path.getsize(segment.log_path)
+            if segment.count:
+                segment.last_time = INDEX.unpack_from(
+                    segment.entries(), (segment.count - 1) * INDEX.size
+                )[1]
+        self.segments[-1].open()
+
+    def append(self, records: List[Tuple[float, bytes]]) -> Union[Segment, None]:
+        """Append records, return the segment that needs to be synced.
+
+        None if the log was closed, the room has to be opened again.
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            active = self.segments[-1]
+            batch: List[Tuple[float, bytes]] = []
+            size = active.size
+            for record_time, payload in records:
+                if size >= self.segment_bytes or (
+                    active.count + len(batch)
+                    and record_time - active.created >= self.segment_age
+                ):
+                    active.append(batch)
+                    active = self.roll()
+                    batch = []
+                    size = 0
+
+                # Times never go back, so the index can be searched by time
+                record_time = max(record_time, active.last_time)
+                if batch:
+                    record_time = max(record_time, batch[-1][0])
+                batch.append((record_time, payload))
+                size += RECORD.size + len(payload)
+            active.append(batch)
+            self.retain(batch[-1][0])
+        return active
+
+    def sync(self, segment: Segment) -> None:
+        """Make what was appended to a segment durable, closing it already did."""
+        with self.lock:
+            if not self.closed and segment.log is not None:
+                segment.sync()
+
+    def roll(self) -> Segment:
+        """Seal the active segment and start a new one."""
+        sealed = self.segments[-1]
+        sealed.seal()
+        active = Segment(self.directory, sealed.end)
+        active.last_time = sealed.last_time
+        active.open()
+        self.segments.append(active)
+        return active
+
+    def retain(self, now: float) -> None:
+        """Delete the oldest segments beyond the size and age limits."""
+        size = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if size <= self.retain_bytes and now - oldest.last_time <= self.retain_age:
+                break
+            size -= oldest.size
+            oldest.delete()
+            del self.segments[0]
+
+    def last(self, count: int) -> Union[List[Tuple[float, bytes]], None]:
+        """The last count records, oldest first, None if the log was closed."""
+        with self.lock:
+            if self.closed:
+                return None
+            start = max(self.segments[-1].end - count, self.segments[0].base)
+            return self.read(start, count)
+
+    def since(self, since: float, count: int) -> Union[List[Tuple[float, bytes]], None]:
+        """Up to count records from since on, oldest first, None if closed."""
+        with self.lock:
+            if self.closed:
+                return None
+            for segment in self.segments:
+                if segment.count and segment.last_time >= since:
+                    return self.read(segment.base + segment.find(since), count)
+            return []
+
+    def read(self, start: int, count: int) -> List[Tuple[float, bytes]]:
+        """Read up to count records from record number start on."""
+        records: List[Tuple[float, bytes]] = []
+        for segment in self.segments:
+            if len(records) >= count:
+                break
+            if segment.end <= start:
+                continue
+            first = max(start, segment.base) - segment.base
+            stop = min(segment.count, first + count - len(records))
+            records += segment.read(first, stop)
+        return records
+
+    def close(self) -> None:
+        """Close every segment."""
+        with self.lock:
+            self.closed = True
+            for segment in self.segments:
+                segment.close()
+
+
+class MessageLog:
+    """Durable history of every room, written by a background thread."""
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 16 * 1024 * 1024,
+        segment_age: float = 24 * 60 * 60,
+        retain_bytes: int = 1024 * 1024 * 1024,
+        retain_age: float = 30 * 24 * 60 * 60,
+        commit_interval: float = 0.005,
+        open_rooms: int = 128,
+    ) -> None:
+        """Open the history kept in a directory, open_rooms at a time."""
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.retain_bytes = retain_bytes
+        self.retain_age = retain_age
+        self.commit_interval = commit_interval
+        self.open_rooms = open_rooms
+        self.rooms: OrderedDict[str, RoomLog] = OrderedDict()
+        self.rooms_lock = threading.Lock()
+        self.pending: List[Tuple[str, float, str]] = []
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # Counters
+        self.records = 0
+        self.commits = 0
+        self.syncs = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.writer = threading.Thread(
+            target=self.writer_loop, name="message-log", daemon=True
+        )
+        self.writer.start()
+
+    def path(self, room: str) -> str:
+        """The directory of the segments of a room."""
+        return os.path.join(self.directory, room[1:])
+
+    def written(self, room: str) -> bool:
+        """Tell if a room has a log, reading one doesn't create it."""
+        return valid_room(room) and (
+            room in self.rooms or os.path.isdir(self.path(room))
+        )
+
+    def room(self, room: str) -> RoomLog:
+        """The log of a room, opened on first use.
+
+        The room used least recently is closed once too many are open, it
+        is closed before it can be opened again.
+        """
+        if not valid_room(room):
+            raise ValueError(f"{room!r} is not a room name")
+        with self.rooms_lock:
+            if (log := self.rooms.get(room)) is not None:
+                self.rooms.move_to_end(room)
+                return log
+            log = self.rooms[room] = RoomLog(
+                self.path(room),
+                self.segment_bytes,
+                self.segment_age,
+                self.retain_bytes,
+                self.retain_age,
+            )
+            while len(self.rooms) > self.open_rooms:
+                self.rooms.popitem(last=False)[1].close()
+            return log
+
+    def append(self, room: str, text: str) -> None:
+        """Queue a message broadcast to a room for writing."""
+        if not valid_room(room):
+            logging.warning(f"Not logging a message to {room!r}")
+            return
+        with self.cond:
+            self.pending.append((room, time.time(), text))
+            if len(self.pending) == 1:
+                self.cond.notify()
+
+    def writer_loop(self) -> None:
+        """Write queued messages in group commits until closed."""
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+
+            # Let more messages join the commit
+            if self.commit_interval > 0 and not self.closed:
+                time.sleep(self.commit_interval)
+            with self.cond:
+                pending, self.pending = self.pending, []
+
+            try:
+                self.commit(pending)
+            except OSError as e:
+                logging.error(f"Unable to write history: {e}")
+
+    def commit(self, pending: List[Tuple[str, float, str]]) -> None:
+        """Append messages to the logs of their rooms and sync once per file."""
+        by_room: Dict[str, List[Tuple[float, bytes]]] = {}
+        for room, record_time, text in pending:
+            by_room.setdefault(room, []).append((record_time, text.encode("utf-8")))
+
+        # A room closed since it was looked up is opened again
+        touched = []
+        for room, records in by_room.items():
+            log = self.room(room)
+            while (segment := log.append(records)) is None:
+                log = self.room(room)
+            touched.append((log, segment))
+        for log, segment in touched:
+            log.sync(segment)
+
+        self.records += len(pending)
+        self.commits += 1
+        self.syncs += len(touched)
+
+    def last(self, room: str, count: int) -> List[Tuple[float, bytes]]:
+        """The time and UTF-8 text of the last count messages of a room."""
+        if not self.written(room):
+            return []
+        while (records := self.room(room).last(count)) is None:
+            pass
+        return records
+
+    def since(self, room: str, since: float, count: int) -> List[Tuple[float, bytes]]:
+        """Time and UTF-8 text of up to count messages of a room from since on."""
+        if not self.written(room):
+            return []
+        while (records := self.room(room).since(since, count)) is None:
+            pass
+        return records
+
+    def close(self) -> None:
+        """Write whatever is queued and close the logs."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
+        with self.rooms_lock:
+            for log in self.rooms.values():
+                log.close()
@@ -0,0 +1,557 @@
+"""SearchIndex.py
+
+Full-text search over the messages of every room.
+
+Messages are split into lower case words and added to an in-memory
+segment mapping every word to the numbers of the messages holding it.
+Once it holds enough messages a background thread writes the segment to
+disk, then merges the newest segments whenever enough of them are the
+same size, so there are only ever a few segments to search.
+
+A segment on disk is four files:
+
+    .docs   the messages, each a header followed by the room and text
+    .dix    the fixed-width position of every message in .docs
+    .post   posting lists, the message numbers holding a word in blocks
+            of BLOCK numbers, each block a first number followed by the
+            differences to the next ones in as few bytes as they fit,
+            behind a table of the last number and end of every block
+    .terms  the sorted words, with the position and length of their list
+
+A manifest lists the segments in use and is replaced atomically, so files
+left behind by a flush or merge that never finished are simply removed.
+Files the index didn't write are left alone.
+
+Message numbers only grow, so the newest messages have the highest ones.
+A query walks the list of its rarest word backwards, newest segment
+first, checks the other words through their block tables and stops as
+soon as it has a page of results.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import *
+
+# Message numbers in a posting list block
+BLOCK = 128
+
+# Longest word indexed, anything longer is hardly something to search for
+MAX_WORD = 64
+
+# Time, room length and text length of a message
+DOC = struct.Struct("<dBI")
+
+# Position of a message in .docs
+POSITION = struct.Struct("<Q")
+
+# Number of messages and of blocks in a posting list
+LIST = struct.Struct("<II")
+
+# Length of a word, position and length of its posting list
+TERM = struct.Struct("<HQI")
+
+# First number of a block, after the type code of its differences
+BLOCK_HEAD = struct.Struct("<cI")
+
+# Array type code of 4 byte unsigned numbers
+INT = "I" if array("I").itemsize == 4 else "L"
+
+MANIFEST = "manifest.json"
+
+# The files of a segment, and a manifest that was never put in place
+INDEX_FILE = re.compile(r"(\d{12}-\d{12})\.(docs|dix|post|terms)|manifest\.json\.tmp")
+
+WORD = re.compile(r"\w+")
+
+
+def split_words(text: str) -> Set[str]:
+    """The distinct lower case words of a text."""
+    return {word for word in WORD.findall(text.lower()) if len(word) <= MAX_WORD}
+
+
+def dump_array(numbers: array) -> bytes:
+    """The little endian bytes of an array."""
+    if sys.byteorder == "big":
+        numbers = array(numbers.typecode, numbers)
+        numbers.byteswap()
+    return numbers.tobytes()
+
+
+def load_array(typecode: str, data: bytes) -> array:
+    """An array of little endian numbers."""
+    numbers = array(typecode)
+    numbers.frombytes(data)
+    if sys.byteorder == "big":
+        numbers.byteswap()
+    return numbers
+
+
+def encode_block(numbers: List[int]) -> bytes:
+    """Encode ascending numbers as the first one and the differences."""
+    deltas = [b - a for a, b in zip(numbers, numbers[1:])]
+    widest = max(deltas, default=0)
+    code = "B" if widest < 1 << 8 else "H" if widest < 1 << 16 else INT
+    return BLOCK_HEAD.pack(code.encode(), numbers[0]) + dump_array(array(code, deltas))
+
+
+def decode_block(data: bytes) -> List[int]:
+    """Decode a block of numbers."""
+    code, first = BLOCK_HEAD.unpack_from(data)
+    deltas = load_array(code.decode(), data[BLOCK_HEAD.size :])
+    return list(itertools.accumulate(deltas, initial=first))
+
+
+def encode_postings(numbers: List[int]) -> bytes:
+    """Encode an ascending posting list."""
+    starts = range(0, len(numbers), BLOCK)
+    blocks = [encode_block(numbers[i : i + BLOCK]) for i in starts]
+    lasts = array(INT, [numbers[min(i + BLOCK, len(numbers)) - 1] for i in starts])
+    ends = array(INT, itertools.accumulate(len(block) for block in blocks))
+    return b"".join(
+        [LIST.pack(len(numbers), len(blocks)), dump_array(lasts), dump_array(ends)]
+        + blocks
+    )
+
+
+def map_file(path: str) -> Union[mmap.mmap, bytes]:
+    """Map a file into memory for reading."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_file(path: str, chunks: Iterable[bytes]) -> None:
+    """Write a file and make it durable."""
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Postings:
+    """The numbers of the messages holding a word, in a segment on disk."""
+
+    __slots__ = ("data", "count", "lasts", "ends", "start", "cached", "numbers")
+
+    def __init__(self, data: bytes) -> None:
+        """Read the block table of an encoded posting list."""
+        self.data = data
+        self.count, blocks = LIST.unpack_from(data)
+        table = LIST.size + 4 * blocks
+        self.lasts = load_array(INT, data[LIST.size : table])
+        self.ends = load_array(INT, data[table : table + 4 * blocks])
+        self.start = table + 4 * blocks
+        self.cached = -1
+        self.numbers: List[int] = []
+
+    def block(self, i: int) -> List[int]:
+        """The numbers of block i, the last block read is kept decoded."""
+        if i != self.cached:
+            begin = self.start + (self.ends[i - 1] if i else 0)
+            self.numbers = decode_block(self.data[begin : self.start + self.ends[i]])
+            self.cached = i
+        return self.numbers
+
+    def all(self) -> List[int]:
+        """Every number, ascending."""
+        numbers: List[int] = []
+        for i in range(len(self.lasts)):
+            numbers += self.block(i)
+        return numbers
+
+    def descending(self) -> Iterator[int]:
+        """Every number, newest message first."""
+        for i in range(len(self.lasts) - 1, -1, -1):
+            yield from reversed(self.block(i))
+
+    def __contains__(self, number: int) -> bool:
+        """Tell if a message holds the word, decoding one block at most."""
+        if (i := bisect_left(self.lasts, number)) == len(self.lasts):
+            return False
+        numbers = self.block(i)
+        j = bisect_left(numbers, number)
+        return j < len(numbers) and numbers[j] == number
+
+
+class ListPostings:
+    """The numbers of the messages holding a word, in memory."""
+
+    __slots__ = ("numbers", "count")
+
+    def __init__(self, numbers: List[int], stop: int) -> None:
+        """Use the numbers below stop of a list that may still grow."""
+        self.numbers = numbers
+        self.count = bisect_left(numbers, stop)
+
+    def descending(self) -> Iterator[int]:
+        """Every number, newest message first."""
+        for i in range(self.count - 1, -1, -1):
+            yield self.numbers[i]
+
+    def __contains__(self, number: int) -> bool:
+        """Tell if a message holds the word."""
+        i = bisect_left(self.numbers, number, 0, self.count)
+        return i < self.count and self.numbers[i] == number
+
+
+class MemorySegment:
+    """The most recent messages, indexed in memory."""
+
+    def __init__(self, base: int) -> None:
+        """Initialize the segment numbering its messages from base on."""
+        self.base = base
+        self.postings: Dict[str, List[int]] = {}
+        self.docs: List[Tuple[float, str, str]] = []
+
+    @property
+    def count(self) -> int:
+        """Number of messages in the segment."""
+        return len(self.docs)
+
+    @property
+    def end(self) -> int:
+        """Number of the message after the last one in the segment."""
+        return self.base + len(self.docs)
+
+    def add(self, when: float, room: str, text: str) -> None:
+        """Index a message."""
+        number = len(self.docs)
+        self.docs.append((when, room, text))
+        postings = self.postings
+        for word in split_words(text):
+            if (numbers := postings.get(word)) is None:
+                postings[word] = [number]
+            else:
+                numbers.append(number)
+
+    def lookup(self, word: str, stop: int) -> Union[ListPostings, None]:
+        """The postings of a word among the first stop messages."""
+        if (numbers := self.postings.get(word)) is None:
+            return None
+        return ListPostings(numbers, stop)
+
+    def doc(self, number: int) -> Tuple[float, str, str]:
+        """Time, room and text of a message."""
+        return self.docs[number]
+
+
+class DiskSegment:
+    """Messages indexed in files, read through memory maps."""
+
+    def __init__(self, directory: str, name: str, base: int) -> None:
+        """Open a segment numbering its messages from base on."""
+        self.name = name
+        self.base = base
+        self.prefix = os.path.join(directory, name)
+        self.docs = map_file(self.prefix + ".docs")
+        self.dix = map_file(self.prefix + ".dix")
+        self.post = map_file(self.prefix + ".post")
+        self.count = len(self.dix) // POSITION.size
+
+        # The dictionary is small next to the posting lists, keep it in memory
+        self.terms: Dict[str, Tuple[int, int]] = {}
+        with open(self.prefix + ".terms", "rb") as f:
+            data = f.read()
+        position = 0
+        while position < len(data):
+            length, start, size = TERM.unpack_from(data, position)
+            position += TERM.size
+            word = data[position : position + length].decode("utf-8")
+            self.terms[word] = (start, size)
+            position += length
+
+    @property
+    def end(self) -> int:
+        """Number of the message after the last one in the segment."""
+        return self.base + self.count
+
+    def lookup(self, word: str, stop: int) -> Union[Postings, None]:
+        """The postings of a word."""
+        if (entry := self.terms.get(word)) is None:
+            return None
+        start, size = entry
+        return Postings(self.post[start : start + size])
+
+    def doc(self, number: int) -> Tuple[float, str, str]:
+        """Time, room and text of a message."""
+        (position,) = POSITION.unpack_from(self.dix, number * POSITION.size)
+        when, room_length, text_length = DOC.unpack_from(self.docs, position)
+        position += DOC.size
+        room = self.docs[position : position + room_length].decode("utf-8")
+        position += room_length
+        text = self.docs[position : position + text_length].decode("utf-8")
+        return when, room, text
+
+    def delete(self) -> None:
+        """Remove the files of the segment.
+
+        Queries still holding the segment keep reading its memory maps.
+        """
+        for extension in (".docs", ".dix", ".post", ".terms"):
+            try:
+                os.remove(self.prefix + extension)
+            except OSError as e:
+                logging.warning(f"Unable to remove {self.prefix}{extension}: {e}")
+
+
+def write_postings(prefix: str, items: Iterable[Tuple[str, List[int]]]) -> None:
+    """Write the sorted words and their posting lists of a segment."""
+    terms = []
+    position = 0
+
+    def lists() -> Iterator[bytes]:
+        """Encode the posting lists, noting where each one goes."""
+        nonlocal position
+        for word, numbers in items:
+            data = encode_postings(numbers)
+            encoded = word.encode("utf-8")
+            terms.append(TERM.pack(len(encoded), position, len(data)) + encoded)
+            position += len(data)
+            yield data
+
+    write_file(prefix + ".post", lists())
+    write_file(prefix + ".terms", terms)
+
+
+def write_segment(directory: str, segment: MemorySegment) -> DiskSegment:
+    """Write a segment held in memory to disk."""
+    name = f"{segment.base:012d}-{segment.end:012d}"
+    prefix = os.path.join(directory, name)
+
+    docs = []
+    positions = array("Q")
+    position = 0
+    for when, room, text in segment.docs:
+        encoded_room = room.encode("utf-8")
+        encoded_text = text.encode("utf-8")
+        docs.append(DOC.pack(when, len(encoded_room), len(encoded_text)))
+        docs.append(encoded_room)
+        docs.append(encoded_text)
+        positions.append(position)
+        position += DOC.size + len(encoded_room) + len(encoded_text)
+
+    write_file(prefix + ".docs", docs)
+    write_file(prefix + ".dix", [dump_array(positions)])
+    write_postings(prefix, sorted(segment.postings.items()))
+    return DiskSegment(directory, name, segment.base)
+
+
+def merge_segments(directory: str, segments: List[DiskSegment]) -> DiskSegment:
+    """Merge consecutive segments into one."""
+    base = segments[0].base
+    name = f"{base:012d}-{segments[-1].end:012d}"
+    prefix = os.path.join(directory, name)
+
+    # Messages are copied as they are, only their positions move up
+    write_file(prefix + ".docs", (segment.docs for segment in segments))
+    shifted = []
+    shift = 0
+    for segment in segments:
+        positions = load_array("Q", segment.dix)
+        shifted.append(dump_array(array("Q", [p + shift for p in positions])))
+        shift += len(segment.docs)
+    write_file(prefix + ".dix", shifted)
+
+    def items() -> Iterator[Tuple[str, List[int]]]:
+        """Walk the sorted words of all segments together."""
+        words = heapq.merge(*(iter(segment.terms) for segment in segments))
+        for word, _ in itertools.groupby(words):
+            numbers: List[int] = []
+            for segment in segments:
+                if (postings := segment.lookup(word, segment.count)) is not None:
+                    offset = segment.base - base
+                    numbers += [number + offset for number in postings.all()]
+            yield word, numbers
+
+    write_postings(prefix, items())
+    return DiskSegment(directory, name, base)
+
+
+class SearchIndex:
+    """An inverted index of the messages of every room."""
+
+    def __init__(
+        self, directory: str, flush_messages: int = 100000, merge_factor: int = 4
+    ) -> None:
+        """Open the index kept in a directory."""
+        self.directory = directory
+        self.flush_messages = flush_messages
+        self.merge_factor = merge_factor
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = self.load()
+        self.live = MemorySegment(self.segments[-1].end if self.segments else 0)
+        self.frozen: List[MemorySegment] = []
+
+        # Counters
+        self.flushes = 0
+        self.merges = 0
+
+        self.writer = threading.Thread(
+            target=self.writer_loop, name="search-index", daemon=True
+        )
+        self.writer.start()
+
+    def load(self) -> List[DiskSegment]:
+        """Open the segments of the manifest, removing any other index files."""
+        path = os.path.join(self.directory, MANIFEST)
+        segments = []
+        if os.path.exists(path):
+            with open(path) as f:
+                for entry in json.load(f)["segments"]:
+                    segments.append(
+                        DiskSegment(self.directory, entry["name"], entry["base"])
+                    )
+
+        names = {segment.name for segment in segments}
+        for filename in os.listdir(self.directory):
+            if (match := INDEX_FILE.fullmatch(filename)) is None:
+                continue
+            if match.group(1) not in names:
+                os.remove(os.path.join(self.directory, filename))
+        return segments
+
+    def save(self) -> None:
+        """Replace the manifest with the segments in use."""
+        path = os.path.join(self.directory, MANIFEST)
+        manifest = {
+            "segments": [
+                {"name": segment.name, "base": segment.base}
+                for segment in self.segments
+            ]
+        }
+        write_file(path + ".tmp", [json.dumps(manifest).encode("utf-8")])
+        os.replace(path + ".tmp", path)
+
+    @property
+    def messages(self) -> int:
+        """Number of messages indexed."""
+        return self.live.end
+
+    def add(self, room: str, text: str, when: Union[float, None] = None) -> None:
+        """Index a message sent to a room."""
+        with self.lock:
+            self.live.add(time.time() if when is None else when, room, text)
+            if self.live.count >= self.flush_messages:
+                self.frozen.append(self.live)
+                self.live = MemorySegment(self.live.end)
+                self.cond.notify()
+
+    def writer_loop(self) -> None:
+        """Write full segments to disk and merge them until closed."""
+        while True:
+            with self.lock:
+                while not self.frozen and not self.closed:
+                    self.cond.wait()
+                if not self.frozen:
+                    return
+                segment = self.frozen[0]
+
+            try:
+                written = write_segment(self.directory, segment)
+            except OSError as e:
+                logging.error(f"Unable to write search index: {e}")
+                written = None
+
+            with self.lock:
+                del self.frozen[0]
+                if written is not None:
+                    self.segments.append(written)
+                    self.save()
+                    self.flushes += 1
+
+            try:
+                self.merge()
+            except OSError as e:
+                logging.error(f"Unable to merge search index: {e}")
+
+    def tier(self, segment: DiskSegment) -> int:
+        """Size class of a segment, each one merge_factor times the last."""
+        ratio = max(1.0, segment.count / self.flush_messages)
+        return int(math.log(ratio, self.merge_factor) + 1e-9)
+
+    def merge(self) -> None:
+        """Merge the newest segments while enough of them are the same size."""
+        while True:
+            # Only this thread changes the segments, they can be read unlocked
+            tail = self.segments[-self.merge_factor :]
+            if len(tail) < self.merge_factor or len(set(map(self.tier, tail))) > 1:
+                return
+
+            merged = merge_segments(self.directory, tail)
+            with self.lock:
+                self.segments = self.segments[: -self.merge_factor] + [merged]
+                self.save()
+                self.merges += 1
+            for segment in tail:
+                segment.delete()
+
+    def search(
+        self, words: Iterable[str], room: Union[str, None], offset: int, limit: int
+    ) -> Tuple[List[Tuple[float, str, str]], bool]:
+        """Messages holding every word, newest first, and if there are more.
+
+        Returns the time, room and text of up to limit messages after the
+        first offset ones, only those sent to room unless it is None.
+        """
+        words = list(words)
+        with self.lock:
+            live, stop = self.live, self.live.count
+            segments = [live] + self.frozen[::-1] + self.segments[::-1]
+
+        wanted = offset + limit + 1
+        found = []
+        for segment in segments:
+            for number in self.matches(segment, words, stop):
+                doc = segment.doc(number)
+                if room is None or doc[1] == room:
+                    found.append(doc)
+                    if len(found) == wanted:
+                        return found[offset : offset + limit], True
+            stop = math.inf
+        return found[offset : offset + limit], False
+
+    @staticmethod
+    def matches(
+        segment: Union[MemorySegment, DiskSegment], words: List[str], stop: int
+    ) -> Iterator[int]:
+        """Numbers of the messages of a segment holding every word, newest first."""
+        lists = []
+        for word in words:
+            if (postings := segment.lookup(word, stop)) is None:
+                return
+            lists.append(postings)
+        lists.sort(key=lambda postings: postings.count)
+
+        # Walk the rarest word, the others only need to be checked
+        rarest, others = lists[0], lists[1:]
+        for number in rarest.descending():
+            if all(number in postings for postings in others):
+                yield number
+
+    def close(self) -> None:
+        """Write the messages still in memory and stop the writer."""
+        with self.lock:
+            if self.live.count:
+                self.frozen.append(self.live)
+                self.live = MemorySegment(self.live.end)
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
@@ -3,7 +3,14 @@ from setuptools import setup
 setup(
     name="The Lair",
     version="0.1.1",
-    packages=["lairchat", "lairchat.cli", "lairchat.gui", "lairchat.crypto"],
+    packages=[
+        "lairchat",
+        "lairchat.cli",
+        "lairchat.gui",
+        "lairchat.crypto",
+        "lairchat.net",
+        "lairchat.store",
+    ],
     url="https://github.com/berrym/lair",
     license="GPLv3",
     author="Michael Berry",
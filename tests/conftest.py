@@ -0,0 +1,9 @@
+"""conftest.py
+
+The Lair: let the tests import lairchat from the source tree.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
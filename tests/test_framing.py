@@ -0,0 +1,97 @@
+"""test_framing.py
+
+The Lair: frames are split off a byte stream however it is read.
+"""
+
+import pytest
+
+from lairchat.crypto.AESCipher import aes_cipher
+from lairchat.net.Framing import (
+    FRAMED,
+    HEADER,
+    LEGACY,
+    FrameDecoder,
+    FrameError,
+    WireCodec,
+    encode_frame,
+    encode_hello,
+)
+from lairchat.net.Resume import GREETING
+
+PAYLOADS = [b"a", b"", b"hello" * 100, bytes(range(256))]
+
+
+def test_frames_packed_into_one_read() -> None:
+    """Every frame of a read comes out, in order."""
+    decoder = FrameDecoder()
+    data = b"".join(encode_frame(payload) for payload in PAYLOADS)
+    assert decoder.feed(data) == PAYLOADS
+    assert not decoder.buffer
+
+
+def test_frames_split_across_reads() -> None:
+    """A frame fed a byte at a time comes out once it is complete."""
+    decoder = FrameDecoder()
+    data = b"".join(encode_frame(payload) for payload in PAYLOADS)
+    frames = []
+    for i in range(len(data)):
+        frames += decoder.feed(data[i : i + 1])
+    assert frames == PAYLOADS
+
+
+def test_frame_split_in_its_header() -> None:
+    """Half a header waits for the rest, and so does a frame after a whole one."""
+    decoder = FrameDecoder()
+    first, second = encode_frame(b"one"), encode_frame(b"two")
+    assert decoder.feed(first + second[:2]) == [b"one"]
+    assert decoder.feed(second[2:5]) == []
+    assert decoder.feed(second[5:]) == [b"two"]
+
+
+def test_oversize_header() -> None:
+    """A header announcing too large a frame is refused before its payload."""
+    decoder = FrameDecoder(max_frame_size=16)
+    assert decoder.feed(encode_frame(b"x" * 16)) == [b"x" * 16]
+    with pytest.raises(FrameError):
+        decoder.feed(HEADER.pack(17))
+    with pytest.raises(FrameError):
+        encode_frame(b"x" * (1 << 24))
+
+
+def test_framed_client_detected() -> None:
+    """A hello makes the codec framed, messages after it in the read decode."""
+    client = WireCodec(FRAMED)
+    server = WireCodec()
+    data = encode_hello() + client.encode("name") + client.encode("hi there")
+    assert server.feed(data) == [b"name", b"hi there"]
+    assert server.mode == FRAMED
+
+
+def test_legacy_client_detected() -> None:
+    """Base64 makes the codec legacy, a read is a message."""
+    server = WireCodec()
+    assert server.feed(aes_cipher.encrypt("name")) == [b"name"]
+    assert server.mode == LEGACY
+    assert server.feed(aes_cipher.encrypt("hi there")) == [b"hi there"]
+
+
+def test_late_legacy_greeting_skipped() -> None:
+    """A framed client skips the legacy greeting of a server it was slow for."""
+    server = WireCodec(FRAMED)
+    client = WireCodec(FRAMED)
+    greeting = aes_cipher.encrypt(GREETING)
+    assert client.feed(greeting) == []
+    assert client.feed(greeting + server.encode(GREETING)) == [GREETING.encode()]
+    assert client.feed(server.encode("next")) == [b"next"]
+
+
+def test_decoding_limited() -> None:
+    """Messages beyond the limits wait, decoded by later feeds without data."""
+    client = WireCodec(FRAMED)
+    server = WireCodec(FRAMED)
+    data = b"".join(client.encode(f"m{i}") for i in range(5))
+    assert server.feed(data, 2) == [b"m0", b"m1"]
+    assert server.pending
+    assert server.feed(b"", max_bytes=1) == [b"m2"]
+    assert server.feed(b"") == [b"m3", b"m4"]
+    assert not server.pending
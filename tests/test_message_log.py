@@ -0,0 +1,42 @@
+"""test_message_log.py
+
+The Lair: the durable history of rooms, read back by number and by time.
+"""
+
+import os
+import time
+from typing import *
+
+from lairchat.store.MessageLog import MessageLog
+
+
+def test_reading_a_room_never_written_creates_nothing(tmp_path: Any) -> None:
+    """Asking for the history of a quiet room leaves the directory alone."""
+    log = MessageLog(str(tmp_path), commit_interval=0)
+    try:
+        assert log.last("#quiet", 10) == []
+        assert log.since("#quiet", 0.0, 10) == []
+        assert os.listdir(tmp_path) == []
+    finally:
+        log.close()
+
+
+def test_last_and_since_across_segments(tmp_path: Any) -> None:
+    """Records read back in order, however many segments they are spread over."""
+    log = MessageLog(str(tmp_path), segment_bytes=256, commit_interval=0)
+    try:
+        start = time.time()
+        for i in range(50):
+            log.append("#den", f"line {i}")
+        log.close()
+
+        log = MessageLog(str(tmp_path), segment_bytes=256, commit_interval=0)
+        assert len(os.listdir(tmp_path / "den")) > 2
+        assert [text for _, text in log.last("#den", 5)] == [
+            f"line {i}".encode() for i in range(45, 50)
+        ]
+        since = log.since("#den", start, 100)
+        assert [text for _, text in since] == [f"line {i}".encode() for i in range(50)]
+        assert log.since("#den", time.time() + 60, 10) == []
+    finally:
+        log.close()
@@ -0,0 +1,185 @@
+"""test_registry.py
+
+The Lair: broadcasts reach every client while others log in and out, and
+clients removed by other threads don't trip up their own.
+"""
+
+import logging
+import threading
+from collections import Counter
+from typing import *
+
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.net.Framing import FRAMED, WireCodec
+
+USERS = 50
+CHURNERS = 4
+STORMS = 4
+BROADCASTS = 500
+
+# A line and every command a client may send
+MESSAGES = [
+    "hello",
+    "{who}",
+    "{who #lair}",
+    "{away}",
+    "{back}",
+    "{presence on}",
+    "{presence off}",
+    "{join #den}",
+    "{part #den}",
+    "{part}",
+    "{msg u0 hi}",
+    "{history}",
+    "{history 5}",
+    "{mail}",
+    "{search hello}",
+    "{help}",
+    "{ack 10}",
+    "{nonsense}",
+]
+
+
+class PlainCodec(WireCodec):
+    """A framed codec that leaves messages in plain text."""
+
+    def encode(self, message: str) -> Union[bytes, None]:
+        """Encode a message without encrypting it."""
+        return message.encode("utf-8")
+
+
+class RecordingQueue:
+    """Stands in for an outbound queue, keeping every frame put in it."""
+
+    def __init__(self) -> None:
+        """Initialize the frames."""
+        self.frames: List[str] = []
+        self.closed = False
+
+    def put(self, frame: bytes) -> bool:
+        """Keep a frame."""
+        self.frames.append(frame.decode("utf-8"))
+        return True
+
+    def close(self, discard: bool = False) -> None:
+        """Mark the queue closed, frames are kept all the same."""
+        self.closed = True
+
+
+class RecordingServer(ChatServer):
+    """A server whose clients have recording queues and no writer threads."""
+
+    def create_queue(self, sock: Any, codec: WireCodec) -> RecordingQueue:
+        """Record frames instead of writing them."""
+        return RecordingQueue()
+
+
+def storm_lines(frames: List[str]) -> List[Tuple[int, int]]:
+    """The storm and number of every storm line among frames."""
+    lines = [frame.split() for frame in frames if frame.startswith("storm ")]
+    return [(int(storm), int(number)) for _, storm, number in lines]
+
+
+def test_no_broadcast_lost_or_repeated_while_clients_churn() -> None:
+    """Clients logged in throughout get every line once, churners never twice."""
+    logging.disable(logging.WARNING)
+    server = RecordingServer("127.0.0.1", 0, admin_console=False)
+    codec = PlainCodec(FRAMED)
+    try:
+        for i in range(USERS):
+            assert server.login(f"u{i}", object(), ("127.0.0.1", i), codec)
+
+        done = threading.Event()
+        churned: List[RecordingQueue] = []
+        errors: List[BaseException] = []
+
+        def churn(worker: int) -> None:
+            """Log clients in and out through the server until the storms end."""
+            i = 0
+            while not done.is_set():
+                username = f"c{worker}x{i}"
+                assert server.login(username, object(), ("127.0.0.1", i), codec)
+                churned.append(server.connections.get(username).queue)
+                server.remove_client(username)
+                i += 1
+
+        def storm(number: int) -> None:
+            """Broadcast numbered lines to everybody."""
+            for i in range(BROADCASTS):
+                server.broadcast_to_all(f"storm {number} {i}", relay=False)
+
+        def guard(work: Callable[[int], None], arg: int) -> threading.Thread:
+            """A thread recording what the work raises instead of losing it."""
+
+            def run() -> None:
+                try:
+                    work(arg)
+                except BaseException as e:
+                    errors.append(e)
+
+            return threading.Thread(target=run)
+
+        churners = [guard(churn, i) for i in range(CHURNERS)]
+        storms = [guard(storm, i) for i in range(STORMS)]
+        for thread in churners + storms:
+            thread.start()
+        for thread in storms:
+            thread.join()
+        done.set()
+        for thread in churners:
+            thread.join()
+        assert not errors, errors
+
+        # Every line once, and the lines of a storm in the order it sent them
+        sent = [(storm, i) for storm in range(STORMS) for i in range(BROADCASTS)]
+        for i in range(USERS):
+            lines = storm_lines(server.connections.get(f"u{i}").queue.frames)
+            assert sorted(lines) == sent
+            for storm in range(STORMS):
+                numbers = [number for s, number in lines if s == storm]
+                assert numbers == list(range(BROADCASTS))
+
+        # Churning clients miss what was sent while they were away, only that
+        assert churned
+        for queue in churned:
+            lines = storm_lines(queue.frames)
+            assert not [line for line, n in Counter(lines).items() if n > 1]
+            for storm in range(STORMS):
+                numbers = [number for s, number in lines if s == storm]
+                assert numbers == sorted(numbers)
+
+        # Every stable client heard every churner come and go exactly once
+        for i in range(USERS):
+            frames = Counter(server.connections.get(f"u{i}").queue.frames)
+            notices = [frame for frame in frames if " the lair" in frame]
+            assert notices and all(frames[frame] == 1 for frame in notices)
+    finally:
+        server.server.close()
+        logging.disable(logging.NOTSET)
+
+
+def test_messages_of_a_removed_client_are_ignored() -> None:
+    """A client evicted or expired by another thread has its messages dropped."""
+    logging.disable(logging.WARNING)
+    server = RecordingServer("127.0.0.1", 0, admin_console=False)
+    codec = PlainCodec(FRAMED)
+    try:
+        assert server.login("u0", object(), ("127.0.0.1", 0), codec)
+        assert server.login("gone", object(), ("127.0.0.1", 1), codec, True)
+        server.remove_client("gone")
+        before = list(server.connections.get("u0").queue.frames)
+        for message in MESSAGES:
+            assert not server.handle_message("gone", message)
+
+        # Handlers already running when it goes see no session either
+        for message in MESSAGES:
+            if message.startswith("{"):
+                command, _, argument = message[1:-1].partition(" ")
+                server.handle_command("gone", command, argument)
+            else:
+                server.say("gone", message)
+        assert server.connections.get("u0").queue.frames == before
+        assert "gone" not in server.rooms.get("#den", ())
+    finally:
+        server.server.close()
+        logging.disable(logging.NOTSET)
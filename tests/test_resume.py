@@ -0,0 +1,136 @@
+"""test_resume.py
+
+The Lair: a client cut off in the middle of a burst resumes where it was.
+"""
+
+import logging
+import re
+import threading
+import time
+from socket import *
+from typing import *
+
+import pytest
+
+from lairchat.cli.AsyncChatServer import AsyncChatServer
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Framing import FRAMED, WireCodec, encode_hello
+from lairchat.net.OutboundQueue import DISCONNECT, DROP
+from lairchat.net.Resume import GREETING, RESUME, SEPARATOR, SESSION
+
+ENGINES = {"threaded": ChatServer, "asyncio": AsyncChatServer}
+LINE = re.compile(r"talker: m(\d+)$")
+MESSAGES = 200
+READ_BEFORE_DROP = 50
+
+
+class Connection:
+    """A framed client connection read a message at a time."""
+
+    def __init__(self, port: int) -> None:
+        """Connect and say hello."""
+        self.sock = create_connection(("127.0.0.1", port))
+        self.sock.settimeout(5)
+        self.sock.sendall(encode_hello())
+        self.codec = WireCodec(FRAMED)
+        self.pending: List[str] = []
+
+    def send(self, message: str) -> None:
+        """Send a message."""
+        self.sock.sendall(self.codec.encode(message))
+
+    def read(self) -> str:
+        """The next message, waiting for it."""
+        while not self.pending:
+            data = self.sock.recv(65536)
+            assert data, "the server closed the connection"
+            self.pending += [m.decode("utf-8") for m in self.codec.feed(data)]
+        return self.pending.pop(0)
+
+    def read_until(self, text: str) -> List[str]:
+        """The messages up to and including the first one holding text."""
+        messages = [self.read()]
+        while text not in messages[-1]:
+            messages.append(self.read())
+        return messages
+
+
+def numbered(message: str) -> Tuple[int, str]:
+    """The sequence number and text of a message of a session."""
+    number, separator, text = message.partition(SEPARATOR)
+    assert separator and number.isdigit(), message
+    return int(number), text
+
+
+@pytest.mark.parametrize("policy", [DISCONNECT, DROP])
+@pytest.mark.parametrize("engine", list(ENGINES))
+def test_resume_replays_exactly_the_missed_messages(engine: str, policy: str) -> None:
+    """Every line is read once, the replay holds just the ones not read."""
+    logging.disable(logging.WARNING)
+    config = ServerConfig(slow_policy=policy)
+    server = ENGINES[engine]("127.0.0.1", 0, admin_console=False, config=config)
+    port = server.server.getsockname()[1]
+    threading.Thread(target=server.run, daemon=True).start()
+    try:
+        # A listener with a session
+        listener = Connection(port)
+        listener.read_until(GREETING)
+        listener.send(SESSION)
+        listener.send("listener")
+        _, session = numbered(listener.read_until("{session ")[-1])
+        _, username, token = session[1:-1].split()
+
+        talker = Connection(port)
+        talker.read_until(GREETING)
+        talker.send("talker")
+        talker.read_until("Hello talker!")
+
+        # Talk while the listener reads part of the burst and is cut off
+        talked = threading.Event()
+
+        def talk() -> None:
+            """Say numbered lines, pausing now and then."""
+            for i in range(MESSAGES):
+                talker.send(f"m{i}")
+                if i % 10 == 0:
+                    time.sleep(0.005)
+            talked.set()
+
+        threading.Thread(target=talk, daemon=True).start()
+        seen: List[int] = []
+        lines: List[int] = []
+        while len(lines) < READ_BEFORE_DROP:
+            seq, text = numbered(listener.read())
+            seen.append(seq)
+            if (line := LINE.search(text)) is not None:
+                lines.append(int(line.group(1)))
+        last = seen[-1]
+        listener.sock.close()
+        assert talked.wait(10)
+
+        # What was sent after the last number read comes again, then the end
+        listener = Connection(port)
+        listener.read_until(GREETING)
+        listener.send(f"{RESUME}{username} {token} {last}}}")
+        replayed = [numbered(message) for message in listener.read_until("{resumed ")]
+        later = [numbered(message) for message in listener.read_until("Welcome back!")]
+        welcome = later[-1][1]
+
+        # Lines the server hadn't relayed yet come after it, as they always do
+        end = f"talker: m{MESSAGES - 1}"
+        while not any(text.endswith(end) for _, text in replayed + later):
+            later.append(numbered(listener.read()))
+
+        # Every line once and in order, the replay holding the ones not read
+        replayed_lines = [int(m.group(1)) for _, t in replayed if (m := LINE.search(t))]
+        later_lines = [int(m.group(1)) for _, t in later if (m := LINE.search(t))]
+        assert replayed[0][0] > last
+        assert lines + replayed_lines + later_lines == list(range(MESSAGES))
+
+        # Every number once and in order, and the replay counted right
+        seen += [seq for seq, _ in replayed + later]
+        assert seen == sorted(set(seen))
+        assert welcome.startswith(f"Welcome back!  {len(replayed) - 1} missed")
+    finally:
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,92 @@
+"""test_search_index.py
+
+The Lair: searching room messages, in memory and across merged segments.
+"""
+
+import os
+from typing import *
+
+from lairchat.store.SearchIndex import BLOCK, SearchIndex
+
+MESSAGES = 1000
+
+
+def fill(index: SearchIndex) -> None:
+    """Index numbered messages, every other one odd, over two rooms."""
+    for i in range(MESSAGES):
+        parity = "odd" if i % 2 else "even"
+        index.add("#den" if i % 5 == 0 else "#lair", f"every {parity} m{i}", i)
+
+
+def numbers(found: List[Tuple[float, str, str]]) -> List[int]:
+    """The numbers of the messages found."""
+    return [int(text.rsplit("m", 1)[1]) for _, _, text in found]
+
+
+def test_search_pages_newest_first(tmp_path: Any) -> None:
+    """Pages follow each other without gaps, in memory and on disk alike."""
+    index = SearchIndex(str(tmp_path), flush_messages=100000)
+    fill(index)
+    odd = list(range(MESSAGES - 1, 0, -2))
+    try:
+        for _ in range(2):
+            pages = []
+            offset = 0
+            while True:
+                found, more = index.search({"every", "odd"}, None, offset, 7)
+                pages += numbers(found)
+                offset += 7
+                if not more:
+                    break
+            assert pages == odd
+
+            # Messages of a room, and a word nobody said
+            found, more = index.search({"even"}, "#den", 0, 3)
+            assert numbers(found) == [990, 980, 970] and more
+            assert index.search({"every", "nobody"}, None, 0, 10) == ([], False)
+
+            # Again once it is all written to a single segment
+            index.close()
+            index = SearchIndex(str(tmp_path), flush_messages=100000)
+            assert len(index.segments) == 1
+    finally:
+        index.close()
+
+
+def test_segments_merge(tmp_path: Any) -> None:
+    """Flushed segments merge by size, searches span what is left of them."""
+    index = SearchIndex(str(tmp_path), flush_messages=BLOCK // 2, merge_factor=4)
+    fill(index)
+    index.close()
+
+    index = SearchIndex(str(tmp_path), flush_messages=BLOCK // 2, merge_factor=4)
+    try:
+        # Sixteen flushes merge four at a time, the last four into a segment
+        # still smaller than four flushes, as the last flush was short
+        assert [index.tier(segment) for segment in index.segments] == [1, 1, 1, 0]
+        assert [segment.count for segment in index.segments] == [256] * 3 + [232]
+        assert index.messages == MESSAGES
+        found, more = index.search({"odd"}, None, 0, MESSAGES)
+        assert numbers(found) == list(range(MESSAGES - 1, 0, -2)) and not more
+        found, _ = index.search({"m512"}, None, 0, 10)
+        assert numbers(found) == [512]
+    finally:
+        index.close()
+
+
+def test_stray_files_removed(tmp_path: Any) -> None:
+    """Files of an unfinished flush go, files the index didn't write stay."""
+    index = SearchIndex(str(tmp_path))
+    index.add("#lair", "hello there")
+    index.close()
+    for name in ("000000000099-000000000100.post", "manifest.json.tmp", "notes.txt"):
+        (tmp_path / name).write_bytes(b"")
+
+    index = SearchIndex(str(tmp_path))
+    try:
+        assert "notes.txt" in os.listdir(tmp_path)
+        assert "manifest.json.tmp" not in os.listdir(tmp_path)
+        assert "000000000099-000000000100.post" not in os.listdir(tmp_path)
+        assert index.search({"hello"}, None, 0, 10)[0][0][2] == "hello there"
+    finally:
+        index.close()
@@ -0,0 +1,121 @@
+"""test_shards.py
+
+The Lair: a dweller of a sharded lair finds its mail on whichever shard,
+and its name free when its session is on another.
+"""
+
+import contextlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from typing import *
+
+import pytest
+
+from lairchat.cli.ShardedServer import ShardedServer
+from lairchat.net.Resume import GREETING, RESUME, SESSION, SESSION_GONE
+from test_resume import ENGINES, Connection, numbered
+
+RECIPIENTS = 6
+ATTEMPTS = 50
+
+
+def wait_for_workers(port: int) -> None:
+    """Wait until a worker listens on the port."""
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            Connection(port).sock.close()
+            return
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline, "no worker is listening"
+            time.sleep(0.05)
+
+
+@contextlib.contextmanager
+def sharded_lair(engine: str) -> Iterator[int]:
+    """Run a lair of two shards in a process of its own, yield its port."""
+    logging.disable(logging.WARNING)
+    sharded = ShardedServer(ENGINES[engine], "127.0.0.1", 0, 2, admin_console=False)
+    port = sharded.address[1]
+    process = multiprocessing.get_context("fork").Process(target=sharded.run)
+    process.start()
+
+    # Only the forked hub holds on to the links, workers close as it goes
+    sharded.server.close()
+    for link in sharded.hub.links:
+        for pair in link:
+            for sock in pair:
+                sock.close()
+    try:
+        wait_for_workers(port)
+        yield port
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(10)
+        logging.disable(logging.NOTSET)
+
+
+def log_in(port: int, username: str) -> Tuple[Connection, str]:
+    """Connect and log in, the welcome comes back with it."""
+    connection = Connection(port)
+    connection.read_until(GREETING)
+    connection.send(username)
+    return connection, connection.read_until(f"Hello {username}!")[-1]
+
+
+@pytest.mark.parametrize("engine", list(ENGINES))
+def test_mail_waits_whichever_shard_it_is_taken_from(engine: str) -> None:
+    """Whispers to dwellers who are away reach them on any shard."""
+    with sharded_lair(engine) as port:
+        talker, _ = log_in(port, "talker")
+        for i in range(RECIPIENTS):
+            recipient, _ = log_in(port, f"r{i}")
+            recipient.sock.close()
+
+            # Whisper once the recipient has left every shard
+            while True:
+                talker.send("{who}")
+                if talker.read_until(" dwellers in ")[-1].startswith("1 dwellers"):
+                    break
+            talker.send(f"{{msg r{i} are you there?}}")
+            assert "is away" in talker.read_until(f"r{i} is ")[-1]
+
+            recipient, welcome = log_in(port, f"r{i}")
+            assert "1 messages came while you were away:" in welcome
+            assert welcome.endswith("talker whispers: are you there?")
+            recipient.sock.close()
+
+
+@pytest.mark.parametrize("engine", list(ENGINES))
+def test_session_gone_on_another_shard_frees_the_name(engine: str) -> None:
+    """A client that can't resume on the shard it reached logs in again."""
+    with sharded_lair(engine) as port:
+        connection = Connection(port)
+        connection.read_until(GREETING)
+        connection.send(SESSION)
+        connection.send("dweller")
+        _, session = numbered(connection.read_until("{session ")[-1])
+        _, username, token = session[1:-1].split()
+
+        # Reconnect until the kernel hands the client to the other shard
+        for _ in range(ATTEMPTS):
+            connection.sock.close()
+            connection = Connection(port)
+            connection.read_until(GREETING)
+            connection.send(f"{RESUME}{username} {token} 0}}")
+            message = connection.read()
+            while message != SESSION_GONE and "{resumed " not in message:
+                message = connection.read()
+            if message == SESSION_GONE:
+                break
+        assert message == SESSION_GONE
+
+        # The name is free at once
+        connection.send("dweller")
+        message = connection.read()
+        while "Hello dweller!" not in message and "is already taken" not in message:
+            message = connection.read()
+        assert "Hello dweller!" in message
@@ -0,0 +1,124 @@
+"""test_slow_policy.py
+
+The Lair: frames are dropped for slow clients only where nothing breaks.
+"""
+
+import dataclasses
+import logging
+import re
+from socket import *
+from typing import *
+
+from lairchat.cli.ChatServer import ChatServer
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.net.Compression import Inflater
+from lairchat.net.Framing import FRAMED, WireCodec
+from lairchat.net.OutboundQueue import DROP, OutboundQueue
+from lairchat.net.Resume import SessionState
+
+LINE = re.compile(r"^line (\d+): ")
+BURSTS = 4
+LINES = 100
+
+
+def text(i: int) -> str:
+    """A line long enough to be compressed, much like the ones before it."""
+    return f"line {i}: " + " ".join(f"word{i * 7 + j}" for j in range(8))
+
+
+class StalledServer(ChatServer):
+    """A server whose clients' frames are only written when a test says so."""
+
+    def create_queue(self, sock: socket, codec: WireCodec) -> OutboundQueue:
+        """Queue frames without a writer thread."""
+        return OutboundQueue(
+            self.config.queue_high_water,
+            self.config.queue_low_water,
+            self.config.slow_policy,
+        )
+
+
+def test_streamed_client_never_misses_a_frame() -> None:
+    """A slow client of a compression stream is cut off, not sent a broken one."""
+    logging.disable(logging.WARNING)
+    config = ServerConfig(slow_policy=DROP, queue_high_water=4096, queue_low_water=1024)
+    server = StalledServer("127.0.0.1", 0, admin_console=False, config=config)
+    socks = [*socketpair(), *socketpair()]
+    try:
+        plain = WireCodec(FRAMED)
+        streamed = WireCodec(FRAMED)
+        streamed.compress(streaming=True)
+        assert server.login("plain", socks[0], ("127.0.0.1", 1), plain)
+        assert server.login("streamed", socks[2], ("127.0.0.1", 2), streamed)
+        plain_queue = server.connections.get("plain").queue
+        queue = server.connections.get("streamed").queue
+
+        # Bursts too large for the queue, read by the client in between
+        client = WireCodec(FRAMED)
+        client.inflater = Inflater()
+        lines = []
+        for burst in range(BURSTS):
+            for i in range(burst * LINES, (burst + 1) * LINES):
+                server.broadcast_to_all(text(i), relay=False)
+            while queue.frames:
+                for frame in queue.get_batch():
+                    for message in map(bytes.decode, client.feed(frame)):
+                        if line := LINE.match(message):
+                            lines.append(int(line.group(1)))
+                            assert message == text(lines[-1])
+
+        # Lines stop where the streamed client was cut off, the plain one
+        # lost some and stays
+        assert "streamed" not in server.connections
+        assert lines == list(range(len(lines)))
+        assert "plain" in server.connections and plain_queue.dropped_frames
+    finally:
+        server.server.close()
+        for sock in socks:
+            sock.close()
+        logging.disable(logging.NOTSET)
+
+
+def test_session_client_resumes_what_it_was_not_sent() -> None:
+    """A slow client with a session is cut off, and resumes with every line."""
+    logging.disable(logging.WARNING)
+    config = ServerConfig(slow_policy=DROP, queue_high_water=4096, queue_low_water=1024)
+    server = StalledServer("127.0.0.1", 0, admin_console=False, config=config)
+    socks = [*socketpair(), *socketpair()]
+    try:
+        assert server.login(
+            "listener", socks[0], ("127.0.0.1", 1), WireCodec(FRAMED), resumable=True
+        )
+        queue = server.connections.get("listener").queue
+        client = WireCodec(FRAMED)
+        state = SessionState()
+        lines = []
+
+        def read(queue: OutboundQueue) -> None:
+            """Read what is queued for the client."""
+            while queue.frames:
+                for frame in queue.get_batch():
+                    for message in client.feed(frame):
+                        text, _ = state.receive(message.decode("utf-8"))
+                        if text is not None and (line := LINE.match(text)):
+                            lines.append(int(line.group(1)))
+
+        # The client reads lines as they come, then stops reading
+        for i in range(BURSTS * LINES):
+            server.broadcast_to_all(text(i), relay=False)
+            if i < LINES:
+                read(queue)
+        assert queue.closed and "listener" in server.connections
+
+        # Resuming on a link that keeps up brings every line it didn't read
+        server.config = dataclasses.replace(config, queue_high_water=1 << 20)
+        codec = WireCodec(FRAMED)
+        greeted = state.greeted()
+        assert server.resume(greeted, socks[2], ("127.0.0.1", 2), codec) == "listener"
+        read(server.connections.get("listener").queue)
+        assert lines == list(range(BURSTS * LINES))
+    finally:
+        server.server.close()
+        for sock in socks:
+            sock.close()
+        logging.disable(logging.NOTSET)
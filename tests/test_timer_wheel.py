@@ -0,0 +1,77 @@
+"""test_timer_wheel.py
+
+The Lair: timers come due to the tick, however far off or late the wheel.
+"""
+
+import logging
+from typing import *
+
+from lairchat.cli.ServerConfig import ServerConfig
+from lairchat.cli.TimerWheel import TimerWheel
+from lairchat.net.Framing import FRAMED
+from test_registry import PlainCodec, RecordingServer
+
+
+def test_due_to_the_tick() -> None:
+    """A timer is due on the tick its delay ends in, never before."""
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    wheel.schedule(2.5, "a", 0.0)
+    assert wheel.advance(2.9) == []
+    assert wheel.advance(3.0) == ["a"]
+    assert len(wheel) == 0 and wheel.next_tick() is None
+
+
+def test_timers_beyond_a_turn_wait_for_their_turn() -> None:
+    """Timers sharing a slot on different turns of the wheel come due apart."""
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    for delay in (3, 11, 19):
+        wheel.schedule(delay, delay, 0.0)
+    fired = []
+    for now in range(1, 25):
+        for item in wheel.advance(float(now)):
+            fired.append((now, item))
+    assert fired == [(3, 3), (11, 11), (19, 19)]
+
+
+def test_long_pause() -> None:
+    """A wheel turned late hands out everything due at once, and only that."""
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    for delay in range(1, 40):
+        wheel.schedule(delay, delay, 0.0)
+    assert sorted(wheel.advance(30.5)) == list(range(1, 31))
+    assert len(wheel) == 9
+    assert sorted(wheel.advance(40.0)) == list(range(31, 40))
+
+
+def test_never_early_after_a_pause() -> None:
+    """Set from another thread while the wheel lags, a timer still waits."""
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    wheel.schedule(1.0, "late", 5.7)
+    assert wheel.advance(6.5) == []
+    assert wheel.advance(7.0) == ["late"]
+
+
+def test_timers_of_a_moved_session_are_ignored() -> None:
+    """Timers aren't cancelled, the heartbeat of a replaced queue does nothing."""
+    logging.disable(logging.WARNING)
+    config = ServerConfig(heartbeat_interval=1.0, idle_timeout=2.0)
+    server = RecordingServer("127.0.0.1", 0, admin_console=False, config=config)
+    try:
+        assert server.login("u0", object(), ("127.0.0.1", 0), PlainCodec(FRAMED))
+        session = server.connections.get("u0")
+        old_queue = session.queue
+        session.queue = server.create_queue(object(), session.codec)
+        session.seen -= 10
+
+        timers = len(server.wheel)
+        server.heartbeat(session, old_queue)
+        assert len(server.wheel) == timers
+        assert server.metrics.pings.value == 0 and not session.queue.frames
+
+        # The heartbeat of the current queue pings the quiet client
+        session.seen += 9
+        server.heartbeat(session, session.queue)
+        assert server.metrics.pings.value == 1 and len(server.wheel) == timers + 1
+    finally:
+        server.server.close()
+        logging.disable(logging.NOTSET)